@@ -0,0 +1,161 @@
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from .config import (
+    BITRATE_BUDGET_UTILIZATION,
+    BITRATE_DECREASE_HOLD,
+    BITRATE_HYSTERESIS,
+    BITRATE_INCREASE_HOLD,
+    BITRATE_MIN,
+    BITRATE_MIN_FPS,
+    BITRATE_RESTART_INTERVAL,
+)
+
+if TYPE_CHECKING:
+    from .stream_handler import StreamHandler
+
+
+@dataclass
+class RateTarget:
+    bitrate: int
+    fps: float
+
+
+def allocate_budget(budget_bps: float, demands: dict[str, tuple[float, int]]) -> dict[str, float]:
+    """
+    Water-fills `budget_bps` across streams by weight. `demands` maps stream id to
+    (weight, maximum bitrate); a stream never gets more than its maximum and what it
+    leaves unused is shared among the others.
+    """
+    allocation: dict[str, float] = {}
+    remaining = dict(demands)
+    budget = max(budget_bps, 0.0)
+    while remaining:
+        total_weight = sum(weight for weight, _ in remaining.values()) or 1.0
+        capped = {
+            stream_id: maximum
+            for stream_id, (weight, maximum) in remaining.items()
+            if maximum <= budget * weight / total_weight
+        }
+        if not capped:
+            for stream_id, (weight, _) in remaining.items():
+                allocation[stream_id] = budget * weight / total_weight
+            break
+        for stream_id, maximum in capped.items():
+            allocation[stream_id] = maximum
+            budget -= maximum
+            del remaining[stream_id]
+    return allocation
+
+
+class BitrateController:
+    """
+    Fits the encoders inside the measured uplink budget.
+    - The budget is a share of the estimated capacity minus non-stream and passthrough traffic
+    - It is split across transcoding streams by weight, capped at each profile's bitrate
+    - Streams squeezed below half their profile bitrate also get a proportionally lower fps
+    - Targets move only past a relative threshold and after a hold time, lowering faster than raising
+    - New targets need an encoder restart, so at most one stream is restarted per interval
+    """
+
+    def __init__(self):
+        self.budget_bps: float | None = None
+        self.allocations: dict[str, float] = {}
+        self._changed_at: dict[str, float] = {}
+        self._last_restart: float = 0.0
+
+    def update(self, handlers: list["StreamHandler"], capacity: dict) -> "StreamHandler | None":
+        """Recomputes the targets and returns the handler to restart with its new target, if any."""
+        adjustable = [handler for handler in handlers if handler.is_running() and handler.is_transcoding()]
+        self.budget_bps = self._get_budget(handlers, capacity)
+        if self.budget_bps is None:
+            # No evidence that the uplink is constrained, run every profile as configured
+            self.allocations = {}
+            targets = {handler.id: None for handler in adjustable}
+        else:
+            self.allocations = allocate_budget(
+                self.budget_bps,
+                {handler.id: (handler.weight, handler.base_encoder_profile().bitrate) for handler in adjustable},
+            )
+            targets = {handler.id: self._get_target(handler, self.allocations[handler.id]) for handler in adjustable}
+
+        now = time.time()
+        for stream_id in list(self._changed_at):
+            if stream_id not in targets:
+                del self._changed_at[stream_id]
+        if now - self._last_restart < BITRATE_RESTART_INTERVAL:
+            return None
+
+        # Apply the largest pending change first
+        candidates = []
+        for handler in adjustable:
+            change = self._get_change(handler, targets[handler.id], now)
+            if change is not None:
+                candidates.append((change, handler))
+        if not candidates:
+            return None
+        _, handler = max(candidates, key=lambda candidate: candidate[0])
+        target = targets[handler.id]
+        handler.rate_target = target
+        self._changed_at[handler.id] = now
+        self._last_restart = now
+        return handler
+
+    def _get_budget(self, handlers: list["StreamHandler"], capacity: dict) -> float | None:
+        # A lower-bound estimate only says the uplink carried what we sent, not that it is full
+        if not capacity or capacity.get("confidence") not in ("saturated", "calibrated"):
+            return None
+        budget = capacity["upload_capacity_mbps"] * 1_000_000 * BITRATE_BUDGET_UTILIZATION
+        stream_upload_mbps = capacity.get("stream_upload_mbps")
+        if stream_upload_mbps is not None:
+            other_traffic = capacity["upload_usage_mbps"] - stream_upload_mbps
+            budget -= max(other_traffic, 0) * 1_000_000
+        for handler in handlers:
+            if handler.is_running() and not handler.is_transcoding() and handler.telemetry.bitrate_bps:
+                budget -= handler.telemetry.bitrate_bps
+        return max(budget, 0.0)
+
+    def _get_target(self, handler: "StreamHandler", allocation: float) -> RateTarget | None:
+        profile = handler.base_encoder_profile()
+        bitrate = max(int(allocation), BITRATE_MIN)
+        if bitrate >= profile.bitrate:
+            return None
+        fps = profile.fps
+        ratio = bitrate / profile.bitrate
+        if ratio < 0.5:
+            fps = max(BITRATE_MIN_FPS, round(profile.fps * ratio * 2, 1))
+        return RateTarget(bitrate=bitrate // 1000 * 1000, fps=min(fps, profile.fps))
+
+    def _get_change(self, handler: "StreamHandler", target: RateTarget | None, now: float) -> float | None:
+        """Returns the relative size of the change to `target`, or None if it should not be applied yet."""
+        base_bitrate = handler.base_encoder_profile().bitrate
+        current_bitrate = handler.rate_target.bitrate if handler.rate_target else base_bitrate
+        new_bitrate = target.bitrate if target else base_bitrate
+        change = abs(new_bitrate - current_bitrate) / current_bitrate
+        if change < BITRATE_HYSTERESIS:
+            return None
+        hold = BITRATE_DECREASE_HOLD if new_bitrate < current_bitrate else BITRATE_INCREASE_HOLD
+        if now - self._changed_at.get(handler.id, 0) < hold:
+            return None
+        return change
+
+    def get_report(self, handlers: list["StreamHandler"]) -> dict:
+        return {
+            "budget_kbps": self.budget_bps / 1000 if self.budget_bps is not None else None,
+            "streams": {
+                handler.id: {
+                    "weight": handler.weight,
+                    "allocated_kbps": (
+                        self.allocations[handler.id] / 1000 if handler.id in self.allocations else None
+                    ),
+                    "target_kbps": handler.get_encoder_profile().bitrate / 1000 if handler.is_transcoding() else None,
+                    "target_fps": handler.get_encoder_profile().fps if handler.is_transcoding() else None,
+                    "actual_kbps": (
+                        handler.telemetry.bitrate_bps / 1000 if handler.telemetry.bitrate_bps is not None else None
+                    ),
+                }
+                for handler in handlers
+                if handler.is_running()
+            },
+        }
@@ -0,0 +1,99 @@
+import time
+from functools import cache
+
+from .config import (
+    CAPACITY_RETRANSMIT_THRESHOLD,
+    CAPACITY_SEND_QUEUE_THRESHOLD,
+    SPEEDTEST_CALIBRATION_INTERVAL,
+)
+from .network_utils import read_cached_network_speedtest
+from .system_sampler import SystemSample
+
+
+class CapacityEstimator:
+    """
+    Estimates the sustained achievable upload rate from passive signals:
+    - Interface TX rates from the system sampler
+    - Per-stream output throughput reported by the encoders, when available
+    - TCP retransmit ratio and send-queue depth from /proc
+
+    While the uplink shows no congestion the observed throughput is only a lower
+    bound on capacity, so the estimate never decreases. Once retransmits or send
+    queues build up the link is saturated and the estimate tracks the sustained
+    throughput. A speedtest calibration seeds the estimate while it is younger than
+    the calibration interval, older ones are only kept for reporting.
+    """
+
+    def __init__(self):
+        self.estimate_bps: float | None = None
+        self.calibration: dict | None = None
+        self.last_calibration_attempt: float = 0.0
+        self._report: dict = {}
+
+    def calibrate(self, speedtest: dict):
+        self.calibration = speedtest
+        if self.is_calibrated():
+            self.estimate_bps = speedtest["upload_mbps"] * 1_000_000
+
+    def is_calibrated(self) -> bool:
+        """Whether a speedtest calibration younger than the calibration interval exists."""
+        return (
+            self.calibration is not None
+            and self.calibration.get("timestamp", 0) >= time.time() - SPEEDTEST_CALIBRATION_INTERVAL
+        )
+
+    def calibration_due(self) -> bool:
+        last_calibration = self.calibration.get("timestamp", 0) if self.calibration else 0
+        return max(last_calibration, self.last_calibration_attempt) < time.time() - SPEEDTEST_CALIBRATION_INTERVAL
+
+    def update(self, samples: list[SystemSample], stream_bps: dict[str, float] | None = None) -> dict:
+        if not samples:
+            return self.get_report()
+
+        tx_rates = sorted(sample.tx_bps for sample in samples)
+        usage_bps = sum(tx_rates) / len(tx_rates)
+        # 90th percentile, so short bursts don't count as sustained throughput
+        sustained_bps = tx_rates[round(0.9 * (len(tx_rates) - 1))]
+        ratios = [s.tcp_retransmit_ratio for s in samples if s.tcp_retransmit_ratio is not None]
+        retransmit_ratio = sum(ratios) / len(ratios) if ratios else 0.0
+        send_queue = sorted(sample.tcp_send_queue for sample in samples)[len(samples) // 2]
+        congested = (
+            retransmit_ratio > CAPACITY_RETRANSMIT_THRESHOLD
+            or send_queue > CAPACITY_SEND_QUEUE_THRESHOLD
+        )
+
+        if congested:
+            if self.estimate_bps is None:
+                self.estimate_bps = sustained_bps
+            else:
+                self.estimate_bps = (self.estimate_bps + sustained_bps) / 2
+            confidence = "saturated"
+        else:
+            self.estimate_bps = max(self.estimate_bps or 0.0, sustained_bps)
+            confidence = "calibrated" if self.is_calibrated() else "lower_bound"
+
+        stream_upload_bps = sum(stream_bps.values()) if stream_bps else None
+        self._report = {
+            "upload_capacity_mbps": self.estimate_bps / 1_000_000,
+            "upload_usage_mbps": usage_bps / 1_000_000,
+            "headroom_mbps": max(self.estimate_bps - usage_bps, 0) / 1_000_000,
+            "stream_upload_mbps": stream_upload_bps / 1_000_000 if stream_upload_bps is not None else None,
+            "congested": congested,
+            "confidence": confidence,
+            "tcp_retransmit_ratio": retransmit_ratio,
+            "tcp_send_queue_bytes": send_queue,
+            "calibrated_at": self.calibration.get("timestamp") if self.calibration else None,
+        }
+        return self.get_report()
+
+    def get_report(self) -> dict:
+        return dict(self._report)
+
+
+@cache
+def get_capacity_estimator() -> CapacityEstimator:
+    estimator = CapacityEstimator()
+    cached_speedtest = read_cached_network_speedtest()
+    if isinstance(cached_speedtest, dict) and "upload_mbps" in cached_speedtest:
+        estimator.calibrate(cached_speedtest)
+    return estimator
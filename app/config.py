@@ -0,0 +1,193 @@
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_int_list(name: str, default: list[int]) -> list[int]:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Logging, written by a background thread. LOG_FORMAT is "json" (one object per line) or "text"
+LOG_FORMAT = os.environ.get("STREAMBOX_LOG_FORMAT", "json").strip().lower()
+LOG_MAX_BYTES = _env_int("STREAMBOX_LOG_MAX_BYTES", 50 * 1024 * 1024)
+LOG_BACKUP_COUNT = _env_int("STREAMBOX_LOG_BACKUP_COUNT", 1)
+LOG_QUEUE_SIZE = _env_int("STREAMBOX_LOG_QUEUE_SIZE", 10000)
+# Identical messages within this many seconds are logged once, then summarized, 0 to log all
+LOG_DEDUP_WINDOW = _env_float("STREAMBOX_LOG_DEDUP_WINDOW", 60.0)
+LOG_DEDUP_MAX_KEYS = _env_int("STREAMBOX_LOG_DEDUP_MAX_KEYS", 1024)
+
+# RTSP source probing
+PROBE_CONCURRENCY = _env_int("STREAMBOX_PROBE_CONCURRENCY", 4)
+PROBE_TIMEOUT = _env_float("STREAMBOX_PROBE_TIMEOUT", 10.0)
+PROBE_CACHE_TTL = _env_float("STREAMBOX_PROBE_CACHE_TTL", 300.0)
+PROBE_CACHE_NEGATIVE_TTL = _env_float("STREAMBOX_PROBE_CACHE_NEGATIVE_TTL", 30.0)
+PROBE_CACHE_MAX_ENTRIES = _env_int("STREAMBOX_PROBE_CACHE_MAX_ENTRIES", 256)
+# Seconds of packets read per probe to measure the source GOP, 0 to skip. Every probe takes
+# this much longer, and keyframe-only decoding is only chosen for sources with a measured GOP
+PROBE_GOP_DURATION = _env_float("STREAMBOX_PROBE_GOP_DURATION", 0.0)
+
+# Background system metrics sampling
+SYSTEM_SAMPLE_INTERVAL = _env_float("STREAMBOX_SYSTEM_SAMPLE_INTERVAL", 5.0)
+SYSTEM_SAMPLE_HISTORY = _env_int("STREAMBOX_SYSTEM_SAMPLE_HISTORY", 120)
+SYSTEM_AVERAGE_WINDOW = _env_float("STREAMBOX_SYSTEM_AVERAGE_WINDOW", 60.0)
+
+# Passive uplink capacity estimation
+CAPACITY_WINDOW = _env_float("STREAMBOX_CAPACITY_WINDOW", 120.0)
+CAPACITY_RETRANSMIT_THRESHOLD = _env_float("STREAMBOX_CAPACITY_RETRANSMIT_THRESHOLD", 0.02)
+CAPACITY_SEND_QUEUE_THRESHOLD = _env_int("STREAMBOX_CAPACITY_SEND_QUEUE_THRESHOLD", 256 * 1024)
+# Active speedtests saturate the uplink, so they only run on request and while no stream is running
+SPEEDTEST_CALIBRATION = _env_bool("STREAMBOX_SPEEDTEST_CALIBRATION", False)
+SPEEDTEST_CALIBRATION_INTERVAL = _env_float("STREAMBOX_SPEEDTEST_CALIBRATION_INTERVAL", 6 * 3600.0)
+
+# Backend HTTP client
+STREAM_INFO_URL = os.environ.get(
+    "STREAMBOX_STREAM_INFO_URL", "https://abm.phronetic.ai/api/v1/devices/stream_info"
+).strip()
+BACKEND_CONNECT_TIMEOUT = _env_float("STREAMBOX_BACKEND_CONNECT_TIMEOUT", 5.0)
+BACKEND_READ_TIMEOUT = _env_float("STREAMBOX_BACKEND_READ_TIMEOUT", 15.0)
+BACKEND_KEEPALIVE_EXPIRY = _env_float("STREAMBOX_BACKEND_KEEPALIVE_EXPIRY", 120.0)
+# HTTP/2 is only used when the optional h2 package is installed
+BACKEND_HTTP2 = _env_bool("STREAMBOX_BACKEND_HTTP2", True)
+BACKEND_MAX_RETRIES = _env_int("STREAMBOX_BACKEND_MAX_RETRIES", 3)
+BACKEND_RETRY_BASE_DELAY = _env_float("STREAMBOX_BACKEND_RETRY_BASE_DELAY", 1.0)
+BACKEND_RETRY_MAX_DELAY = _env_float("STREAMBOX_BACKEND_RETRY_MAX_DELAY", 10.0)
+
+# Heartbeat encoding. Deltas and compression need backend support, so both are opt-in
+HEARTBEAT_DELTA = _env_bool("STREAMBOX_HEARTBEAT_DELTA", False)
+HEARTBEAT_FULL_INTERVAL = _env_int("STREAMBOX_HEARTBEAT_FULL_INTERVAL", 30)
+# One of "none", "gzip" or "zstd" (zstd needs the zstandard package, else gzip is used)
+HEARTBEAT_COMPRESSION = os.environ.get("STREAMBOX_HEARTBEAT_COMPRESSION", "none").strip().lower()
+
+# ffmpeg supervision
+FFMPEG_STOP_TIMEOUT = _env_float("STREAMBOX_FFMPEG_STOP_TIMEOUT", 5.0)
+RESTART_BACKOFF_BASE = _env_float("STREAMBOX_RESTART_BACKOFF_BASE", 2.0)
+RESTART_BACKOFF_MAX = _env_float("STREAMBOX_RESTART_BACKOFF_MAX", 120.0)
+# A process that ran this long before exiting resets the backoff
+RESTART_STABLE_RUNTIME = _env_float("STREAMBOX_RESTART_STABLE_RUNTIME", 60.0)
+CRASH_LOOP_THRESHOLD = _env_int("STREAMBOX_CRASH_LOOP_THRESHOLD", 5)
+CRASH_LOOP_WINDOW = _env_float("STREAMBOX_CRASH_LOOP_WINDOW", 300.0)
+CRASH_LOOP_PARK_TIME = _env_float("STREAMBOX_CRASH_LOOP_PARK_TIME", 900.0)
+
+# Per-stream error events reported in the heartbeat logs
+ERROR_STORE_MAX_ENTRIES = _env_int("STREAMBOX_ERROR_STORE_MAX_ENTRIES", 16)
+ERROR_DETAIL_MAX_CHARS = _env_int("STREAMBOX_ERROR_DETAIL_MAX_CHARS", 1000)
+
+# ffmpeg output buffering, per stream and per pipe
+FFMPEG_LOG_MAX_LINES = _env_int("STREAMBOX_FFMPEG_LOG_MAX_LINES", 200)
+FFMPEG_LOG_MAX_BYTES = _env_int("STREAMBOX_FFMPEG_LOG_MAX_BYTES", 32 * 1024)
+FFMPEG_LOG_MAX_LINE_LENGTH = _env_int("STREAMBOX_FFMPEG_LOG_MAX_LINE_LENGTH", 1024)
+FFMPEG_CRASH_TAIL_LINES = _env_int("STREAMBOX_FFMPEG_CRASH_TAIL_LINES", 20)
+
+# Encoder telemetry from ffmpeg -progress
+ENCODER_STARTUP_GRACE = _env_float("STREAMBOX_ENCODER_STARTUP_GRACE", 30.0)
+ENCODER_STALL_TIMEOUT = _env_float("STREAMBOX_ENCODER_STALL_TIMEOUT", 10.0)
+
+# Stream copy of single sources that already meet the output constraints
+PASSTHROUGH_ENABLED = _env_bool("STREAMBOX_PASSTHROUGH_ENABLED", True)
+# Runtime after which the measured bitrate of a passthrough stream is checked against the ceiling
+PASSTHROUGH_VERIFY_TIME = _env_float("STREAMBOX_PASSTHROUGH_VERIFY_TIME", 20.0)
+
+# Shared ingest: one RTSP session per source URL, relayed locally to every stream using it
+INGEST_SHARED = _env_bool("STREAMBOX_INGEST_SHARED", False)
+# Seconds a relay outlives its last consumer, so restarting streams keep the camera session
+INGEST_IDLE_LINGER = _env_float("STREAMBOX_INGEST_IDLE_LINGER", 15.0)
+INGEST_CLIENT_QUEUE_CHUNKS = _env_int("STREAMBOX_INGEST_CLIENT_QUEUE_CHUNKS", 64)
+
+# Grouped execution: streams sharing a source are encoded by one ffmpeg with several outputs
+GROUPED_EXECUTION = _env_bool("STREAMBOX_GROUPED_EXECUTION", False)
+GROUP_MAX_STREAMS = _env_int("STREAMBOX_GROUP_MAX_STREAMS", 4)
+# Seconds to wait for more members before a group's ffmpeg is restarted
+GROUP_JOIN_DELAY = _env_float("STREAMBOX_GROUP_JOIN_DELAY", 2.0)
+
+# Per-process resource accounting of the ffmpeg children
+RESOURCE_SAMPLE_INTERVAL = _env_float("STREAMBOX_RESOURCE_SAMPLE_INTERVAL", 5.0)
+# Placement of encoders on the cores not reserved for the gateway and the system
+ENCODER_PLACEMENT = _env_bool("STREAMBOX_ENCODER_PLACEMENT", False)
+ENCODER_RESERVED_CPUS = _env_int_list("STREAMBOX_ENCODER_RESERVED_CPUS", [0])
+ENCODER_NICE = _env_int("STREAMBOX_ENCODER_NICE", 5)
+# cgroup v2 directory encoders are moved into, e.g. to cap their CPU share, empty to skip
+ENCODER_CGROUP = os.environ.get("STREAMBOX_ENCODER_CGROUP", "").strip()
+# Estimated CPU percent of an encoder before it has been measured
+ENCODER_PLACEMENT_DEFAULT_COST = _env_float("STREAMBOX_ENCODER_PLACEMENT_DEFAULT_COST", 50.0)
+ENCODER_PLACEMENT_REBALANCE_INTERVAL = _env_float("STREAMBOX_ENCODER_PLACEMENT_REBALANCE_INTERVAL", 300.0)
+
+# Load governor stepping low-priority streams down a quality ladder under sustained overload
+QOS_ENABLED = _env_bool("STREAMBOX_QOS_ENABLED", False)
+# Window of the CPU average, in seconds
+QOS_WINDOW = _env_float("STREAMBOX_QOS_WINDOW", 30.0)
+QOS_CPU_HIGH = _env_float("STREAMBOX_QOS_CPU_HIGH", 90.0)
+QOS_CPU_LOW = _env_float("STREAMBOX_QOS_CPU_LOW", 70.0)
+# Encoders processing slower than real time are falling behind
+QOS_MIN_SPEED = _env_float("STREAMBOX_QOS_MIN_SPEED", 0.9)
+# Share of the CPU usage or upload bitrate that must come from the gateway's ffmpeg processes
+# for an overload to be blamed on the streams
+QOS_MIN_ENCODER_SHARE = _env_float("STREAMBOX_QOS_MIN_ENCODER_SHARE", 0.5)
+# Overload or headroom must last this long before a stream is stepped down or up
+QOS_OVERLOAD_SUSTAIN = _env_float("STREAMBOX_QOS_OVERLOAD_SUSTAIN", 30.0)
+QOS_HEADROOM_SUSTAIN = _env_float("STREAMBOX_QOS_HEADROOM_SUSTAIN", 120.0)
+# Minimum time between two steps
+QOS_STEP_INTERVAL = _env_float("STREAMBOX_QOS_STEP_INTERVAL", 30.0)
+QOS_FPS_FACTOR = _env_float("STREAMBOX_QOS_FPS_FACTOR", 0.5)
+QOS_RESOLUTION_FACTOR = _env_float("STREAMBOX_QOS_RESOLUTION_FACTOR", 0.5)
+
+# Local Prometheus metrics endpoint, bound to localhost unless configured otherwise
+METRICS_ENABLED = _env_bool("STREAMBOX_METRICS_ENABLED", False)
+METRICS_HOST = os.environ.get("STREAMBOX_METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = _env_int("STREAMBOX_METRICS_PORT", 9108)
+
+# Timing spans of gateway hot paths, reported in the heartbeat
+TRACE_WINDOW = _env_int("STREAMBOX_TRACE_WINDOW", 256)
+LOOP_LAG_INTERVAL = _env_float("STREAMBOX_LOOP_LAG_INTERVAL", 0.5)
+# Stack sampling of the event loop thread, started by SIGUSR1 or by a loop lag above the threshold
+PROFILE_DIR = os.environ.get("STREAMBOX_PROFILE_DIR", "/tmp").strip()
+PROFILE_DURATION = _env_float("STREAMBOX_PROFILE_DURATION", 10.0)
+PROFILE_SAMPLE_INTERVAL = _env_float("STREAMBOX_PROFILE_SAMPLE_INTERVAL", 0.005)
+# Seconds of loop lag that start a profile, 0 to only profile on SIGUSR1
+PROFILE_LAG_THRESHOLD = _env_float("STREAMBOX_PROFILE_LAG_THRESHOLD", 0.0)
+PROFILE_COOLDOWN = _env_float("STREAMBOX_PROFILE_COOLDOWN", 600.0)
+
+# Reduced decoding of sources whose frame rate is far above the output fps
+LOW_RATE_DECODE_ENABLED = _env_bool("STREAMBOX_LOW_RATE_DECODE_ENABLED", True)
+# Source fps must be at least this multiple of the output fps
+LOW_RATE_FPS_RATIO = _env_float("STREAMBOX_LOW_RATE_FPS_RATIO", 4.0)
+# Keyframes only are decoded when one arrives at least every this many output frames
+KEYFRAME_ONLY_MAX_GOP_FRAMES = _env_float("STREAMBOX_KEYFRAME_ONLY_MAX_GOP_FRAMES", 2.0)
+
+# Adaptive bitrate control
+BITRATE_CONTROL_ENABLED = _env_bool("STREAMBOX_BITRATE_CONTROL_ENABLED", True)
+# Share of the estimated uplink capacity that streams may use
+BITRATE_BUDGET_UTILIZATION = _env_float("STREAMBOX_BITRATE_BUDGET_UTILIZATION", 0.8)
+BITRATE_MIN = _env_int("STREAMBOX_BITRATE_MIN", 100_000)
+BITRATE_MIN_FPS = _env_float("STREAMBOX_BITRATE_MIN_FPS", 1.0)
+# Relative change below which a new target is ignored
+BITRATE_HYSTERESIS = _env_float("STREAMBOX_BITRATE_HYSTERESIS", 0.15)
+# Minimum time a target is held before it may be lowered or raised again
+BITRATE_DECREASE_HOLD = _env_float("STREAMBOX_BITRATE_DECREASE_HOLD", 30.0)
+BITRATE_INCREASE_HOLD = _env_float("STREAMBOX_BITRATE_INCREASE_HOLD", 300.0)
+# At most one stream is restarted with a new target per interval
+BITRATE_RESTART_INTERVAL = _env_float("STREAMBOX_BITRATE_RESTART_INTERVAL", 20.0)
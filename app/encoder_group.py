@@ -0,0 +1,389 @@
+import asyncio
+import re
+
+from .config import (
+    ENCODER_STALL_TIMEOUT,
+    ENCODER_STARTUP_GRACE,
+    FFMPEG_CRASH_TAIL_LINES,
+    FFMPEG_STOP_TIMEOUT,
+    GROUP_JOIN_DELAY,
+)
+from .ffmpeg_output import OutputBuffer, drain_stream
+from .ffmpeg_progress import EncoderTelemetry
+from .layout import build_mosaic_filter
+from .logs import logger
+from .stream_handler import (
+    DECODE_KEYFRAMES,
+    MODE_MOSAIC,
+    MODE_PASSTHROUGH,
+    MODE_TRANSCODE,
+    STATE_CRASH_LOOPING,
+    StreamHandler,
+    decode_input_args,
+)
+from .tracing import get_tracer
+
+OUTPUT_FILE_PATTERN = re.compile(r"output file #(\d+)")
+TEE_SLAVE_PATTERN = re.compile(r"Slave muxer #(\d+) failed")
+
+
+def plan_groups(stream_sources: dict[str, list[str]], max_size: int) -> list[list[str]]:
+    """Splits stream ids into groups that share at least one source, of at most `max_size` streams each."""
+    stream_ids = sorted(stream_sources)
+    parent = {stream_id: stream_id for stream_id in stream_ids}
+
+    def find(stream_id: str) -> str:
+        while parent[stream_id] != stream_id:
+            parent[stream_id] = parent[parent[stream_id]]
+            stream_id = parent[stream_id]
+        return stream_id
+
+    first_consumer: dict[str, str] = {}
+    for stream_id in stream_ids:
+        for url in stream_sources[stream_id]:
+            if url in first_consumer:
+                parent[find(stream_id)] = find(first_consumer[url])
+            else:
+                first_consumer[url] = stream_id
+
+    components: dict[str, list[str]] = {}
+    for stream_id in stream_ids:
+        components.setdefault(find(stream_id), []).append(stream_id)
+    groups = []
+    for members in components.values():
+        for first in range(0, len(members), max_size):
+            chunk = members[first:first + max_size]
+            if len(chunk) > 1:
+                groups.append(chunk)
+    return groups
+
+
+class EncoderGroup:
+    """
+    One ffmpeg process producing the outputs of several streams that share sources.
+    - Each shared input is demuxed and decoded once and split between the streams using it
+    - Streams with identical encodes are encoded once and sent to every URL through `tee`
+    - Members join and leave through their handler's start() and stop(), the process is
+      restarted with the current members after `GROUP_JOIN_DELAY`
+    - Errors naming a member's output or source are attributed to that member only. It is
+      evicted and restarts in its own ffmpeg with its own backoff, the others keep running
+    - Any other failure of the shared process is a group restart: every member records the
+      crash with reason "group" and they restart together after the longest backoff
+    """
+
+    def __init__(self, group_id: str):
+        self.id: str = group_id
+        self.process: asyncio.subprocess.Process | None = None
+        self.ready: dict[str, StreamHandler] = {}
+        self.running: list[StreamHandler] = []
+        self.restart_count: int = 0
+        self.stderr_buffer: OutputBuffer = OutputBuffer()
+        self.telemetry: EncoderTelemetry = EncoderTelemetry()
+        # Members per output file, in output order
+        self._outputs: list[list[StreamHandler]] = []
+        self._failed: set[str] = set()
+        self._abort_reason: str | None = None
+        self._supervisor_task: asyncio.Task | None = None
+        self._spawn_task: asyncio.Task | None = None
+        self._spawn_pending: bool = False
+
+    def join(self, handler: StreamHandler):
+        self.ready[handler.id] = handler
+        self._schedule_spawn()
+
+    def leave(self, handler: StreamHandler):
+        if self.ready.pop(handler.id, None) is not None:
+            self._schedule_spawn()
+
+    def evict(self, member: StreamHandler):
+        """
+        Moves an unhealthy member out of the group to restart on its own. Its output is still
+        written, so the group's ffmpeg is restarted once without it.
+        """
+        member.record_exit_error(f"Removed from encoder group {self.id}")
+        self._evict(member, "aborted")
+        self._schedule_spawn()
+
+    def abort(self, reason: str):
+        """Terminates the shared ffmpeg when the whole group is unhealthy, every member restarts with it."""
+        if self.process and self.process.returncode is None:
+            self._abort_reason = reason
+            self.process.terminate()
+
+    def is_stalled(self) -> bool:
+        return (
+            self.process is not None
+            and self.process.returncode is None
+            and self.telemetry.is_stalled(ENCODER_STARTUP_GRACE, ENCODER_STALL_TIMEOUT)
+        )
+
+    async def close(self):
+        self.ready.clear()
+        if self._spawn_task:
+            self._spawn_task.cancel()
+        await self._terminate()
+
+    def _schedule_spawn(self):
+        self._spawn_pending = True
+        if self._spawn_task is None or self._spawn_task.done():
+            self._spawn_task = asyncio.create_task(self._spawn_loop())
+
+    async def _spawn_loop(self):
+        while self._spawn_pending:
+            await asyncio.sleep(GROUP_JOIN_DELAY)
+            self._spawn_pending = False
+            await self._spawn()
+
+    async def _spawn(self):
+        await self._terminate()
+        members = sorted(self.ready.values(), key=lambda handler: handler.id)
+        if not members:
+            return
+
+        logger.info(f"Starting encoder group {self.id} with streams: {[member.id for member in members]}")
+        try:
+            with get_tracer().span("ffmpeg_spawn"):
+                process = await asyncio.create_subprocess_exec(
+                    *self.build_ffmpeg_cmd(members),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+        except OSError as e:
+            logger.error(f"Failed to start ffmpeg for encoder group {self.id}: {e}")
+            for member in members:
+                member.errors.add("ffmpeg_start", f"Failed to start ffmpeg: {e}")
+            self._fail(members)
+            return
+
+        self.process = process
+        self.running = members
+        self.telemetry = EncoderTelemetry()
+        self.stderr_buffer.clear()
+        self._failed.clear()
+        self._abort_reason = None
+        for member in members:
+            member.attach_process(process)
+        self._supervisor_task = asyncio.create_task(self._supervise(process))
+
+    async def _terminate(self):
+        task, self._supervisor_task = self._supervisor_task, None
+        if task and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+        process, self.process = self.process, None
+        for member in self.running:
+            if member.ffmpeg_process is process:
+                member.ffmpeg_process = None
+        self.running = []
+        if process and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), FFMPEG_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Encoder group {self.id} ffmpeg did not exit after terminate, killing it")
+                process.kill()
+
+    async def _supervise(self, process: asyncio.subprocess.Process):
+        return_code, _, _ = await asyncio.gather(
+            process.wait(),
+            drain_stream(process.stderr, self._on_stderr),
+            drain_stream(process.stdout, self._on_progress),
+        )
+        if process is not self.process:
+            return
+        self.process = None
+        self.restart_count += 1
+
+        running = [member for member in self.running if member.ffmpeg_process is process]
+        self.running = []
+        crash_error = self.stderr_buffer.tail(FFMPEG_CRASH_TAIL_LINES) or "ffmpeg command failed"
+        crash_error += f" | Frames: {self.telemetry.frame} | Return Code: {return_code}"
+        for member in running:
+            member.ffmpeg_process = None
+            member.exit_code = return_code
+        guilty = [member for member in running if member.id in self._failed]
+        if guilty and len(guilty) < len(running):
+            # Failures of these members ended the process, the others restart without them
+            for member in guilty:
+                member.record_exit_error(crash_error)
+                self._evict(member, "exit")
+        elif guilty or not self._failed:
+            # Every member failed or no error named one, e.g. a shared source: the whole group failed
+            for member in running:
+                if self._abort_reason:
+                    member.errors.add("aborted", f"{self._abort_reason} | {crash_error}")
+                else:
+                    member.record_exit_error(crash_error)
+            self._fail(running)
+        if any(member.id in self.ready for member in running):
+            self._schedule_spawn()
+
+    def _fail(self, members: list[StreamHandler]):
+        """Restarts the group once the backoff of its members is over, after a failure of the shared process."""
+        delays = {member.id: member.record_crash() for member in members}
+        # Members failing together restart together, so the group restarts once
+        shared_delay = max(
+            (delays[member.id] for member in members if member.state != STATE_CRASH_LOOPING),
+            default=0,
+        )
+        for member in members:
+            self.ready.pop(member.id, None)
+            member.last_crash_reason = "group"
+            delay = delays[member.id] if member.state == STATE_CRASH_LOOPING else shared_delay
+            member.schedule_restart(delay)
+
+    def _evict(self, member: StreamHandler, crash_reason: str):
+        """Removes a failed member for good, it restarts in its own ffmpeg with its own backoff."""
+        self.ready.pop(member.id, None)
+        if member in self.running:
+            self.running.remove(member)
+        member.ffmpeg_process = None
+        member.group = None
+        member.solo = True
+        member.last_crash_reason = crash_reason
+        logger.warning(
+            f"Encoder group {self.id}: stream {member.id} failed, moving it to its own ffmpeg",
+            extra=member.log_extra,
+        )
+        member.schedule_restart(member.record_crash())
+
+    def _on_stderr(self, line: str):
+        self.stderr_buffer.append(line)
+        members = self._attribute(line)
+        for member in members or self.running:
+            member.stderr_buffer.append(line)
+        self._failed.update(member.id for member in members)
+        healthy = [member for member in self.running if member.id not in self._failed]
+        if members and healthy and self.process:
+            # A member's output or source failed while the others keep running
+            for member in members:
+                member.errors.add("ffmpeg_output", line)
+                self._evict(member, "exit")
+
+    def _attribute(self, line: str) -> list[StreamHandler]:
+        """Members an ffmpeg error line is about, [] when it concerns the whole process."""
+        by_url = [
+            member for member in self.running
+            if member.stream_url in line
+            or any(url in line or member.input_urls.get(url, url) in line for url in member.active_source_urls())
+        ]
+        if by_url:
+            return by_url
+        match = OUTPUT_FILE_PATTERN.search(line)
+        if match and int(match.group(1)) < len(self._outputs):
+            return [member for member in self._outputs[int(match.group(1))] if member in self.running]
+        match = TEE_SLAVE_PATTERN.search(line)
+        tee_outputs = [members for members in self._outputs if len(members) > 1]
+        if match and len(tee_outputs) == 1 and int(match.group(1)) < len(tee_outputs[0]):
+            member = tee_outputs[0][int(match.group(1))]
+            return [member] if member in self.running else []
+        return []
+
+    def _on_progress(self, line: str):
+        self.telemetry.feed_line(line)
+        for member in self.running:
+            member.telemetry.feed_line(line)
+        if line.startswith("progress=") and self.telemetry.bitrate_bps is not None:
+            # ffmpeg reports the size of all outputs, it is shared by nominal bitrate
+            weights = {member.id: self._nominal_bitrate(member) for member in self.running}
+            total = sum(weights.values()) or 1
+            for member in self.running:
+                member.telemetry.bitrate_bps = self.telemetry.bitrate_bps * weights[member.id] / total
+
+    @staticmethod
+    def _nominal_bitrate(member: StreamHandler) -> float:
+        if member.mode == MODE_PASSTHROUGH:
+            source_info = member.source_info.get(member.active_source_urls()[0], {})
+            try:
+                return int(source_info.get("bit_rate"))
+            except (TypeError, ValueError):
+                return member.encoder_profiles[MODE_TRANSCODE].max_bitrate
+        return member.get_encoder_profile().bitrate
+
+    def build_ffmpeg_cmd(self, members: list[StreamHandler]) -> list[str]:
+        inputs: list[str] = []
+        input_owner: dict[str, StreamHandler] = {}
+        for member in members:
+            member.update_decode_modes(member.get_encoder_profile())
+            for url in member.active_source_urls():
+                if url not in input_owner:
+                    input_owner[url] = member
+                    inputs.append(url)
+
+        # Members with identical encodes share one output through tee
+        outputs: dict[tuple, list[StreamHandler]] = {}
+        for member in members:
+            key = (
+                member.mode,
+                tuple(member.active_source_urls()),
+                member.get_encoder_profile() if member.is_transcoding() else None,
+                member.mosaic_layout() if member.mode == MODE_MOSAIC else None,
+            )
+            outputs.setdefault(key, []).append(member)
+        self._outputs = list(outputs.values())
+
+        ffmpeg_cmd = ["ffmpeg", "-nostats", "-progress", "pipe:1", "-loglevel", "error"]
+        filter_consumers: dict[str, int] = {url: 0 for url in inputs}
+        for output in self._outputs:
+            if output[0].is_transcoding():
+                for url in output[0].active_source_urls():
+                    filter_consumers[url] += 1
+        for url in inputs:
+            # Keyframe-only decoding is shared, so it is used only if every consumer chose it
+            keyframes_only = all(
+                member.decode_modes.get(url) == DECODE_KEYFRAMES
+                for member in members if url in member.active_source_urls() and member.is_transcoding()
+            ) and filter_consumers[url] > 0
+            ffmpeg_cmd.extend([
+                "-fflags", "+genpts",
+                "-thread_queue_size", "4096",
+                *(decode_input_args(DECODE_KEYFRAMES) if keyframes_only else []),
+                *input_owner[url].input_args(url),
+            ])
+
+        filters = []
+        pads: dict[str, list[str]] = {}
+        for index, url in enumerate(inputs):
+            count = filter_consumers[url]
+            if count > 1:
+                pads[url] = [f"i{index}s{copy}" for copy in range(count)]
+                filters.append(f"[{index}:v]split={count}" + "".join(f"[{pad}]" for pad in pads[url]))
+            else:
+                pads[url] = [f"{index}:v"]
+
+        output_args = []
+        for index, output in enumerate(self._outputs):
+            member = output[0]
+            profile = member.get_encoder_profile()
+            if member.mode == MODE_PASSTHROUGH:
+                stream_args = ["-map", f"{inputs.index(member.active_source_urls()[0])}:v:0", "-c:v", "copy"]
+            elif member.mode == MODE_MOSAIC:
+                filters.append(build_mosaic_filter(
+                    [pads[url].pop() for url in member.active_source_urls()],
+                    member.mosaic_layout(), profile.width, profile.height, profile.fps,
+                    output=f"o{index}", prefix=f"o{index}",
+                ))
+                stream_args = ["-map", f"[o{index}]", "-pix_fmt", "yuv420p", *profile.encoder_args()]
+            else:
+                pad = pads[member.active_source_urls()[0]].pop()
+                filters.append(f"[{pad}]{member.transcode_filter(profile)}[o{index}]")
+                stream_args = ["-map", f"[o{index}]", *profile.encoder_args()]
+
+            if len(output) == 1:
+                output_args.extend([*stream_args, "-an", "-f", "rtsp", member.stream_url])
+            else:
+                slaves = "|".join(f"[f=rtsp:onfail=ignore]{slave.stream_url}" for slave in output)
+                output_args.extend([*stream_args, "-an", "-flags", "+global_header", "-f", "tee", slaves])
+
+        if filters:
+            ffmpeg_cmd.extend(["-filter_complex", ";".join(filters)])
+        ffmpeg_cmd.extend(output_args)
+        return ffmpeg_cmd
+
+    def get_stats(self) -> dict:
+        return {
+            "streams": sorted(self.ready),
+            "running": [member.id for member in self.running],
+            "outputs": len(self._outputs),
+            "restart_count": self.restart_count,
+            "encoder": self.telemetry.get_stats() if self.process else None,
+        }
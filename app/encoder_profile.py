@@ -0,0 +1,200 @@
+import dataclasses
+import re
+from dataclasses import dataclass
+from typing import Any
+
+RATE_CONTROLS = ("vbr", "cbr", "crf")
+X264_PRESETS = (
+    "ultrafast", "superfast", "veryfast", "faster", "fast",
+    "medium", "slow", "slower", "veryslow",
+)
+X264_TUNES = ("zerolatency", "fastdecode", "film", "animation", "grain", "stillimage")
+
+
+def parse_bitrate(value: Any) -> int:
+    """Parses bits/s given as an int or as a string such as "500k" or "2M"."""
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid bitrate: {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmM]?)\s*", str(value))
+    if not match:
+        raise ValueError(f"Invalid bitrate: {value!r}")
+    multiplier = {"": 1, "k": 1_000, "m": 1_000_000}[match.group(2).lower()]
+    return int(float(match.group(1)) * multiplier)
+
+
+def format_bitrate(bits_per_second: int) -> str:
+    if bits_per_second % 1000 == 0:
+        return f"{bits_per_second // 1000}k"
+    return str(bits_per_second)
+
+
+# Accepted value types per profile field, None is allowed for all but REQUIRED_FIELDS
+FIELD_TYPES: dict[str, type | tuple[type, ...]] = {
+    "width": int,
+    "height": int,
+    "fps": (int, float),
+    "rate_control": str,
+    "bitrate": int,
+    "maxrate": int,
+    "bufsize": int,
+    "crf": int,
+    "preset": str,
+    "tune": str,
+    "gop": int,
+    "keyframe_interval": (int, float),
+    "keyint_min": int,
+}
+REQUIRED_FIELDS = ("width", "height", "fps", "rate_control", "bitrate", "preset")
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    width: int
+    height: int
+    fps: float
+    rate_control: str = "vbr"
+    # Bits/s. maxrate and bufsize apply to vbr and cap crf
+    bitrate: int = 500_000
+    maxrate: int | None = 600_000
+    bufsize: int | None = 1_000_000
+    crf: int | None = None
+    preset: str = "veryfast"
+    tune: str | None = "zerolatency"
+    # Keyframe spacing in frames, or in seconds when gop is not set
+    gop: int | None = None
+    keyframe_interval: float | None = None
+    keyint_min: int | None = None
+
+    @property
+    def max_bitrate(self) -> int:
+        return self.maxrate or self.bitrate
+
+    @property
+    def gop_frames(self) -> int | None:
+        if self.gop:
+            return self.gop
+        if self.keyframe_interval:
+            return max(1, round(self.fps * self.keyframe_interval))
+        return None
+
+    def validate(self):
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            expected = FIELD_TYPES[field.name]
+            if value is None and field.name not in REQUIRED_FIELDS:
+                continue
+            if isinstance(value, bool) or not isinstance(value, expected):
+                raise ValueError(f"Invalid {field.name} {value!r}")
+        if not (0 < self.width <= 4096 and 0 < self.height <= 4096):
+            raise ValueError(f"Invalid resolution {self.width}x{self.height}")
+        if self.width % 2 or self.height % 2:
+            raise ValueError(f"Resolution {self.width}x{self.height} must be even")
+        if not 0 < self.fps <= 60:
+            raise ValueError(f"Invalid fps {self.fps}")
+        if self.rate_control not in RATE_CONTROLS:
+            raise ValueError(f"Invalid rate_control {self.rate_control!r}, expected one of {RATE_CONTROLS}")
+        if self.bitrate <= 0:
+            raise ValueError(f"Invalid bitrate {self.bitrate}")
+        if self.maxrate is not None and self.maxrate < self.bitrate:
+            raise ValueError(f"maxrate {self.maxrate} is below bitrate {self.bitrate}")
+        if self.bufsize is not None and self.bufsize <= 0:
+            raise ValueError(f"Invalid bufsize {self.bufsize}")
+        if self.rate_control == "crf" and (self.crf is None or not 0 <= self.crf <= 51):
+            raise ValueError(f"crf rate control needs a crf between 0 and 51, got {self.crf}")
+        if self.preset not in X264_PRESETS:
+            raise ValueError(f"Invalid preset {self.preset!r}")
+        if self.tune is not None and self.tune not in X264_TUNES:
+            raise ValueError(f"Invalid tune {self.tune!r}")
+        if self.gop is not None and self.gop < 1:
+            raise ValueError(f"Invalid gop {self.gop}")
+        if self.keyframe_interval is not None and self.keyframe_interval <= 0:
+            raise ValueError(f"Invalid keyframe_interval {self.keyframe_interval}")
+        if self.keyint_min is not None and (self.keyint_min < 1 or (self.gop_frames and self.keyint_min > self.gop_frames)):
+            raise ValueError(f"Invalid keyint_min {self.keyint_min}")
+
+    def encoder_args(self) -> list[str]:
+        """libx264 output options for this profile."""
+        args = ["-c:v", "libx264", "-r", f"{self.fps:g}", "-preset", self.preset]
+        if self.tune:
+            args.extend(["-tune", self.tune])
+
+        if self.rate_control == "crf":
+            args.extend(["-crf", str(self.crf)])
+            if self.maxrate:
+                args.extend(["-maxrate", format_bitrate(self.maxrate)])
+        elif self.rate_control == "cbr":
+            bitrate = format_bitrate(self.bitrate)
+            args.extend(["-b:v", bitrate, "-minrate", bitrate, "-maxrate", bitrate])
+        else:
+            args.extend(["-b:v", format_bitrate(self.bitrate)])
+            if self.maxrate:
+                args.extend(["-maxrate", format_bitrate(self.maxrate)])
+        if self.maxrate or self.rate_control == "cbr":
+            args.extend(["-bufsize", format_bitrate(self.bufsize or 2 * self.max_bitrate)])
+
+        if self.gop_frames:
+            args.extend(["-g", str(self.gop_frames)])
+        if self.keyint_min:
+            args.extend(["-keyint_min", str(self.keyint_min)])
+        return args
+
+
+ENCODER_PRESETS: dict[str, EncoderProfile] = {
+    # Single camera relays
+    "single": EncoderProfile(width=1280, height=720, fps=2, preset="veryfast"),
+    # 2x2 and larger grids
+    "mosaic": EncoderProfile(width=1920, height=1080, fps=15, preset="ultrafast"),
+    "low_cpu": EncoderProfile(
+        width=960, height=540, fps=2, bitrate=300_000, maxrate=400_000, bufsize=600_000, preset="ultrafast",
+    ),
+    "high_quality": EncoderProfile(
+        width=1920, height=1080, fps=15, bitrate=1_500_000, maxrate=2_000_000, bufsize=3_000_000,
+        preset="faster", keyframe_interval=2,
+    ),
+}
+
+BITRATE_FIELDS = ("bitrate", "maxrate", "bufsize")
+PROFILE_FIELDS = {field.name for field in dataclasses.fields(EncoderProfile)}
+
+
+def resolve_encoder_profile(spec: str | dict | None, default_preset: str) -> EncoderProfile:
+    """
+    Builds a validated profile from a backend `encoder_profile` value:
+    - None: the `default_preset`
+    - "name": a named preset
+    - {"profile": "name", <field>: <value>, ...}: a preset with per-stream overrides,
+      based on `default_preset` when no preset is named. "preset" overrides the x264 preset
+    Raises ValueError for unknown presets, unknown fields or invalid values.
+    """
+    if spec is None:
+        spec = {}
+    elif isinstance(spec, str):
+        spec = {"profile": spec}
+    elif not isinstance(spec, dict):
+        raise ValueError(f"Invalid encoder profile: {spec!r}")
+
+    overrides = dict(spec)
+    preset_name = overrides.pop("profile", None) or default_preset
+    if preset_name not in ENCODER_PRESETS:
+        raise ValueError(f"Unknown encoder profile {preset_name!r}")
+    unknown_fields = set(overrides) - PROFILE_FIELDS
+    if unknown_fields:
+        raise ValueError(f"Unknown encoder profile fields: {sorted(unknown_fields)}")
+
+    for name in BITRATE_FIELDS:
+        if overrides.get(name) is not None:
+            overrides[name] = parse_bitrate(overrides[name])
+    base = ENCODER_PRESETS[preset_name]
+    # A bitrate override keeps the preset's maxrate and bufsize ratios unless those are overridden too
+    if isinstance(overrides.get("bitrate"), int) and overrides["bitrate"] > 0:
+        for name in ("maxrate", "bufsize"):
+            if name not in overrides and getattr(base, name):
+                overrides[name] = round(getattr(base, name) * overrides["bitrate"] / base.bitrate)
+    try:
+        profile = dataclasses.replace(base, **overrides)
+    except TypeError as e:
+        raise ValueError(f"Invalid encoder profile: {e}") from e
+    profile.validate()
+    return profile
@@ -0,0 +1,82 @@
+import re
+import time
+from dataclasses import dataclass
+
+from .config import ERROR_DETAIL_MAX_CHARS, ERROR_STORE_MAX_ENTRIES
+
+# Numbers vary between repeats of the same error (frame counts, timestamps, PIDs)
+_NUMBER_PATTERN = re.compile(r"\d+(\.\d+)?")
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+def error_signature(kind: str, detail: str) -> tuple[str, str]:
+    return kind, _SPACE_PATTERN.sub(" ", _NUMBER_PATTERN.sub("#", detail)).strip()
+
+
+@dataclass
+class ErrorEntry:
+    kind: str
+    # Latest occurrence, truncated
+    detail: str
+    first_seen: float
+    last_seen: float
+    count: int = 1
+    # Count when the entry was last reported, 0 when it never was
+    reported_count: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "detail": self.detail,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "count": self.count,
+        }
+
+
+class ErrorStore:
+    """
+    Bounded record of a stream's errors.
+    - Errors with the same kind and detail, numbers aside, are one entry with a count
+    - At most `max_entries` entries are kept, the least recently seen is evicted
+    - `get_changed` returns only the entries that are new or recurred since they were last
+      acknowledged, entries stay changed until the backend received them
+    """
+
+    def __init__(self, max_entries: int = ERROR_STORE_MAX_ENTRIES, max_detail: int = ERROR_DETAIL_MAX_CHARS):
+        self.max_entries: int = max_entries
+        self.max_detail: int = max_detail
+        self.entries: dict[tuple[str, str], ErrorEntry] = {}
+
+    def add(self, kind: str, detail: str, count: int = 1) -> ErrorEntry:
+        now = time.time()
+        if len(detail) > self.max_detail:
+            detail = detail[:self.max_detail] + "..."
+        signature = error_signature(kind, detail)
+        entry = self.entries.pop(signature, None)
+        if entry is None:
+            entry = ErrorEntry(kind, detail, first_seen=now, last_seen=now, count=count)
+            while len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        else:
+            entry.detail = detail
+            entry.last_seen = now
+            entry.count += count
+        # Entries are kept in order of last occurrence
+        self.entries[signature] = entry
+        return entry
+
+    def get_changed(self) -> list[ErrorEntry]:
+        return [entry for entry in self.entries.values() if entry.count != entry.reported_count]
+
+    def acknowledge(self, kind: str, detail: str, count: int):
+        """Marks the entry as reported with `count` occurrences, once the report was received."""
+        entry = self.entries.get(error_signature(kind, detail))
+        if entry is not None:
+            entry.reported_count = max(entry.reported_count, count)
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "kinds": sorted({entry.kind for entry in self.entries.values()}),
+        }
@@ -0,0 +1,94 @@
+import asyncio
+import re
+from collections import Counter, deque
+from typing import Callable
+
+from .config import FFMPEG_LOG_MAX_BYTES, FFMPEG_LOG_MAX_LINE_LENGTH, FFMPEG_LOG_MAX_LINES
+
+# Known ffmpeg error patterns, checked in order
+ERROR_PATTERNS: list[tuple[str, re.Pattern]] = [
+    ("unauthorized", re.compile(r"401 Unauthorized|Server returned 401", re.IGNORECASE)),
+    ("not_found", re.compile(r"404 Not Found|Server returned 404", re.IGNORECASE)),
+    ("connection_refused", re.compile(r"Connection refused", re.IGNORECASE)),
+    ("connection_timeout", re.compile(r"Connection timed out|Operation timed out", re.IGNORECASE)),
+    ("connection_reset", re.compile(r"Broken pipe|Connection reset by peer", re.IGNORECASE)),
+    ("host_unreachable", re.compile(r"No route to host|Network is unreachable|Name or service not known", re.IGNORECASE)),
+    ("non_monotonic_dts", re.compile(r"Non-monoton\w* DTS", re.IGNORECASE)),
+    ("invalid_data", re.compile(r"Invalid data found when processing input", re.IGNORECASE)),
+    ("decode_error", re.compile(r"error while decoding|corrupt|concealing \d+ errors", re.IGNORECASE)),
+    ("end_of_file", re.compile(r"End of file", re.IGNORECASE)),
+]
+
+
+def classify_line(line: str) -> str | None:
+    for kind, pattern in ERROR_PATTERNS:
+        if pattern.search(line):
+            return kind
+    return None
+
+
+class OutputBuffer:
+    """
+    Ring buffer of the most recent lines of an ffmpeg pipe.
+    - Holds at most `max_lines` lines and `max_bytes` characters, oldest lines are dropped first
+    - Lines matching a known error pattern are counted per kind as they arrive
+    """
+
+    def __init__(self, max_lines: int = FFMPEG_LOG_MAX_LINES, max_bytes: int = FFMPEG_LOG_MAX_BYTES):
+        self.max_lines: int = max_lines
+        self.max_bytes: int = max_bytes
+        self.dropped_lines: int = 0
+        self._lines: deque[str] = deque()
+        self._size: int = 0
+        # Error counts since the last pop_errors() call, with the latest line per kind
+        self._error_counts: Counter[str] = Counter()
+        self._error_lines: dict[str, str] = {}
+
+    def append(self, line: str):
+        line = line[:FFMPEG_LOG_MAX_LINE_LENGTH]
+        self._lines.append(line)
+        self._size += len(line)
+        while len(self._lines) > self.max_lines or self._size > self.max_bytes:
+            self._size -= len(self._lines.popleft())
+            self.dropped_lines += 1
+
+        kind = classify_line(line)
+        if kind:
+            self._error_counts[kind] += 1
+            self._error_lines[kind] = line
+
+    def tail(self, lines: int | None = None) -> str:
+        selected = list(self._lines)
+        if lines is not None:
+            selected = selected[-lines:]
+        return "\n".join(selected)
+
+    def pop_errors(self) -> list[tuple[str, int, str]]:
+        """Returns (kind, count, latest line) for errors seen since the last call."""
+        errors = [
+            (kind, count, self._error_lines[kind])
+            for kind, count in self._error_counts.most_common()
+        ]
+        self._error_counts.clear()
+        self._error_lines.clear()
+        return errors
+
+    def clear(self):
+        self._lines.clear()
+        self._size = 0
+        self.dropped_lines = 0
+
+
+async def drain_stream(reader: asyncio.StreamReader | None, on_line: Callable[[str], None]):
+    """Reads `reader` line by line into `on_line` until EOF, so the child never blocks on a full pipe."""
+    if reader is None:
+        return
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            # Line longer than the reader limit, the reader has already discarded it
+            continue
+        if not line:
+            return
+        on_line(line.decode(errors="replace").rstrip())
@@ -0,0 +1,99 @@
+import time
+
+
+def _to_float(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return float(value.rstrip("x").replace("kbits/s", "").strip())
+    except ValueError:
+        return None
+
+
+def _to_int(value: str | None) -> int | None:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class EncoderTelemetry:
+    """
+    Parses the key=value blocks that `ffmpeg -progress pipe:1` writes to stdout.
+    Each block ends with a `progress=continue|end` line.
+    """
+
+    def __init__(self):
+        self.frame: int = 0
+        self.fps: float | None = None
+        self.speed: float | None = None
+        self.total_size: int = 0
+        self.out_time_us: int | None = None
+        self.dup_frames: int = 0
+        self.drop_frames: int = 0
+        # Output bitrate over the last progress interval, smoothed
+        self.bitrate_bps: float | None = None
+        self.updates: int = 0
+        self.started_at: float = time.monotonic()
+        self.updated_at: float | None = None
+        self.frame_advanced_at: float | None = None
+        self._block: dict[str, str] = {}
+
+    def feed_line(self, line: str):
+        key, separator, value = line.partition("=")
+        if not separator:
+            return
+        key = key.strip()
+        self._block[key] = value.strip()
+        if key == "progress":
+            self._apply(self._block)
+            self._block = {}
+
+    def _apply(self, block: dict[str, str]):
+        now = time.monotonic()
+        frame = _to_int(block.get("frame"))
+        if frame is not None:
+            if frame > self.frame:
+                self.frame_advanced_at = now
+            self.frame = frame
+
+        total_size = _to_int(block.get("total_size"))
+        if total_size is not None:
+            if self.updated_at is not None and now > self.updated_at:
+                instant_bps = max(total_size - self.total_size, 0) * 8 / (now - self.updated_at)
+                if self.bitrate_bps is None:
+                    self.bitrate_bps = instant_bps
+                else:
+                    self.bitrate_bps = 0.8 * self.bitrate_bps + 0.2 * instant_bps
+            self.total_size = total_size
+
+        self.fps = _to_float(block.get("fps"))
+        self.speed = _to_float(block.get("speed"))
+        self.out_time_us = _to_int(block.get("out_time_us")) or self.out_time_us
+        self.dup_frames = _to_int(block.get("dup_frames")) or self.dup_frames
+        self.drop_frames = _to_int(block.get("drop_frames")) or self.drop_frames
+        self.updates += 1
+        self.updated_at = now
+
+    def is_stalled(self, startup_grace: float, stall_timeout: float) -> bool:
+        """True when no output frame was produced within the grace period, or none since `stall_timeout`."""
+        now = time.monotonic()
+        if self.frame_advanced_at is None:
+            return now - self.started_at > startup_grace
+        return now - self.frame_advanced_at > stall_timeout
+
+    def get_stats(self) -> dict:
+        return {
+            "frame": self.frame,
+            "fps": self.fps,
+            "bitrate_kbps": self.bitrate_bps / 1000 if self.bitrate_bps is not None else None,
+            "speed": self.speed,
+            "total_size": self.total_size,
+            "dup_frames": self.dup_frames,
+            "drop_frames": self.drop_frames,
+            "seconds_since_frame": (
+                time.monotonic() - self.frame_advanced_at if self.frame_advanced_at is not None else None
+            ),
+        }
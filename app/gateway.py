@@ -1,12 +1,38 @@
 import asyncio
+import signal
 import time
 from typing import TYPE_CHECKING
 
-from .interface import get_stream_details
+from .bitrate_controller import BitrateController
+from .capacity import get_capacity_estimator
+from .config import (
+    BITRATE_CONTROL_ENABLED,
+    ENCODER_STALL_TIMEOUT,
+    GROUP_MAX_STREAMS,
+    GROUPED_EXECUTION,
+    INGEST_SHARED,
+    METRICS_ENABLED,
+    QOS_ENABLED,
+    QOS_WINDOW,
+    RESOURCE_SAMPLE_INTERVAL,
+    SPEEDTEST_CALIBRATION,
+)
+from .heartbeat import HeartbeatEncoder
+from .ingest import IngestManager
+from .interface import BackendClient, BackendError, get_stream_details
+from .load_governor import QOS_LEVEL_NAMES, LoadGovernor
 from .logs import logger
+from .metrics import RECONCILE_BUCKETS, Histogram, MetricsServer
+from .network_utils import cache_network_speedtest, get_network_speedtest
+from .probe import RtspProber
+from .reconcile import StreamDiff, diff_streams
+from .resources import ResourceMonitor
+from .system_sampler import get_system_sampler
+from .tracing import get_tracer
 from .utils import check_network_availability, get_device_id
 
 if TYPE_CHECKING:
+    from .encoder_group import EncoderGroup
     from .stream_handler import StreamHandler
 
 
@@ -21,51 +47,137 @@ class GatewayService:
 
     def __init__(self, stop_event):
         self.exit_code: int = 0
+        self.started_timestamp: float = time.time()
         self.last_online: float = time.time()
-        self.stream_handlers: list["StreamHandler"] = []
+        self.stream_handlers: dict[str, "StreamHandler"] = {}
+        self.ingest: IngestManager | None = IngestManager() if INGEST_SHARED else None
+        self.prober: RtspProber = RtspProber(ingest=self.ingest)
+        self.encoder_groups: dict[str, "EncoderGroup"] = {}
+        self.resources: ResourceMonitor = ResourceMonitor()
+        self.last_resource_sample_timestamp: float = 0.0
+        self.backend: BackendClient = BackendClient()
+        self.heartbeat: HeartbeatEncoder = HeartbeatEncoder()
+        self.bitrate_controller: BitrateController = BitrateController()
+        self.load_governor: LoadGovernor = LoadGovernor()
+        self.config_version: str | None = None
+        self.reconcile_duration: Histogram = Histogram(RECONCILE_BUCKETS)
+        self.metrics_server: MetricsServer | None = MetricsServer(self) if METRICS_ENABLED else None
         self.stop_event: asyncio.Event = stop_event
         self.last_monitor_timestamp: float = time.time()
         self.stream_fetch_timestamp: float = time.time()
+        # Stream info poll running alongside the supervision loop
+        self._poll_task: asyncio.Task | None = None
         self._is_service_start: bool = True
-        self._stream_handlers_state_changed: bool = False
+        # Handler state changes, and how many of them the backend acknowledged or is being sent
+        self._state_changes: int = 0
+        self._reported_state_changes: int = 0
+        self._pending_state_changes: int = 0
 
-    async def load_streams(self):
-        stream_details = await get_stream_details(self)
-        streams = stream_details.get("streams", [])
-        return [stream for stream in streams if stream["status"] == "active"]
+    async def load_stream_details(self):
+        """Returns the stream info response, or None when the backend could not provide it."""
+        try:
+            return await get_stream_details(self)
+        except BackendError as e:
+            logger.warning(f"Failed to load streams, keeping current handlers: {e}")
+            return None
 
     async def update_stream_handlers(self):
+        stream_details = await self.load_stream_details()
+        if stream_details is None:
+            self.stream_fetch_timestamp = time.time()
+            return
+        started = time.monotonic()
+        try:
+            with get_tracer().span("reconcile"):
+                await self.reconcile(stream_details)
+        finally:
+            self.reconcile_duration.observe(time.monotonic() - started)
+        self.stream_fetch_timestamp = time.time()
+
+    async def reconcile(self, stream_details: dict):
+        if stream_details.get("not_modified"):
+            # Config is unchanged, only refresh runtime fields
+            last_frame_timestamps = stream_details.get("last_frame_timestamps") or {}
+            for handler in self.stream_handlers.values():
+                if handler.id in last_frame_timestamps:
+                    handler.set_last_frame_timestamp(last_frame_timestamps[handler.id])
+            # Streams without a valid source still need their sources re-checked
+            await asyncio.gather(*(
+                handler.start()
+                for handler in self.stream_handlers.values()
+                if not handler.valid_source_urls
+            ))
+            return
+
+        streams = [stream for stream in stream_details["streams"] if stream["status"] == "active"]
+        diff = diff_streams(self.stream_handlers, streams)
+        await self.apply_stream_diff(diff)
+
+    async def apply_stream_diff(self, diff: StreamDiff):
         from .stream_handler import StreamHandler
 
-        streams = await self.load_streams()
-        for stream in streams:
-            existing_handler = next(
-                (
-                    handler
-                    for handler in self.stream_handlers
-                    if handler.id == stream["stream_id"]
-                ),
-                None,
-            )
-            if existing_handler:
-                existing_handler.update(stream)
-            else:
-                stream_handler = StreamHandler(self, stream)
-                self.stream_handlers.append(stream_handler)
-                stream_handler.start()
-                self._stream_handlers_state_changed = True
-
-        active_stream_ids = [stream["stream_id"] for stream in streams]
-        inactive_stream_ids = [
-            handler.id
-            for handler in self.stream_handlers
-            if handler.id not in active_stream_ids
-        ]
-        for handler in self.stream_handlers:
-            if handler.id in inactive_stream_ids:
+        for stream_id in diff.removed:
+            self.stream_handlers.pop(stream_id).stop()
+
+        added_handlers = [StreamHandler(self, stream) for stream in diff.added]
+        for handler in added_handlers:
+            self.stream_handlers[handler.id] = handler
+        regrouped = await self.assign_encoder_groups(diff)
+
+        # Handlers probe their sources concurrently through the shared prober
+        await asyncio.gather(
+            *(handler.start() for handler in added_handlers),
+            *(self.stream_handlers[stream["stream_id"]].update(stream, changed=True) for stream in diff.changed),
+            *(
+                self.stream_handlers[stream["stream_id"]].start()
+                if stream["stream_id"] in regrouped
+                else self.stream_handlers[stream["stream_id"]].update(stream, changed=False)
+                for stream in diff.unchanged
+            ),
+        )
+        if diff:
+            self.mark_state_changed()
+
+    async def assign_encoder_groups(self, diff: StreamDiff) -> set[str]:
+        """
+        Packs streams sharing a source into encoder groups when grouped execution is enabled.
+        Returns the ids of unchanged streams that were stopped to move to another group.
+        """
+        from .encoder_group import EncoderGroup, plan_groups
+
+        if not GROUPED_EXECUTION:
+            return set()
+
+        stream_sources = {handler.id: handler.source_urls for handler in self.stream_handlers.values()}
+        # Changed streams are grouped by their new sources
+        stream_sources.update({stream["stream_id"]: stream["source_urls"] for stream in diff.changed})
+        groups = {}
+        assignments = {}
+        for stream_ids in plan_groups(stream_sources, GROUP_MAX_STREAMS):
+            group_id = "+".join(stream_ids)
+            groups[group_id] = self.encoder_groups.get(group_id) or EncoderGroup(group_id)
+            for stream_id in stream_ids:
+                assignments[stream_id] = groups[group_id]
+
+        unchanged_ids = {stream["stream_id"] for stream in diff.unchanged}
+        regrouped = set()
+        for handler in self.stream_handlers.values():
+            # Streams evicted from a group after a failure stay on their own ffmpeg
+            group = None if handler.solo else assignments.get(handler.id)
+            if handler.group is group:
+                continue
+            if handler.id in unchanged_ids:
                 handler.stop()
-                self.stream_handlers.remove(handler)
-        self.stream_fetch_timestamp = time.time()
+                regrouped.add(handler.id)
+            elif handler.group is not None:
+                handler.group.leave(handler)
+            handler.group = group
+
+        for group_id, group in self.encoder_groups.items():
+            if group_id not in groups:
+                await group.close()
+        self.encoder_groups = groups
+        return regrouped
 
     async def monitor(self):
         if not check_network_availability():
@@ -73,47 +185,203 @@ class GatewayService:
             self.stop_event.set()
             return
 
-        restarted = False
-        for stream_handler in self.stream_handlers:
-            if not stream_handler.is_alive():
-                logger.warning(f"Stream {stream_handler.id} crashed. Restarting...")
-                stream_handler.restart()
-                restarted = True
+        # Crashes are handled by each handler's supervisor and encoders producing no frames by
+        # abort_stalled_encoders, only streams the backend gets no frames from are caught here
+        for stream_handler in list(self.stream_handlers.values()):
+            error = stream_handler.get_stale_frames_error() if stream_handler.is_running() else None
+            if error is None:
+                continue
+            stream_handler.errors.add("stale_frames", error)
+            logger.warning(f"Stream {stream_handler.id} stalled. Restarting...", extra=stream_handler.log_extra)
+            stream_handler.abort()
 
-        if restarted:
-            self._stream_handlers_state_changed = True
+        # Passthrough streams that turned out too heavy for the uplink are restarted as transcodes
+        await asyncio.gather(*(
+            stream_handler.restart()
+            for stream_handler in self.stream_handlers.values()
+            if stream_handler.check_passthrough_bitrate()
+        ))
 
-        if self.stream_fetch_timestamp < time.time() - 60:
-            await self.update_stream_handlers()
-            self.stream_fetch_timestamp = time.time()
+        if BITRATE_CONTROL_ENABLED:
+            stream_handler = self.bitrate_controller.update(
+                list(self.stream_handlers.values()),
+                get_capacity_estimator().get_report(),
+            )
+            if stream_handler:
+                profile = stream_handler.get_encoder_profile()
+                logger.info(
+                    f"Stream {stream_handler.id} bitrate target {profile.bitrate / 1000:.0f}k "
+                    f"at {profile.fps:g} fps. Restarting...",
+                    extra=stream_handler.log_extra,
+                )
+                await stream_handler.restart()
+
+        if QOS_ENABLED:
+            stream_handler = self.load_governor.update(
+                list(self.stream_handlers.values()),
+                get_system_sampler().averages(QOS_WINDOW),
+                get_capacity_estimator().get_report(),
+                self.resources.get_report(),
+            )
+            if stream_handler:
+                logger.warning(
+                    f"Stream {stream_handler.id} (priority {stream_handler.priority}) moved to QoS level "
+                    f"{QOS_LEVEL_NAMES[stream_handler.qos_level]}. Restarting...",
+                    extra=stream_handler.log_extra,
+                )
+                await stream_handler.restart()
+
+        await self.calibrate_uplink()
+
+        if self.stream_fetch_timestamp < time.time() - 60 and not self.is_polling():
+            # Backend retries can take minutes, encoders are still supervised meanwhile
+            self._poll_task = asyncio.create_task(self.update_stream_handlers())
+
+    def is_polling(self) -> bool:
+        return self._poll_task is not None and not self._poll_task.done()
+
+    async def calibrate_uplink(self):
+        """Runs the opt-in speedtest calibration, only while no stream is using the uplink."""
+        estimator = get_capacity_estimator()
+        if (
+            not SPEEDTEST_CALIBRATION
+            or not estimator.calibration_due()
+            or any(handler.is_running() for handler in self.stream_handlers.values())
+        ):
+            return
+
+        logger.info("Running speedtest calibration while streams are idle")
+        estimator.last_calibration_attempt = time.time()
+        with get_tracer().span("speedtest"):
+            result = await asyncio.to_thread(get_network_speedtest)
+        if result:
+            result["timestamp"] = time.time()
+            cache_network_speedtest(result)
+            estimator.calibrate(result)
 
     async def start(self):
         logger.info(f"Starting gateway service for device {get_device_id()}")
+        get_system_sampler()
+        tracer = get_tracer()
+        tracer.start_loop_monitor()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, tracer.start_profile)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Signal handlers can only be installed from the main thread
+            pass
+        if self.metrics_server:
+            await self.metrics_server.start()
         await self.update_stream_handlers()
         while not self.stop_event.is_set():
-            if time.time() - self.last_monitor_timestamp > 10:
-                await self.monitor()
+            if self._poll_task and self._poll_task.done():
+                # Raises what the poll raised, like an inline poll would
+                poll_task, self._poll_task = self._poll_task, None
+                poll_task.result()
+            # The monitor restarts handlers, so it waits for a running reconcile to finish
+            if time.time() - self.last_monitor_timestamp > 10 and not self.is_polling():
+                with tracer.span("monitor"):
+                    await self.monitor()
                 self.last_monitor_timestamp = time.time()
+            self.abort_stalled_encoders()
+            if time.time() - self.last_resource_sample_timestamp >= RESOURCE_SAMPLE_INTERVAL:
+                with tracer.span("resource_sample"):
+                    self.resources.update(self.get_owned_processes())
+                self.last_resource_sample_timestamp = time.time()
             await asyncio.sleep(1)
-        for stream_handler in self.stream_handlers:
+        await self.shutdown()
+
+    async def shutdown(self):
+        get_tracer().stop_loop_monitor()
+        if self.is_polling():
+            self._poll_task.cancel()
+            await asyncio.gather(self._poll_task, return_exceptions=True)
+        for stream_handler in self.stream_handlers.values():
             stream_handler.stop()
+        for group in self.encoder_groups.values():
+            await group.close()
+        if self.ingest:
+            await self.ingest.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await self.backend.aclose()
+
+    def abort_stalled_encoders(self):
+        reason = f"No output frames for {ENCODER_STALL_TIMEOUT:.0f} seconds."
+        # Grouped streams share the telemetry of their group's ffmpeg, so they stall together
+        for group in self.encoder_groups.values():
+            if group.is_stalled():
+                logger.warning(f"Encoder group {group.id} stopped producing frames. Restarting...")
+                group.abort(reason)
+        for stream_handler in self.stream_handlers.values():
+            if stream_handler.group is None and stream_handler.is_stalled():
+                logger.warning(
+                    f"Stream {stream_handler.id} encoder stopped producing frames. Restarting...",
+                    extra=stream_handler.log_extra,
+                )
+                stream_handler.abort(reason)
+
+    def get_output_bitrates(self) -> dict[str, float]:
+        """Returns the measured output bitrate in bits/s of every running encoder."""
+        return {
+            stream_handler.id: stream_handler.telemetry.bitrate_bps
+            for stream_handler in self.stream_handlers.values()
+            if stream_handler.is_running() and stream_handler.telemetry.bitrate_bps is not None
+        }
+
+    def get_owned_processes(self) -> dict[str, int]:
+        """Returns the PID of every running ffmpeg, keyed by stream id, group or ingest source."""
+        owners = {
+            stream_handler.id: stream_handler.ffmpeg_process.pid
+            for stream_handler in self.stream_handlers.values()
+            if stream_handler.group is None and stream_handler.is_running()
+        }
+        for group_id, group in self.encoder_groups.items():
+            if group.process and group.process.returncode is None:
+                owners[f"group:{group_id}"] = group.process.pid
+        if self.ingest:
+            for url, relay in self.ingest.relays.items():
+                if relay.process and relay.process.returncode is None:
+                    owners[f"ingest:{url}"] = relay.process.pid
+        return owners
+
+    def mark_state_changed(self):
+        self._state_changes += 1
 
     def fetch_logs(self):
+        """Returns the error entries of every stream that are new or recurred since the last acknowledged heartbeat."""
         logs = []
-        for stream_handler in self.stream_handlers:
-            error = stream_handler.get_error()
-            if error:
-                logs.append({"timestamp": time.time(), "stream_id": stream_handler.id, "log": error})
+        for stream_handler in self.stream_handlers.values():
+            for entry in stream_handler.get_changed_errors():
+                logs.append({
+                    "timestamp": entry.last_seen,
+                    "stream_id": stream_handler.id,
+                    "log": f"{entry.kind} x{entry.count}: {entry.detail}",
+                    **entry.to_dict(),
+                })
         return logs
 
-
     def get_service_info(self):
         """Returns service state info and process state flags as needed."""
+        self._pending_state_changes = self._state_changes
         service_info = {
             "is_service_initialization": self._is_service_start,
-            "is_process_state_changed": self._stream_handlers_state_changed,
+            "is_process_state_changed": self._state_changes != self._reported_state_changes,
+            "probe_cache": self.prober.cache.get_stats(),
+            "ingest": self.ingest.get_stats() if self.ingest else None,
+            "encoder_groups": {group_id: group.get_stats() for group_id, group in self.encoder_groups.items()},
+            "resources": self.resources.get_report(),
+            "bitrate_control": self.bitrate_controller.get_report(list(self.stream_handlers.values())),
+            "qos": self.load_governor.get_report(list(self.stream_handlers.values())),
+            "tracing": get_tracer().get_report(),
         }
+        return service_info
+
+    def acknowledge_heartbeat(self, payload: dict):
+        """Marks the logs and flags of `payload` as reported, once the backend received it."""
+        for log in payload["logs"]:
+            stream_handler = self.stream_handlers.get(log["stream_id"])
+            if stream_handler:
+                stream_handler.errors.acknowledge(log["kind"], log["detail"], log["count"])
         # Reset flags after reporting
         self._is_service_start = False
-        self._stream_handlers_state_changed = False
-        return service_info
\ No newline at end of file
+        self._reported_state_changes = self._pending_state_changes
\ No newline at end of file
@@ -0,0 +1,106 @@
+import gzip
+import importlib
+import json
+from typing import Any
+
+from .config import HEARTBEAT_COMPRESSION, HEARTBEAT_DELTA, HEARTBEAT_FULL_INTERVAL
+from .logs import logger
+
+# Fields that are events rather than state and are always sent as-is
+ALWAYS_SENT_FIELDS = ("device_id", "logs")
+
+
+def diff_payload(new: dict, old: dict) -> dict:
+    """Returns the keys of `new` that differ from `old`, recursing into dicts. Removed keys map to None."""
+    delta = {}
+    for key, value in new.items():
+        if key not in old:
+            delta[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested = diff_payload(value, old[key])
+            if nested:
+                delta[key] = nested
+        elif value != old[key]:
+            delta[key] = value
+    for key in old:
+        if key not in new:
+            delta[key] = None
+    return delta
+
+
+class HeartbeatEncoder:
+    """
+    Turns heartbeat payloads into deltas against the last payload the backend acknowledged.
+    A full payload is sent on start, every `full_interval` heartbeats and whenever the
+    backend asks for a resync.
+    """
+
+    def __init__(self, delta: bool = HEARTBEAT_DELTA, full_interval: int = HEARTBEAT_FULL_INTERVAL):
+        self.delta: bool = delta
+        self.full_interval: int = full_interval
+        self.seq: int = 0
+        self._acked_seq: int | None = None
+        self._acked_payload: dict | None = None
+        self._deltas_since_full: int = 0
+
+    def encode(self, payload: dict) -> dict:
+        self.seq += 1
+        if (
+            not self.delta
+            or self._acked_payload is None
+            or self._deltas_since_full >= self.full_interval
+        ):
+            return {**payload, "heartbeat": {"seq": self.seq, "base_seq": None}}
+
+        body = diff_payload(payload, self._acked_payload)
+        for field in ALWAYS_SENT_FIELDS:
+            if field in payload:
+                body[field] = payload[field]
+        body["heartbeat"] = {"seq": self.seq, "base_seq": self._acked_seq}
+        return body
+
+    def acknowledge(self, payload: dict, body: dict):
+        """Marks `payload`, sent as `body`, as received by the backend."""
+        if body["heartbeat"]["base_seq"] is None:
+            self._deltas_since_full = 0
+        else:
+            self._deltas_since_full += 1
+        self._acked_seq = body["heartbeat"]["seq"]
+        self._acked_payload = payload
+
+    def reset(self):
+        self._acked_seq = None
+        self._acked_payload = None
+
+
+def _get_zstd_compressor():
+    try:
+        zstandard = importlib.import_module("zstandard")
+    except ImportError:
+        logger.warning("zstandard is not installed, compressing heartbeats with gzip")
+        return None
+    return zstandard.ZstdCompressor(level=3)
+
+
+class PayloadCompressor:
+    """Serializes JSON request bodies, compressed according to HEARTBEAT_COMPRESSION."""
+
+    def __init__(self, compression: str = HEARTBEAT_COMPRESSION):
+        self.encoding: str | None = None
+        self._zstd = None
+        if compression == "zstd":
+            self._zstd = _get_zstd_compressor()
+            self.encoding = "zstd" if self._zstd else "gzip"
+        elif compression == "gzip":
+            self.encoding = "gzip"
+
+    def compress(self, payload: Any) -> tuple[bytes, dict[str, str]]:
+        content = json.dumps(payload, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.encoding == "zstd":
+            content = self._zstd.compress(content)
+        elif self.encoding == "gzip":
+            content = gzip.compress(content, compresslevel=6)
+        if self.encoding:
+            headers["Content-Encoding"] = self.encoding
+        return content, headers
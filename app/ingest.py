@@ -0,0 +1,237 @@
+import asyncio
+import random
+import time
+
+from .config import (
+    ENCODER_STALL_TIMEOUT,
+    ENCODER_STARTUP_GRACE,
+    FFMPEG_CRASH_TAIL_LINES,
+    FFMPEG_STOP_TIMEOUT,
+    INGEST_CLIENT_QUEUE_CHUNKS,
+    INGEST_IDLE_LINGER,
+    RESTART_BACKOFF_BASE,
+    RESTART_BACKOFF_MAX,
+    RESTART_STABLE_RUNTIME,
+)
+from .ffmpeg_output import OutputBuffer, drain_stream
+from .logs import logger
+from .tracing import get_tracer
+
+RELAY_HOST = "127.0.0.1"
+RELAY_CHUNK_SIZE = 64 * 1024
+
+
+class SourceRelay:
+    """
+    A single RTSP session to a source, fanned out to local consumers.
+    - A puller ffmpeg copies the source's video into MPEG-TS on its stdout
+    - The stream is served on a local TCP port to every connected consumer
+    - Consumers that fall behind by more than `INGEST_CLIENT_QUEUE_CHUNKS` chunks are
+      disconnected, their encoder is restarted by its own supervisor
+    - The puller is restarted with backoff when it exits or stops producing data
+    """
+
+    def __init__(self, url: str):
+        self.url: str = url
+        self.consumers: set[str] = set()
+        self.port: int | None = None
+        self.process: asyncio.subprocess.Process | None = None
+        self.restart_count: int = 0
+        self.bytes_received: int = 0
+        self.dropped_clients: int = 0
+        self.stderr_buffer: OutputBuffer = OutputBuffer()
+        self.last_error: str | None = None
+        # Pending chunks and serving task of every connected consumer
+        self._clients: dict[asyncio.StreamWriter, tuple[asyncio.Queue, asyncio.Task]] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._puller_task: asyncio.Task | None = None
+        self.linger_task: asyncio.Task | None = None
+        self.started: asyncio.Future | None = None
+
+    @property
+    def local_url(self) -> str:
+        return f"tcp://{RELAY_HOST}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_client, RELAY_HOST, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._puller_task = asyncio.create_task(self._run_puller())
+        logger.info(f"Started shared ingest for {self.url} on {self.local_url}")
+
+    async def stop(self):
+        for task in (self._puller_task, self.linger_task):
+            if task and task is not asyncio.current_task():
+                task.cancel()
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), FFMPEG_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        for _queue, task in list(self._clients.values()):
+            task.cancel()
+        self._clients.clear()
+        if self._server:
+            self._server.close()
+        logger.info(f"Stopped shared ingest for {self.url}")
+
+    def puller_cmd(self) -> list[str]:
+        return [
+            "ffmpeg",
+            "-nostats",
+            "-loglevel", "error",
+            "-rtsp_transport", "tcp",
+            "-fflags", "+genpts",
+            "-i", self.url,
+            "-map", "0:v:0",
+            "-c", "copy",
+            "-f", "mpegts",
+            "pipe:1",
+        ]
+
+    async def _run_puller(self):
+        consecutive_failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                with get_tracer().span("ffmpeg_spawn"):
+                    self.process = await asyncio.create_subprocess_exec(
+                        *self.puller_cmd(),
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+            except OSError as e:
+                self.last_error = f"Failed to start ffmpeg: {e}"
+            else:
+                stderr_task = asyncio.create_task(drain_stream(self.process.stderr, self.stderr_buffer.append))
+                try:
+                    await self._relay_output(self.process)
+                finally:
+                    if self.process.returncode is None:
+                        self.process.kill()
+                    return_code = await self.process.wait()
+                    await stderr_task
+                self.last_error = (
+                    f"{self.stderr_buffer.tail(FFMPEG_CRASH_TAIL_LINES) or 'ffmpeg exited'} | Return Code: {return_code}"
+                )
+
+            self.restart_count += 1
+            if time.monotonic() - started >= RESTART_STABLE_RUNTIME:
+                consecutive_failures = 0
+            consecutive_failures += 1
+            delay = min(RESTART_BACKOFF_BASE * 2 ** (consecutive_failures - 1), RESTART_BACKOFF_MAX)
+            delay *= random.uniform(0.8, 1.2)
+            logger.warning(f"Shared ingest for {self.url} exited. Restarting in {delay:.1f}s: {self.last_error}")
+            await asyncio.sleep(delay)
+
+    async def _relay_output(self, process: asyncio.subprocess.Process):
+        """Forwards the puller's stdout to every client until it ends or stops producing data."""
+        timeout = ENCODER_STARTUP_GRACE
+        while True:
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(RELAY_CHUNK_SIZE), timeout)
+            except asyncio.TimeoutError:
+                self.stderr_buffer.append(f"No data from source for {timeout:.0f} seconds")
+                return
+            if not chunk:
+                return
+            timeout = ENCODER_STALL_TIMEOUT
+            self.bytes_received += len(chunk)
+            for queue, task in list(self._clients.values()):
+                try:
+                    queue.put_nowait(chunk)
+                except asyncio.QueueFull:
+                    logger.warning(f"Shared ingest client of {self.url} fell behind, disconnecting it")
+                    self.dropped_clients += 1
+                    task.cancel()
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue = asyncio.Queue(maxsize=INGEST_CLIENT_QUEUE_CHUNKS)
+        self._clients[writer] = (queue, asyncio.current_task())
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    def get_stats(self) -> dict:
+        return {
+            "consumers": sorted(self.consumers),
+            "consumer_count": len(self.consumers),
+            "clients": len(self._clients),
+            "running": self.process is not None and self.process.returncode is None,
+            "restart_count": self.restart_count,
+            "bytes_received": self.bytes_received,
+            "dropped_clients": self.dropped_clients,
+            "last_error": self.last_error,
+        }
+
+
+class IngestManager:
+    """
+    Shares one `SourceRelay` per source URL between all streams of the gateway.
+    Relays are reference counted by stream id: the first consumer starts one and
+    it is stopped `INGEST_IDLE_LINGER` seconds after the last consumer left, so a
+    restarting stream does not reconnect to the camera.
+    """
+
+    def __init__(self):
+        self.relays: dict[str, SourceRelay] = {}
+
+    async def acquire(self, url: str, consumer_id: str) -> str:
+        """Registers `consumer_id` as a consumer of `url` and returns the local URL to read it from."""
+        relay = self.relays.get(url)
+        if relay is None:
+            relay = SourceRelay(url)
+            self.relays[url] = relay
+            relay.started = asyncio.ensure_future(relay.start())
+        try:
+            await asyncio.shield(relay.started)
+        except OSError:
+            if self.relays.get(url) is relay:
+                del self.relays[url]
+            raise
+        if relay.linger_task:
+            relay.linger_task.cancel()
+            relay.linger_task = None
+        relay.consumers.add(consumer_id)
+        return relay.local_url
+
+    def local_url(self, url: str) -> str | None:
+        """Local URL of the relay of `url` while it is receiving from the source, else None."""
+        relay = self.relays.get(url)
+        if relay is None or relay.port is None or relay.bytes_received == 0:
+            return None
+        if relay.process is None or relay.process.returncode is not None:
+            return None
+        return relay.local_url
+
+    def release(self, url: str, consumer_id: str):
+        relay = self.relays.get(url)
+        if relay is None or consumer_id not in relay.consumers:
+            return
+        relay.consumers.discard(consumer_id)
+        if not relay.consumers and relay.linger_task is None:
+            relay.linger_task = asyncio.create_task(self._stop_idle(relay))
+
+    def release_all(self, consumer_id: str, keep: list[str] = ()):
+        for url in list(self.relays):
+            if url not in keep:
+                self.release(url, consumer_id)
+
+    async def _stop_idle(self, relay: SourceRelay):
+        await asyncio.sleep(INGEST_IDLE_LINGER)
+        if not relay.consumers and self.relays.get(relay.url) is relay:
+            del self.relays[relay.url]
+            await relay.stop()
+
+    async def close(self):
+        relays, self.relays = list(self.relays.values()), {}
+        await asyncio.gather(*(relay.stop() for relay in relays))
+
+    def get_stats(self) -> dict:
+        return {url: relay.get_stats() for url, relay in self.relays.items()}
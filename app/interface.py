@@ -1,15 +1,118 @@
+import asyncio
+import importlib.util
+import json
+import random
+import time
 from typing import TYPE_CHECKING, Any
 
 import httpx
 
+from .config import (
+    BACKEND_CONNECT_TIMEOUT,
+    BACKEND_HTTP2,
+    BACKEND_KEEPALIVE_EXPIRY,
+    BACKEND_MAX_RETRIES,
+    BACKEND_READ_TIMEOUT,
+    BACKEND_RETRY_BASE_DELAY,
+    BACKEND_RETRY_MAX_DELAY,
+    STREAM_INFO_URL,
+)
+from .heartbeat import PayloadCompressor
+from .logs import logger
+from .metrics import ROUND_TRIP_BUCKETS, Histogram
+from .tracing import get_tracer
+
 if TYPE_CHECKING:
     from .gateway import GatewayService
 from .utils import get_device_id, get_system_info
 
+# JSON object of {stream_id: last_frame_timestamp} sent along with a 304 response
+LAST_FRAME_TIMESTAMPS_HEADER = "X-Last-Frame-Timestamps"
+
+
+class BackendError(Exception):
+    """Base error for failed backend calls."""
+
+
+class BackendUnavailableError(BackendError):
+    """The backend could not be reached or kept failing with server errors."""
+
+
+class BackendResponseError(BackendError):
+    """The backend answered, but with a response that cannot be used."""
+
+
+class BackendClient:
+    """
+    Long-lived HTTP client for backend calls.
+    - Keeps connections alive between polls, over HTTP/2 when available
+    - Retries transport errors and 5xx/429 responses with jittered exponential backoff
+    - Compresses request bodies according to HEARTBEAT_COMPRESSION
+    """
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+        self._compressor: PayloadCompressor = PayloadCompressor()
+        self.round_trip: Histogram = Histogram(ROUND_TRIP_BUCKETS)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=BACKEND_HTTP2 and importlib.util.find_spec("h2") is not None,
+                timeout=httpx.Timeout(BACKEND_READ_TIMEOUT, connect=BACKEND_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=4,
+                    max_keepalive_connections=2,
+                    keepalive_expiry=BACKEND_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    async def post(self, url: str, payload: Any, headers: dict[str, str] | None = None) -> httpx.Response:
+        """Posts `payload` as JSON and returns the 200 or 304 response."""
+        client = self._get_client()
+        content, request_headers = self._compressor.compress(payload)
+        request_headers.update(headers or {})
+        last_error = ""
+        for attempt in range(BACKEND_MAX_RETRIES + 1):
+            if attempt > 0:
+                delay = min(BACKEND_RETRY_BASE_DELAY * 2 ** (attempt - 1), BACKEND_RETRY_MAX_DELAY)
+                await asyncio.sleep(random.uniform(0, delay))
+            started = time.monotonic()
+            try:
+                response = await client.post(url, content=content, headers=request_headers)
+            except httpx.TransportError as e:
+                last_error = f"{type(e).__name__}: {e}"
+                logger.warning(f"Backend request to {url} failed (attempt {attempt + 1}): {last_error}")
+                continue
+            self.round_trip.observe(time.monotonic() - started)
+
+            if response.status_code >= 500 or response.status_code == 429:
+                last_error = f"HTTP {response.status_code}"
+                logger.warning(f"Backend request to {url} failed (attempt {attempt + 1}): {last_error}")
+                continue
+            if response.status_code not in (200, 304):
+                raise BackendResponseError(f"HTTP {response.status_code} from {url}")
+            return response
+
+        raise BackendUnavailableError(f"Backend request to {url} failed: {last_error}")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 
 async def get_stream_details(gateway: "GatewayService") -> dict[str, Any]:
-    url = "https://abm.phronetic.ai/api/v1/devices/stream_info"
-    system_info = get_system_info()
+    """
+    Posts the heartbeat and returns the stream info response. When the backend reports
+    that the config matching `gateway.config_version` is unchanged, the result is
+    {"not_modified": True} plus any runtime fields such as "last_frame_timestamps".
+    A 304 has no body, so it carries those in the X-Last-Frame-Timestamps header. A
+    backend sending neither leaves the frame liveness check of newer encoders dormant.
+    """
+    with get_tracer().span("system_info"):
+        system_info = get_system_info(gateway.get_output_bitrates())
     device_id = get_device_id()
     stream_status = get_stream_status(gateway)
     logs = gateway.fetch_logs()
@@ -21,26 +124,62 @@ async def get_stream_details(gateway: "GatewayService") -> dict[str, Any]:
         "logs": logs,
         "service_info": service_info,
     }
-    async with httpx.AsyncClient() as client:
-        headers = {"Content-Type": "application/json"}
-        response = await client.post(url, json=payload, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
+    with get_tracer().span("heartbeat_encode"):
+        body = gateway.heartbeat.encode(payload)
+    body["config_version"] = gateway.config_version
+    headers = {"If-None-Match": gateway.config_version} if gateway.config_version else {}
+    with get_tracer().span("backend_post"):
+        response = await gateway.backend.post(STREAM_INFO_URL, body, headers=headers)
+    gateway.heartbeat.acknowledge(payload, body)
+    gateway.acknowledge_heartbeat(payload)
+
+    if response.status_code == 304:
+        return {"not_modified": True, "last_frame_timestamps": parse_last_frame_timestamps(response)}
+    try:
+        stream_details = response.json()
+    except ValueError as e:
+        raise BackendResponseError(f"Invalid JSON from {STREAM_INFO_URL}: {e}") from e
+    if not isinstance(stream_details, dict):
+        raise BackendResponseError(f"Unexpected stream info response: {type(stream_details).__name__}")
+    if stream_details.get("heartbeat_resync"):
+        gateway.heartbeat.reset()
+    if stream_details.get("not_modified"):
+        return stream_details
+    if not isinstance(stream_details.get("streams"), list):
+        raise BackendResponseError("Stream info response has no streams list")
+    gateway.config_version = response.headers.get("ETag") or stream_details.get("config_version")
+    return stream_details
+
+
+def parse_last_frame_timestamps(response: httpx.Response) -> dict[str, float | None]:
+    header = response.headers.get(LAST_FRAME_TIMESTAMPS_HEADER)
+    if not header:
         return {}
+    try:
+        last_frame_timestamps = json.loads(header)
+    except ValueError as e:
+        raise BackendResponseError(f"Invalid {LAST_FRAME_TIMESTAMPS_HEADER} header: {e}") from e
+    if not isinstance(last_frame_timestamps, dict):
+        raise BackendResponseError(f"Unexpected {LAST_FRAME_TIMESTAMPS_HEADER} header: {header!r}")
+    return last_frame_timestamps
 
 
 def get_stream_status(gateway: "GatewayService") -> dict:
+    handlers = list(gateway.stream_handlers.values())
+    alive = {stream.id: stream.is_alive() for stream in handlers}
     return {
-        "num_streams": len(gateway.stream_handlers),
-        "stream_ids": [stream.id for stream in gateway.stream_handlers],
+        "num_streams": len(handlers),
+        "stream_ids": [stream.id for stream in handlers],
         "alive_streams": [
-            stream.id for stream in gateway.stream_handlers if stream.is_alive()
+            stream_id for stream_id, is_alive in alive.items() if is_alive
         ],
         "dead_streams": [
-            stream.id for stream in gateway.stream_handlers if not stream.is_alive()
+            stream_id for stream_id, is_alive in alive.items() if not is_alive
         ],
         "rtsp_status": [
-            handler.rtsp_status for handler in gateway.stream_handlers
-        ]
+            handler.rtsp_status for handler in handlers
+        ],
+        "stream_stats": {
+            handler.id: handler.get_stats() for handler in handlers
+        },
     }
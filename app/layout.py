@@ -0,0 +1,89 @@
+import math
+import re
+from dataclasses import dataclass
+
+# Grids picked for a number of sources when the backend does not set a layout
+AUTO_LAYOUTS = {1: (1, 1), 2: (1, 2), 3: (2, 2), 4: (2, 2), 5: (2, 3), 6: (2, 3)}
+MAX_GRID_SIZE = 6
+
+
+@dataclass(frozen=True)
+class MosaicLayout:
+    rows: int
+    cols: int
+
+    @property
+    def capacity(self) -> int:
+        return self.rows * self.cols
+
+    @classmethod
+    def for_count(cls, count: int) -> "MosaicLayout":
+        if count in AUTO_LAYOUTS:
+            return cls(*AUTO_LAYOUTS[count])
+        cols = math.ceil(math.sqrt(count))
+        return cls(math.ceil(count / cols), cols)
+
+    @classmethod
+    def parse(cls, spec: str | dict) -> "MosaicLayout":
+        """Parses a backend layout given as "RxC" (e.g. "3x3") or {"rows": R, "cols": C}."""
+        if isinstance(spec, str):
+            match = re.fullmatch(r"\s*(\d+)\s*[xX]\s*(\d+)\s*", spec)
+            if not match:
+                raise ValueError(f"Invalid layout {spec!r}, expected e.g. \"2x2\"")
+            rows, cols = int(match.group(1)), int(match.group(2))
+        elif isinstance(spec, dict):
+            rows, cols = spec.get("rows"), spec.get("cols")
+        else:
+            raise ValueError(f"Invalid layout {spec!r}")
+        if not all(isinstance(value, int) and 1 <= value <= MAX_GRID_SIZE for value in (rows, cols)):
+            raise ValueError(f"Invalid layout {spec!r}, rows and cols must be between 1 and {MAX_GRID_SIZE}")
+        return cls(rows, cols)
+
+    def tile_size(self, width: int, height: int) -> tuple[int, int]:
+        """Largest even tile size that fits the grid into the output resolution."""
+        return width // self.cols // 2 * 2, height // self.rows // 2 * 2
+
+
+def build_mosaic_filter(
+    inputs: list[str],
+    layout: MosaicLayout,
+    width: int,
+    height: int,
+    fps: float,
+    output: str = "out",
+    prefix: str = "",
+) -> str:
+    """
+    Builds a filter graph that places the `inputs` pads (e.g. "0:v") on `layout` inside a
+    `width`x`height` canvas, labelled [`output`]. Each input is frame-rate reduced and
+    downscaled to its tile before stacking, and empty cells are left to padding
+    rather than synthetic inputs. Intermediate labels start with `prefix`, so several
+    mosaics can share one graph.
+    """
+    input_count = len(inputs)
+    tile_width, tile_height = layout.tile_size(width, height)
+    filters = [
+        f"[{pad}]fps={fps:g},"
+        f"scale={tile_width}:{tile_height}:force_original_aspect_ratio=decrease,"
+        f"pad={tile_width}:{tile_height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p[{prefix}t{index}]"
+        for index, pad in enumerate(inputs)
+    ]
+
+    rows = []
+    row_width = tile_width * layout.cols
+    for row_index, first in enumerate(range(0, input_count, layout.cols)):
+        indexes = range(first, min(first + layout.cols, input_count))
+        row = "".join(f"[{prefix}t{index}]" for index in indexes)
+        chain = [f"hstack=inputs={len(indexes)}"] if len(indexes) > 1 else []
+        if len(indexes) < layout.cols:
+            chain.append(f"pad={row_width}:{tile_height}:0:0:black")
+        if chain:
+            filters.append(f"{row}{','.join(chain)}[{prefix}r{row_index}]")
+            row = f"[{prefix}r{row_index}]"
+        rows.append(row)
+
+    chain = [f"vstack=inputs={len(rows)}"] if len(rows) > 1 else []
+    if row_width != width or tile_height * len(rows) != height:
+        chain.append(f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:black")
+    filters.append(f"{''.join(rows)}{','.join(chain) or 'null'}[{output}]")
+    return ";".join(filters)
@@ -0,0 +1,154 @@
+import os
+import time
+from typing import TYPE_CHECKING
+
+from .config import (
+    ENCODER_STARTUP_GRACE,
+    QOS_CPU_HIGH,
+    QOS_CPU_LOW,
+    QOS_HEADROOM_SUSTAIN,
+    QOS_MIN_ENCODER_SHARE,
+    QOS_MIN_SPEED,
+    QOS_OVERLOAD_SUSTAIN,
+    QOS_STEP_INTERVAL,
+)
+
+if TYPE_CHECKING:
+    from .stream_handler import StreamHandler
+
+# Quality ladder, each level includes the ones before it
+QOS_FULL = 0
+QOS_REDUCED_FPS = 1
+QOS_REDUCED_RESOLUTION = 2
+QOS_SINGLE_TILE = 3  # mosaic reduced to its first source
+QOS_PAUSED = 4
+QOS_LEVEL_NAMES = ("full", "reduced_fps", "reduced_resolution", "single_tile", "paused")
+
+
+def is_level_applicable(handler: "StreamHandler", level: int) -> bool:
+    """Whether stepping to `level` lowers the cost of `handler`."""
+    if level in (QOS_REDUCED_FPS, QOS_REDUCED_RESOLUTION):
+        return handler.is_transcoding()
+    if level == QOS_SINGLE_TILE:
+        return len(handler.valid_source_urls) > 1
+    return True
+
+
+def next_level(handler: "StreamHandler") -> int | None:
+    for level in range(handler.qos_level + 1, QOS_PAUSED + 1):
+        if is_level_applicable(handler, level):
+            return level
+    return None
+
+
+def previous_level(handler: "StreamHandler") -> int:
+    for level in range(handler.qos_level - 1, QOS_FULL, -1):
+        if is_level_applicable(handler, level):
+            return level
+    return QOS_FULL
+
+
+class LoadGovernor:
+    """
+    Keeps high-priority streams at full quality when the box is overloaded.
+    - Overload is a high CPU average or an encoder slower than real time, while the gateway's
+      ffmpeg processes use at least `QOS_MIN_ENCODER_SHARE` of the CPU, or a congested uplink
+      while the streams send at least that share of the upload. Load from elsewhere is left alone
+    - After `QOS_OVERLOAD_SUSTAIN` seconds of overload, the lowest-priority running stream is
+      stepped one level down the ladder, streams of equal priority take turns
+    - Streams of the highest priority present are never degraded
+    - After `QOS_HEADROOM_SUSTAIN` seconds of headroom, the highest-priority degraded stream is
+      stepped one level back up
+    - A step needs an encoder restart, so at most one stream is stepped per `QOS_STEP_INTERVAL`
+    """
+
+    def __init__(self):
+        self.overloaded_since: float | None = None
+        self.headroom_since: float | None = None
+        self.signals: dict = {}
+        self._last_step: float = 0.0
+
+    def update(
+        self, handlers: list["StreamHandler"], averages: dict, capacity: dict, resources: dict
+    ) -> "StreamHandler | None":
+        """Returns the handler to restart at its new level, if any."""
+        now = time.time()
+        self.signals = self._get_signals(handlers, averages, capacity, resources)
+        cpu_usage = self.signals["cpu_usage"]
+        cpu_overloaded = (cpu_usage is not None and cpu_usage >= QOS_CPU_HIGH) or bool(self.signals["lagging_streams"])
+        overloaded = (
+            (cpu_overloaded and self.signals["encoder_cpu_share"] >= QOS_MIN_ENCODER_SHARE)
+            or (self.signals["congested"] and self.signals["encoder_upload_share"] >= QOS_MIN_ENCODER_SHARE)
+        )
+        headroom = (
+            not cpu_overloaded
+            and not self.signals["congested"]
+            and (cpu_usage is None or cpu_usage <= QOS_CPU_LOW)
+        )
+        self.overloaded_since = (self.overloaded_since or now) if overloaded else None
+        self.headroom_since = (self.headroom_since or now) if headroom else None
+        if now - self._last_step < QOS_STEP_INTERVAL:
+            return None
+
+        handler = None
+        if self.overloaded_since and now - self.overloaded_since >= QOS_OVERLOAD_SUSTAIN:
+            top_priority = max((handler.priority for handler in handlers), default=0)
+            candidates = [
+                handler for handler in handlers
+                if handler.is_running() and handler.priority < top_priority and next_level(handler) is not None
+            ]
+            if candidates:
+                handler = min(candidates, key=lambda handler: (handler.priority, handler.qos_level, handler.id))
+                handler.qos_level = next_level(handler)
+        elif self.headroom_since and now - self.headroom_since >= QOS_HEADROOM_SUSTAIN:
+            candidates = [handler for handler in handlers if handler.qos_level > QOS_FULL]
+            if candidates:
+                handler = max(candidates, key=lambda handler: (handler.priority, handler.qos_level, handler.id))
+                handler.qos_level = previous_level(handler)
+                # Every step back up needs its own period of headroom
+                self.headroom_since = now
+
+        if handler:
+            self._last_step = now
+        return handler
+
+    def _get_signals(self, handlers: list["StreamHandler"], averages: dict, capacity: dict, resources: dict) -> dict:
+        lagging_streams = [
+            handler.id
+            for handler in handlers
+            if handler.is_running()
+            and handler.is_transcoding()
+            and handler.telemetry.speed is not None
+            and handler.telemetry.speed < QOS_MIN_SPEED
+            and time.time() - handler.start_timestamp > ENCODER_STARTUP_GRACE
+        ]
+        cpu_usage = averages.get("cpu_usage")
+        # ffmpeg usage is in percent of one core, cpu_usage in percent of the whole machine
+        encoder_cpu_usage = resources.get("total_cpu_percent", 0.0) / (os.cpu_count() or 1)
+        upload_bitrate = averages.get("upload_bitrate")
+        encoder_upload_bitrate = sum(
+            handler.telemetry.bitrate_bps
+            for handler in handlers
+            if handler.is_running() and handler.telemetry.bitrate_bps is not None
+        ) / 1_000_000
+        return {
+            "cpu_usage": cpu_usage,
+            "encoder_cpu_share": round(min(1.0, encoder_cpu_usage / cpu_usage), 3) if cpu_usage else 0.0,
+            "congested": bool(capacity and capacity.get("congested")),
+            "encoder_upload_share": (
+                round(min(1.0, encoder_upload_bitrate / upload_bitrate), 3) if upload_bitrate else 0.0
+            ),
+            "lagging_streams": lagging_streams,
+        }
+
+    def get_report(self, handlers: list["StreamHandler"]) -> dict:
+        now = time.time()
+        return {
+            **self.signals,
+            "overloaded_for": now - self.overloaded_since if self.overloaded_since else None,
+            "headroom_for": now - self.headroom_since if self.headroom_since else None,
+            "streams": {
+                handler.id: {"priority": handler.priority, "level": QOS_LEVEL_NAMES[handler.qos_level]}
+                for handler in handlers
+            },
+        }
@@ -1,6 +1,122 @@
-import os
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from .config import (
+    LOG_BACKUP_COUNT,
+    LOG_DEDUP_MAX_KEYS,
+    LOG_DEDUP_WINDOW,
+    LOG_FORMAT,
+    LOG_MAX_BYTES,
+    LOG_QUEUE_SIZE,
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the stream id of records logged with `extra={"stream_id": ...}`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        stream_id = getattr(record, "stream_id", None)
+        if stream_id is not None:
+            entry["stream_id"] = stream_id
+        repeated = getattr(record, "repeated", None)
+        if repeated:
+            entry["repeated"] = repeated
+        return json.dumps(entry, ensure_ascii=False)
+
+    def formatTime(self, record: logging.LogRecord, datefmt: str | None = None) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+class DedupQueueHandler(QueueHandler):
+    """
+    Hands records to a background writer without blocking the event loop.
+    - A record identical to one logged less than `window` seconds ago is counted instead of queued,
+      once the window is over a "repeated N times" summary is queued
+    - Records are dropped and counted when the queue is full, e.g. while the disk is stalled
+    """
+
+    def __init__(self, log_queue: queue.Queue, window: float = LOG_DEDUP_WINDOW, max_keys: int = LOG_DEDUP_MAX_KEYS):
+        super().__init__(log_queue)
+        self.window: float = window
+        self.max_keys: int = max_keys
+        self.dropped: int = 0
+        # First time a message was logged in the current window and the number of repeats suppressed since
+        self._seen: dict[tuple, list] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord):
+        if self.window <= 0:
+            return super().emit(record)
+        try:
+            key = (record.levelno, getattr(record, "stream_id", None), record.getMessage())
+        except Exception:
+            return super().emit(record)
+        now = record.created
+        with self._lock:
+            summaries = self._expire(now)
+            entry = self._seen.get(key)
+            if entry is not None:
+                entry[1] += 1
+                record = None
+            elif len(self._seen) < self.max_keys:
+                self._seen[key] = [now, 0, record]
+        for summary in summaries:
+            super().emit(summary)
+        if record is not None:
+            super().emit(record)
+
+    def _expire(self, now: float) -> list[logging.LogRecord]:
+        summaries = []
+        for key, (first, repeats, record) in list(self._seen.items()):
+            if now - first >= self.window:
+                del self._seen[key]
+                if repeats:
+                    summaries.append(self._summary(record, repeats, now - first))
+        if self.dropped:
+            summaries.append(logging.makeLogRecord({
+                "name": "app.logs",
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"Dropped {self.dropped} log records, the log queue was full",
+            }))
+            self.dropped = 0
+        return summaries
+
+    @staticmethod
+    def _summary(record: logging.LogRecord, repeats: int, seconds: float) -> logging.LogRecord:
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f"{record.getMessage()} (repeated {repeats} times in {seconds:.0f}s)"
+        summary.args = None
+        summary.exc_info = None
+        summary.exc_text = None
+        summary.repeated = repeats
+        summary.created = time.time()
+        summary.msecs = (summary.created % 1) * 1000
+        return summary
+
+    def flush_summaries(self):
+        with self._lock:
+            summaries = self._expire(float("inf"))
+        for summary in summaries:
+            super().emit(summary)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
 
 
 def setup_logger():
@@ -9,12 +125,27 @@ def setup_logger():
     current_dir = os.path.dirname(os.path.abspath(__file__))
     file_handler = RotatingFileHandler(
         f'{current_dir}/app.log',
-        maxBytes=50 * 1024 * 1024,
-        backupCount=1
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT
     )
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    if LOG_FORMAT == "text":
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    else:
+        formatter = JsonFormatter()
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    # File writes happen on the listener's thread, never on the event loop
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DedupQueueHandler(log_queue)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    logger.addHandler(queue_handler)
+
+    def stop():
+        queue_handler.flush_summaries()
+        listener.stop()
+
+    atexit.register(stop)
     return logger
 
 logger = setup_logger()
@@ -0,0 +1,188 @@
+import asyncio
+import bisect
+import time
+from typing import TYPE_CHECKING
+
+from .config import METRICS_HOST, METRICS_PORT
+from .logs import logger
+
+if TYPE_CHECKING:
+    from .gateway import GatewayService
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+RECONCILE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROUND_TRIP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+# Requests larger than this are not metric scrapes
+MAX_REQUEST_BYTES = 8 * 1024
+REQUEST_TIMEOUT = 5.0
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense, `buckets` are upper bounds in seconds."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * len(buckets)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricFamily:
+    def __init__(self, name: str, kind: str, description: str):
+        self.name: str = name
+        self.kind: str = kind
+        self.description: str = description
+        self.samples: list[str] = []
+
+    def add(self, value: float | int | None, **labels):
+        if value is None:
+            return
+        label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        self.samples.append(f"{self.name}{{{label_text}}} {value:g}" if label_text else f"{self.name} {value:g}")
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.samples]
+
+
+def render_metrics(gateway: "GatewayService") -> str:
+    """Returns the gateway and per-stream metrics in the Prometheus text format."""
+    families = {
+        name: MetricFamily(f"streambox_{name}", kind, description)
+        for name, kind, description in (
+            ("streams", "gauge", "Number of stream handlers"),
+            ("stream_alive", "gauge", "Whether the stream's encoder is alive"),
+            ("stream_running", "gauge", "Whether the stream's ffmpeg is running"),
+            ("stream_restarts_total", "counter", "Encoder restarts after a crash"),
+            ("stream_consecutive_crashes", "gauge", "Crashes since the encoder last ran stably"),
+            ("stream_last_crash", "gauge", "Reason and exit code of the last encoder crash"),
+            ("stream_qos_level", "gauge", "Load governor level, 0 is full quality"),
+            ("stream_encoder_fps", "gauge", "Encoder output frames per second"),
+            ("stream_encoder_speed", "gauge", "Encoder speed relative to real time"),
+            ("stream_encoder_bitrate_bps", "gauge", "Measured encoder output bitrate"),
+            ("stream_encoder_frames_total", "counter", "Frames written by the current encoder"),
+            ("stream_cpu_percent", "gauge", "CPU usage of the stream's ffmpeg, in percent of one core"),
+            ("stream_rss_bytes", "gauge", "Resident memory of the stream's ffmpeg"),
+            ("source_valid", "gauge", "Whether the last probe of the source succeeded"),
+            ("source_probe_seconds", "gauge", "Duration of the last ffprobe of the source"),
+        )
+    }
+    families["streams"].add(len(gateway.stream_handlers))
+    for handler in gateway.stream_handlers.values():
+        stream_id = handler.id
+        families["stream_alive"].add(int(handler.is_alive()), stream_id=stream_id)
+        families["stream_running"].add(int(handler.is_running()), stream_id=stream_id)
+        families["stream_restarts_total"].add(handler.restart_count, stream_id=stream_id)
+        families["stream_consecutive_crashes"].add(handler.consecutive_crashes, stream_id=stream_id)
+        if handler.last_crash_reason:
+            families["stream_last_crash"].add(
+                1, stream_id=stream_id, reason=handler.last_crash_reason, exit_code=handler.exit_code
+            )
+        families["stream_qos_level"].add(handler.qos_level, stream_id=stream_id)
+        if handler.is_running():
+            telemetry = handler.telemetry
+            families["stream_encoder_fps"].add(telemetry.fps, stream_id=stream_id)
+            families["stream_encoder_speed"].add(telemetry.speed, stream_id=stream_id)
+            families["stream_encoder_bitrate_bps"].add(telemetry.bitrate_bps, stream_id=stream_id)
+            families["stream_encoder_frames_total"].add(telemetry.frame, stream_id=stream_id)
+        # Grouped streams report the usage of the whole group's ffmpeg
+        usage = gateway.resources.get_usage(f"group:{handler.group.id}" if handler.group else handler.id)
+        if usage:
+            families["stream_cpu_percent"].add(usage["cpu_percent"], stream_id=stream_id)
+            families["stream_rss_bytes"].add(usage["rss_bytes"], stream_id=stream_id)
+        for status in handler.rtsp_status.values():
+            families["source_valid"].add(int(status["valid"]), stream_id=stream_id, url=status["url"])
+            # Scrapes must not skew the cache statistics reported in the heartbeat
+            result = gateway.prober.cache.peek(status["url"])
+            if result:
+                families["source_probe_seconds"].add(result.duration, stream_id=stream_id, url=status["url"])
+
+    lines = []
+    for family in families.values():
+        if family.samples:
+            lines.extend(family.render())
+    for name, description, histogram in (
+        ("streambox_reconcile_seconds", "Time to apply a stream info response", gateway.reconcile_duration),
+        ("streambox_backend_round_trip_seconds", "Round trip of backend requests", gateway.backend.round_trip),
+    ):
+        lines.extend([f"# HELP {name} {description}", f"# TYPE {name} histogram", *histogram.render(name)])
+    lines.append("# HELP streambox_uptime_seconds Time since the gateway started")
+    lines.append("# TYPE streambox_uptime_seconds gauge")
+    lines.append(f"streambox_uptime_seconds {time.time() - gateway.started_timestamp:g}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves `GET /metrics` from the gateway's event loop, so scrapes never add
+    traffic to the backend. Metrics are rendered from live state on every request.
+    """
+
+    def __init__(self, gateway: "GatewayService", host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.gateway: "GatewayService" = gateway
+        self.host: str = host
+        self.port: int = port
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        try:
+            self._server = await asyncio.start_server(
+                self._serve, self.host, self.port, limit=MAX_REQUEST_BYTES
+            )
+        except OSError as e:
+            logger.warning(f"Failed to start metrics endpoint on {self.host}:{self.port}: {e}")
+            return
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            method, _, rest = request.decode("latin-1").partition(" ")
+            path = rest.split(" ", 1)[0].split("?", 1)[0]
+            if method not in ("GET", "HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            elif path != "/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", render_metrics(self.gateway).encode()
+            headers = (
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(headers.encode() + (body if method == "GET" else b""))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.warning(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
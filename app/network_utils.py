@@ -43,6 +43,36 @@ def get_upload_bitrate(interval=1.0):
         print(f"Failed to get upload bitrate: {e}")
         return 0
 
+def get_tcp_counters():
+    """Returns (OutSegs, RetransSegs) from /proc/net/snmp, or None when unavailable."""
+    try:
+        with open("/proc/net/snmp", "r") as f:
+            rows = [line.split() for line in f if line.startswith("Tcp:")]
+        stats = dict(zip(rows[0][1:], rows[1][1:]))
+        return int(stats["OutSegs"]), int(stats["RetransSegs"])
+    except (OSError, IndexError, KeyError, ValueError):
+        return None
+
+# Remote addresses of loopback sockets as they appear in /proc/net/tcp{,6}
+LOOPBACK_HEX_PREFIXES = ("0100007F", "00000000000000000000000001000000")
+
+def get_tcp_send_queue_bytes():
+    """Returns the total bytes waiting in send queues of established non-loopback TCP sockets."""
+    total = 0
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path, "r") as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    # fields: sl, local_address, rem_address, st, tx_queue:rx_queue, ...
+                    if fields[3] != "01" or fields[2].startswith(LOOPBACK_HEX_PREFIXES):
+                        continue
+                    total += int(fields[4].split(":")[0], 16)
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
 def _install_ookla_speedtest_noninteractive():
     """Attempts to install Ookla speedtest non-interactively. Returns True if installed."""
     install_script = f"{REPO_ROOT}/scripts/install_speedtest.sh"
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import statistics
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from .config import (
+    PROBE_CACHE_MAX_ENTRIES,
+    PROBE_CACHE_NEGATIVE_TTL,
+    PROBE_CACHE_TTL,
+    PROBE_CONCURRENCY,
+    PROBE_GOP_DURATION,
+    PROBE_TIMEOUT,
+)
+from .ingest import IngestManager
+from .logs import logger
+from .tracing import get_tracer
+
+FFPROBE_PACKET_ENTRIES = "packet=pts_time,flags"
+FFPROBE_STREAM_ENTRIES = "stream=index,codec_name,codec_long_name,profile,pix_fmt,width,height,avg_frame_rate,r_frame_rate,bit_rate,level,color_range,color_space,color_transfer,color_primaries,nb_frames"
+
+
+@dataclass
+class ProbeResult:
+    url: str
+    valid: bool
+    output: str
+    duration: float = 0.0
+    # Fields of the first video stream as reported by ffprobe
+    info: dict = field(default_factory=dict)
+
+    @property
+    def frame_rate(self) -> float | None:
+        return parse_frame_rate(self.info.get("avg_frame_rate"))
+
+    @property
+    def bit_rate(self) -> int | None:
+        try:
+            return int(self.info.get("bit_rate"))
+        except (TypeError, ValueError):
+            return None
+
+
+class ProbeCache:
+    """
+    Probe results keyed by URL.
+    - Valid results live for `ttl` seconds, invalid ones for `negative_ttl`
+    - Least recently used entries are evicted beyond `max_entries`
+    """
+
+    def __init__(
+        self,
+        ttl: float = PROBE_CACHE_TTL,
+        negative_ttl: float = PROBE_CACHE_NEGATIVE_TTL,
+        max_entries: int = PROBE_CACHE_MAX_ENTRIES,
+    ):
+        self.ttl: float = ttl
+        self.negative_ttl: float = negative_ttl
+        self.max_entries: int = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: OrderedDict[str, tuple[ProbeResult, float]] = OrderedDict()
+
+    def get(self, url: str) -> ProbeResult | None:
+        entry = self._entries.get(url)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[url]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(url)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, url: str) -> ProbeResult | None:
+        """Returns the unexpired entry of `url` without counting a hit or miss, e.g. for metrics."""
+        entry = self._entries.get(url)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def put(self, result: ProbeResult):
+        ttl = self.ttl if result.valid else self.negative_ttl
+        self._entries[result.url] = (result, time.monotonic() + ttl)
+        self._entries.move_to_end(result.url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def refresh(self, url: str):
+        """Extends a valid entry, e.g. when a running encoder proves the source is alive."""
+        entry = self._entries.get(url)
+        if entry is not None and entry[0].valid:
+            self._entries[url] = (entry[0], time.monotonic() + self.ttl)
+
+    def invalidate(self, url: str):
+        self._entries.pop(url, None)
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RtspProber:
+    """
+    Async ffprobe runner shared by all stream handlers of a gateway.
+    - At most `max_concurrency` ffprobe processes run at the same time
+    - Every probe is killed after `timeout` seconds and reported as invalid
+    - Concurrent probes of the same URL share a single ffprobe process
+    - Results are served from a TTL cache until they expire or are invalidated
+    - Sources with a running shared ingest relay are probed through it, not with another RTSP session
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = PROBE_CONCURRENCY,
+        timeout: float = PROBE_TIMEOUT,
+        gop_duration: float = PROBE_GOP_DURATION,
+        ingest: IngestManager | None = None,
+    ):
+        self.timeout: float = timeout
+        self.gop_duration: float = gop_duration
+        self.ingest: IngestManager | None = ingest
+        self.cache: ProbeCache = ProbeCache()
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def probe(self, url: str) -> ProbeResult:
+        cached = self.cache.get(url)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._probe(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def probe_many(self, urls: list[str]) -> list[ProbeResult]:
+        return list(await asyncio.gather(*(self.probe(url) for url in urls)))
+
+    async def _probe(self, url: str) -> ProbeResult:
+        async with self._semaphore:
+            start = time.monotonic()
+            valid, output, info = await self._run_ffprobe(url)
+            result = ProbeResult(url, valid, output, time.monotonic() - start, info)
+            get_tracer().record("ffprobe", result.duration)
+            self.cache.put(result)
+            return result
+
+    async def _run_ffprobe(self, url: str) -> tuple[bool, str, dict]:
+        entries = FFPROBE_STREAM_ENTRIES
+        read_intervals = []
+        if self.gop_duration > 0:
+            # Packet flags of the first seconds give the keyframe interval
+            entries = f"{entries}:{FFPROBE_PACKET_ENTRIES}"
+            read_intervals = ["-read_intervals", f"%+{self.gop_duration:g}"]
+        local_url = self.ingest.local_url(url) if self.ingest else None
+        input_args = ["-f", "mpegts", local_url] if local_url else ["-rtsp_transport", "tcp", url]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffprobe",
+                "-v", "error",
+                "-select_streams", "v:0",
+                "-show_entries", entries,
+                *read_intervals,
+                "-of", "json",
+                *input_args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.error(f"Failed to run ffprobe for {url}: {e}")
+            return False, str(e), {}
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return False, f"ffprobe timed out after {self.timeout:.0f} seconds", {}
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+
+        errors = stderr.decode(errors="replace").strip()
+        if process.returncode != 0:
+            return False, errors or stdout.decode(errors="replace").strip(), {}
+        info = parse_stream_info(stdout)
+        output = "\n".join(f"{key}={value}" for key, value in info.items())
+        if errors:
+            output = f"{output}\n{errors}".strip()
+        return True, output, info
+
+
+def parse_stream_info(ffprobe_json: bytes) -> dict:
+    """
+    Returns the first stream of ffprobe's JSON output, or {} if there is none.
+    When packets were read, `gop_seconds` is added with the median keyframe interval.
+    """
+    try:
+        data = json.loads(ffprobe_json or b"{}")
+        streams = data.get("streams") or []
+        packets = data.get("packets") or []
+    except (ValueError, AttributeError):
+        return {}
+    if not streams or not isinstance(streams[0], dict):
+        return {}
+    info = streams[0]
+    gop_seconds = parse_gop_seconds(packets)
+    if gop_seconds is not None:
+        info["gop_seconds"] = round(gop_seconds, 3)
+    return info
+
+
+def parse_gop_seconds(packets: list[dict]) -> float | None:
+    """Median interval between keyframe packets, None if fewer than two keyframes were read."""
+    keyframe_times = []
+    for packet in packets:
+        if "K" not in str(packet.get("flags", "")):
+            continue
+        try:
+            keyframe_times.append(float(packet["pts_time"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    intervals = [b - a for a, b in zip(keyframe_times, keyframe_times[1:]) if b > a]
+    return statistics.median(intervals) if intervals else None
+
+
+def parse_frame_rate(value) -> float | None:
+    """Parses ffprobe rates such as "25/1" or "30000/1001", None when unknown."""
+    try:
+        numerator, _, denominator = str(value).partition("/")
+        rate = float(numerator) / float(denominator or 1)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return rate if rate > 0 else None
@@ -0,0 +1,36 @@
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .stream_handler import StreamHandler
+
+
+@dataclass
+class StreamDiff:
+    added: list[dict] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    changed: list[dict] = field(default_factory=list)
+    unchanged: list[dict] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+def diff_streams(handlers: dict[str, "StreamHandler"], streams: list[dict]) -> StreamDiff:
+    """Splits the desired `streams` into added, removed, changed and unchanged against the running `handlers`."""
+    diff = StreamDiff()
+    desired_ids = set()
+    for stream in streams:
+        stream_id = stream["stream_id"]
+        if stream_id in desired_ids:
+            continue
+        desired_ids.add(stream_id)
+        handler = handlers.get(stream_id)
+        if handler is None:
+            diff.added.append(stream)
+        elif handler.has_config_changed(stream):
+            diff.changed.append(stream)
+        else:
+            diff.unchanged.append(stream)
+    diff.removed = [stream_id for stream_id in handlers if stream_id not in desired_ids]
+    return diff
@@ -0,0 +1,185 @@
+import math
+import os
+import time
+from dataclasses import asdict, dataclass
+
+import psutil
+
+from .config import (
+    ENCODER_CGROUP,
+    ENCODER_NICE,
+    ENCODER_PLACEMENT,
+    ENCODER_PLACEMENT_DEFAULT_COST,
+    ENCODER_PLACEMENT_REBALANCE_INTERVAL,
+    ENCODER_RESERVED_CPUS,
+)
+from .logs import logger
+
+
+@dataclass
+class ProcessUsage:
+    pid: int
+    # Percent of one core, above 100 for multi-threaded encoders
+    cpu_percent: float
+    rss_bytes: int
+    threads: int
+    read_bytes: int | None = None
+    write_bytes: int | None = None
+    read_bps: float | None = None
+    write_bps: float | None = None
+    cpus: list[int] | None = None
+
+
+class CorePlacer:
+    """
+    Spreads encoders over the cores not reserved for the gateway.
+    - New encoders go to the least loaded cores, with as many cores as their CPU cost needs
+    - When a core is overloaded, all encoders are repacked by decreasing measured cost,
+      at most once per `rebalance_interval`
+    - Placed encoders are reniced and optionally moved into a cgroup
+    """
+
+    def __init__(
+        self,
+        reserved_cpus: list[int] = ENCODER_RESERVED_CPUS,
+        nice: int = ENCODER_NICE,
+        cgroup: str = ENCODER_CGROUP,
+        rebalance_interval: float = ENCODER_PLACEMENT_REBALANCE_INTERVAL,
+    ):
+        available = list(range(psutil.cpu_count() or 1))
+        self.cpus: list[int] = [cpu for cpu in available if cpu not in reserved_cpus] or available
+        self.nice: int = nice
+        self.cgroup: str = cgroup
+        self.rebalance_interval: float = rebalance_interval
+        self.assignments: dict[int, list[int]] = {}
+        self.last_rebalance: float = time.monotonic()
+
+    def update(self, processes: dict[int, psutil.Process], costs: dict[int, float]):
+        for pid in list(self.assignments):
+            if pid not in processes:
+                del self.assignments[pid]
+
+        loads = self.core_loads(costs)
+        if (
+            any(load > 100 for load in loads.values())
+            and time.monotonic() - self.last_rebalance >= self.rebalance_interval
+        ):
+            self.last_rebalance = time.monotonic()
+            self.assignments.clear()
+            loads = {cpu: 0.0 for cpu in self.cpus}
+
+        pending = sorted(
+            (pid for pid in processes if pid not in self.assignments),
+            key=lambda pid: costs.get(pid, ENCODER_PLACEMENT_DEFAULT_COST),
+            reverse=True,
+        )
+        for pid in pending:
+            cost = costs.get(pid, ENCODER_PLACEMENT_DEFAULT_COST)
+            cpus = sorted(self.cpus, key=lambda cpu: loads[cpu])[:max(1, math.ceil(cost / 100))]
+            for cpu in cpus:
+                loads[cpu] += cost / len(cpus)
+            self.assignments[pid] = sorted(cpus)
+            self._apply(processes[pid], self.assignments[pid])
+
+    def core_loads(self, costs: dict[int, float]) -> dict[int, float]:
+        """Estimated CPU percent per core, assuming an encoder spreads evenly over its cores."""
+        loads = {cpu: 0.0 for cpu in self.cpus}
+        for pid, cpus in self.assignments.items():
+            cost = costs.get(pid, ENCODER_PLACEMENT_DEFAULT_COST)
+            for cpu in cpus:
+                loads[cpu] += cost / len(cpus)
+        return loads
+
+    def _apply(self, process: psutil.Process, cpus: list[int]):
+        try:
+            process.cpu_affinity(cpus)
+            if self.nice:
+                process.nice(self.nice)
+        except (psutil.Error, OSError) as e:
+            logger.warning(f"Failed to place ffmpeg {process.pid} on cores {cpus}: {e}")
+        if self.cgroup:
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.procs"), "w") as f:
+                    f.write(str(process.pid))
+            except OSError as e:
+                logger.warning(f"Failed to move ffmpeg {process.pid} into cgroup {self.cgroup}: {e}")
+
+
+class ResourceMonitor:
+    """
+    Samples CPU, memory, threads and I/O of the ffmpeg processes owned by the gateway.
+    Processes are identified by an owner label, e.g. a stream id.
+    """
+
+    def __init__(self, placement: bool = ENCODER_PLACEMENT):
+        self.placer: CorePlacer | None = CorePlacer() if placement else None
+        self.usage: dict[str, ProcessUsage] = {}
+        self._processes: dict[int, psutil.Process] = {}
+        self._last_io: dict[int, tuple[float, int, int]] = {}
+
+    def update(self, owners: dict[str, int]):
+        """Samples every `owners` PID, `owners` maps owner labels to PIDs."""
+        pids = set(owners.values())
+        for pid in list(self._processes):
+            if pid not in pids:
+                del self._processes[pid]
+                self._last_io.pop(pid, None)
+
+        usage = {}
+        for owner, pid in owners.items():
+            process = self._processes.get(pid)
+            try:
+                if process is None:
+                    process = psutil.Process(pid)
+                    # The first call only sets the baseline
+                    process.cpu_percent()
+                    self._processes[pid] = process
+                usage[owner] = self._sample(process)
+            except psutil.Error:
+                self._processes.pop(pid, None)
+        self.usage = usage
+
+        if self.placer:
+            self.placer.update(
+                self._processes,
+                {sample.pid: sample.cpu_percent for sample in usage.values() if sample.cpu_percent},
+            )
+
+    def _sample(self, process: psutil.Process) -> ProcessUsage:
+        with process.oneshot():
+            usage = ProcessUsage(
+                pid=process.pid,
+                cpu_percent=process.cpu_percent(),
+                rss_bytes=process.memory_info().rss,
+                threads=process.num_threads(),
+            )
+            try:
+                io = process.io_counters()
+            except (psutil.AccessDenied, AttributeError):
+                io = None
+        if io is not None:
+            now = time.monotonic()
+            usage.read_bytes, usage.write_bytes = io.read_bytes, io.write_bytes
+            last = self._last_io.get(process.pid)
+            if last and now > last[0]:
+                usage.read_bps = (io.read_bytes - last[1]) * 8 / (now - last[0])
+                usage.write_bps = (io.write_bytes - last[2]) * 8 / (now - last[0])
+            self._last_io[process.pid] = (now, io.read_bytes, io.write_bytes)
+        if self.placer:
+            usage.cpus = self.placer.assignments.get(process.pid)
+        return usage
+
+    def get_usage(self, owner: str) -> dict | None:
+        usage = self.usage.get(owner)
+        return asdict(usage) if usage else None
+
+    def get_report(self) -> dict:
+        report = {
+            "processes": {owner: asdict(usage) for owner, usage in self.usage.items()},
+            "total_cpu_percent": sum(usage.cpu_percent for usage in self.usage.values()),
+            "total_rss_bytes": sum(usage.rss_bytes for usage in self.usage.values()),
+        }
+        if self.placer:
+            costs = {usage.pid: usage.cpu_percent for usage in self.usage.values()}
+            report["core_loads"] = self.placer.core_loads(costs)
+        return report
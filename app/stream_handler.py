@@ -1,193 +1,675 @@
-import subprocess
+import asyncio
+import dataclasses
+import random
 import time
+from collections import deque
+from typing import TYPE_CHECKING
 
+from app.config import (
+    CRASH_LOOP_PARK_TIME,
+    CRASH_LOOP_THRESHOLD,
+    CRASH_LOOP_WINDOW,
+    BITRATE_MIN_FPS,
+    ENCODER_STALL_TIMEOUT,
+    ENCODER_STARTUP_GRACE,
+    FFMPEG_CRASH_TAIL_LINES,
+    FFMPEG_STOP_TIMEOUT,
+    KEYFRAME_ONLY_MAX_GOP_FRAMES,
+    LOW_RATE_DECODE_ENABLED,
+    LOW_RATE_FPS_RATIO,
+    PASSTHROUGH_ENABLED,
+    PASSTHROUGH_VERIFY_TIME,
+    QOS_FPS_FACTOR,
+    QOS_RESOLUTION_FACTOR,
+    RESTART_BACKOFF_BASE,
+    RESTART_BACKOFF_MAX,
+    RESTART_STABLE_RUNTIME,
+)
+from app.bitrate_controller import RateTarget
+from app.encoder_profile import ENCODER_PRESETS, EncoderProfile, resolve_encoder_profile
+from app.error_store import ErrorEntry, ErrorStore
+from app.ffmpeg_output import OutputBuffer, drain_stream
+from app.ffmpeg_progress import EncoderTelemetry
 from app.gateway import GatewayService
+from app.layout import MosaicLayout, build_mosaic_filter
+from app.load_governor import (
+    QOS_FULL,
+    QOS_LEVEL_NAMES,
+    QOS_PAUSED,
+    QOS_REDUCED_FPS,
+    QOS_REDUCED_RESOLUTION,
+    QOS_SINGLE_TILE,
+)
 from app.logs import logger
+from app.probe import parse_frame_rate
+from app.tracing import get_tracer
+
+if TYPE_CHECKING:
+    from app.encoder_group import EncoderGroup
+
+STATE_IDLE = "idle"  # not started or no valid source urls
+STATE_RUNNING = "running"
+STATE_BACKOFF = "backoff"  # crashed, waiting to restart
+STATE_CRASH_LOOPING = "crash_looping"  # crashed repeatedly, parked
+STATE_STOPPED = "stopped"
+STATE_PAUSED = "paused"  # stopped by the load governor
+
+MODE_PASSTHROUGH = "passthrough"  # single source, stream copy
+MODE_TRANSCODE = "transcode"  # single source, re-encoded
+MODE_MOSAIC = "mosaic"  # several sources stacked into a grid
+
+PASSTHROUGH_CODECS = ("h264",)
+PASSTHROUGH_PIX_FMTS = ("yuv420p", "yuvj420p")
+
+DECODE_FULL = "full"  # every frame decoded, dropped after scaling by -r
+DECODE_DECIMATE = "decimate"  # every frame decoded, dropped before scaling
+DECODE_KEYFRAMES = "keyframes"  # only keyframes decoded
+KEYFRAME_ONLY_CODECS = ("h264", "hevc")
+
+
+def can_passthrough(info: dict, profile: EncoderProfile) -> bool:
+    """True when a probed source can be relayed as-is within the output constraints of `profile`."""
+    if info.get("codec_name") not in PASSTHROUGH_CODECS or info.get("pix_fmt") not in PASSTHROUGH_PIX_FMTS:
+        return False
+    width, height = info.get("width"), info.get("height")
+    if not width or not height or width > profile.width or height > profile.height:
+        return False
+    try:
+        bit_rate = int(info.get("bit_rate"))
+    except (TypeError, ValueError):
+        # RTSP sources rarely report a bitrate, it is verified once the stream runs
+        return True
+    return bit_rate <= profile.max_bitrate
+
+
+def select_decode_mode(info: dict, output_fps: float) -> str:
+    """Picks how much of a probed source to decode for an output of `output_fps`."""
+    source_fps = parse_frame_rate(info.get("avg_frame_rate"))
+    if not LOW_RATE_DECODE_ENABLED or source_fps is None or source_fps < output_fps * LOW_RATE_FPS_RATIO:
+        return DECODE_FULL
+    gop_seconds = info.get("gop_seconds")
+    if (
+        info.get("codec_name") in KEYFRAME_ONLY_CODECS
+        and gop_seconds
+        and gop_seconds <= KEYFRAME_ONLY_MAX_GOP_FRAMES / output_fps
+    ):
+        return DECODE_KEYFRAMES
+    return DECODE_DECIMATE
+
+
+def decode_input_args(decode_mode: str) -> list[str]:
+    return ["-skip_frame", "nokey"] if decode_mode == DECODE_KEYFRAMES else []
 
 
 class StreamHandler:
     def __init__(self, gateway: GatewayService, stream_details: dict):
         self.id: str = stream_details["stream_id"]
+        # Tags log records of this stream with its id
+        self.log_extra: dict = {"stream_id": self.id}
         self.stream_url: str = stream_details["stream_url"]
         self.status: str = stream_details["status"]
         self.source_urls: list[str] = stream_details["source_urls"]
         self.gateway: GatewayService = gateway
-        self.ffmpeg_process: subprocess.Popen | None = None
+        self.ffmpeg_process: asyncio.subprocess.Process | None = None
         self.exit_code: int = 0
+        # "exit", "signal", "aborted" or "group" for a failure of the stream's encoder group
+        self.last_crash_reason: str | None = None
         self.last_frame_timestamp: float | None = stream_details["last_frame_timestamp"]
+        # When the backend last reported last_frame_timestamp, a 304 reports it in a header
+        self.last_frame_report_timestamp: float = time.time()
         self.start_timestamp: float | None = None
         self.valid_source_urls: list[str] = []
         self.rtsp_status = {}
-        self.ffmpeg_error = "init"
+        self.source_info: dict[str, dict] = {}
+        self.mode: str | None = None
+        self.decode_modes: dict[str, str] = {}
+        # Local relay URLs of sources read through the gateway's shared ingest
+        self.input_urls: dict[str, str] = {}
+        # Encoder group running this stream as one output of a shared ffmpeg
+        self.group: "EncoderGroup | None" = None
+        # Set when the stream failed in its group, it then runs its own ffmpeg until its config changes
+        self.solo: bool = False
+        self._passthrough_rejected: bool = False
+        self.errors: ErrorStore = ErrorStore()
+        self._abort_reason: str | None = None
+        self.encoder_profile_spec: str | dict | None = None
+        self.encoder_profiles: dict[str, EncoderProfile] = {}
+        self._ffmpeg_cmd_cache: tuple[tuple, list[str]] | None = None
+        self.weight: float = float(stream_details.get("weight", 1.0))
+        # Higher priority streams are degraded last under overload
+        self.priority: int = int(stream_details.get("priority", 0))
+        self.qos_level: int = QOS_FULL
+        # Bitrate and fps set by the bitrate controller, overriding the profile
+        self.rate_target: RateTarget | None = None
+        self.load_encoder_profiles(stream_details.get("encoder_profile"))
+        self.layout_spec: str | dict | None = None
+        # Grid requested by the backend, None to size the grid from the source count
+        self.layout: MosaicLayout | None = None
+        self.load_layout(stream_details.get("layout"))
+        self.state: str = STATE_IDLE
+        self.restart_count: int = 0
+        self.consecutive_crashes: int = 0
+        self.next_restart_timestamp: float | None = None
+        self._crash_times: deque[float] = deque()
+        self._supervisor_task: asyncio.Task | None = None
+        self._aborted: bool = False
+        self.stderr_buffer: OutputBuffer = OutputBuffer()
+        self.telemetry: EncoderTelemetry = EncoderTelemetry()
 
-    def update(self, stream_details: dict):
-        logger.info(f"Updating stream details for stream: {stream_details['stream_id']}")
-        changed = True
-        if (
+    def has_config_changed(self, stream_details: dict) -> bool:
+        return not (
             self.stream_url == stream_details["stream_url"]
             and self.status == stream_details["status"]
             and self.source_urls == stream_details["source_urls"]
-        ):
-            changed = False
+            and self.encoder_profile_spec == stream_details.get("encoder_profile")
+            and self.layout_spec == stream_details.get("layout")
+        )
 
+    async def update(self, stream_details: dict, changed: bool):
+        if changed:
+            logger.info(f"Updating stream details for stream: {stream_details['stream_id']}", extra=self.log_extra)
         self.stream_url = stream_details["stream_url"]
         self.status = stream_details["status"]
         self.source_urls = stream_details["source_urls"]
-        self.last_frame_timestamp = stream_details["last_frame_timestamp"]
+        self.set_last_frame_timestamp(stream_details["last_frame_timestamp"])
+        self.weight = float(stream_details.get("weight", 1.0))
+        self.priority = int(stream_details.get("priority", 0))
+        if not changed and self.state in (STATE_BACKOFF, STATE_CRASH_LOOPING):
+            # The supervisor owns the restart schedule of a failing stream
+            return
+        if changed:
+            self.load_encoder_profiles(stream_details.get("encoder_profile"))
+            self.load_layout(stream_details.get("layout"))
+            self.rate_target = None
+            self.reset_backoff()
+            self.invalidate_probes()
+            self._passthrough_rejected = False
+            self.solo = False
+        elif self.is_running():
+            # A running encoder is proof that its sources are reachable
+            for url in self.valid_source_urls:
+                self.gateway.prober.cache.refresh(url)
         existing_valid_source_urls = self.valid_source_urls
-        self.validate_source_urls()
+        await self.validate_source_urls()
         if changed or self.valid_source_urls != existing_valid_source_urls:
-            self.restart()
-
-    def get_error(self):
-        error = ""
-        for _index, status in self.rtsp_status.items():
-            if not status["valid"]:
-                error += f"RTSP URL {status['url']} is invalid: {status['output']}\n"
-        if self.ffmpeg_error:
-            error += f"FFmpeg error: {self.ffmpeg_error}\n"
-            self.ffmpeg_error = "init"
-        if len(self.valid_source_urls) == 0:
-            error += "No valid source URLs"
-        return error.strip() if error else None
+            await self.restart()
+
+    def set_last_frame_timestamp(self, timestamp: float | None):
+        self.last_frame_timestamp = timestamp
+        self.last_frame_report_timestamp = time.time()
 
-    def start(self):
+    def get_changed_errors(self) -> list[ErrorEntry]:
+        """Returns the error entries that are new or recurred since they were last acknowledged."""
+        for kind, count, line in self.stderr_buffer.pop_errors():
+            self.errors.add(f"ffmpeg_{kind}", line, count=count)
+        return self.errors.get_changed()
+
+    def record_exit_error(self, crash_error: str):
+        if self._aborted:
+            detail = f"{self._abort_reason} | {crash_error}" if self._abort_reason else crash_error
+            self.errors.add("aborted", detail)
+        else:
+            self.errors.add("ffmpeg_exit", crash_error)
+
+    async def start(self):
         if self.gateway.stop_event.is_set():
             return
 
-        self.validate_source_urls()
+        await self.validate_source_urls()
+        if self.qos_level >= QOS_PAUSED:
+            logger.info(f"Stream {self.id} is paused by the load governor", extra=self.log_extra)
+            self.release_inputs()
+            self.state = STATE_PAUSED
+            return
+        await self.acquire_inputs()
 
         if len(self.valid_source_urls) == 0:
-            logger.info(f"No valid source urls - Returning...")
+            logger.info(f"No valid source urls - Returning...", extra=self.log_extra)
+            self.errors.add("no_valid_sources", "No valid source URLs")
+            self.state = STATE_IDLE
             return
 
-        logger.info(f"Starting stream: {self.id}")
-        # ffmpeg_process = subprocess.Popen(ffmpeg_cmd)
-        self.ffmpeg_process = subprocess.Popen(
-            self.build_ffmpeg_cmd(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
+        self.mode = self.select_mode()
+        logger.info(f"Starting stream: {self.id} ({self.mode})", extra=self.log_extra)
+        if self.group is not None:
+            # The group's ffmpeg is restarted with this stream as one of its outputs
+            self.group.join(self)
+            return
         self.start_timestamp = time.time()
-        logger.info(f"Stream handler started at: {self.start_timestamp}")
+        self._aborted = False
+        self._abort_reason = None
+        self.stderr_buffer.clear()
+        self.telemetry = EncoderTelemetry()
+        try:
+            with get_tracer().span("ffmpeg_spawn"):
+                process = await asyncio.create_subprocess_exec(
+                    *self.build_ffmpeg_cmd(),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+        except OSError as e:
+            logger.error(f"Failed to start ffmpeg for stream {self.id}: {e}", extra=self.log_extra)
+            self.errors.add("ffmpeg_start", f"Failed to start ffmpeg: {e}")
+            self.schedule_restart(self.record_crash())
+            return
+
+        self.ffmpeg_process = process
+        self.state = STATE_RUNNING
+        self._supervisor_task = asyncio.create_task(self._supervise(process))
+        logger.info(f"Stream handler started at: {self.start_timestamp}", extra=self.log_extra)
 
     def stop(self):
-        if self.ffmpeg_process:
-            try:
-                self.ffmpeg_process.terminate()
-                self.ffmpeg_process = None
-            except Exception as e:
-                logger.error(f"Error stopping stream {self.id}: {e}")
-            logger.info(f"Stream {self.id} stopped")
+        self._cancel_supervisor()
+        self.release_inputs()
+        self.next_restart_timestamp = None
+        process, self.ffmpeg_process = self.ffmpeg_process, None
+        self.state = STATE_STOPPED
+        if self.group is not None:
+            # The process is shared, the group restarts it without this stream
+            self.group.leave(self)
+            return
+        if process:
+            if process.returncode is None:
+                try:
+                    process.terminate()
+                except ProcessLookupError:
+                    pass
+                except Exception as e:
+                    logger.error(f"Error stopping stream {self.id}: {e}", extra=self.log_extra)
+                asyncio.ensure_future(self._reap(process))
+            logger.info(f"Stream {self.id} stopped", extra=self.log_extra)
 
-    def restart(self):
+    async def restart(self, reprobe: bool = False):
         self.stop()
-        self.start()
+        if reprobe:
+            self.invalidate_probes()
+        await self.start()
 
-    def is_alive(self):
-        if self.ffmpeg_process:
-            if self.ffmpeg_process.poll() is not None:
-                # Process has terminated, capture error output
-                stderr_output = self.ffmpeg_process.stderr.read() if self.ffmpeg_process.stderr else None
-                self.ffmpeg_error = stderr_output if stderr_output else "ffmpeg command failed"
-
-                stdout_output = self.ffmpeg_process.stdout.read() if self.ffmpeg_process.stdout else ""
-                self.ffmpeg_error += f" | FFmpeg Output: {stdout_output}"
-                process_return_code = self.ffmpeg_process.returncode
-                self.ffmpeg_error += f" | Return Code: {process_return_code}"
-                return False
-        if self.start_timestamp and time.time() - self.start_timestamp > 150:
-            current_time = time.time()
-            time_since_start = current_time - self.start_timestamp
-            if (
-                not self.last_frame_timestamp
-                or current_time - self.last_frame_timestamp > 300
-            ):
-                error_msg = f" - Stream {self.id}: Last Frame received 120 seconds ago. Marking process as Not Alive."
-                if not self.last_frame_timestamp:
-                    error_msg += f" [last_frame_timestamp=None, start_timestamp={self.start_timestamp}, time_since_start={time_since_start:.2f}s, current_time={current_time}]"
-                else:
-                    time_since_last_frame = current_time - self.last_frame_timestamp
-                    error_msg += f" [last_frame_timestamp={self.last_frame_timestamp}, time_since_last_frame={time_since_last_frame:.2f}s, start_timestamp={self.start_timestamp}, time_since_start={time_since_start:.2f}s, current_time={current_time}]"
-                self.ffmpeg_error += error_msg
-                return False
+    def attach_process(self, process: asyncio.subprocess.Process):
+        """Marks the stream as running in `process`, started by its encoder group."""
+        self.ffmpeg_process = process
+        self.state = STATE_RUNNING
+        self.start_timestamp = time.time()
+        self.next_restart_timestamp = None
+        self._aborted = False
+        self._abort_reason = None
+        self.stderr_buffer.clear()
+        self.telemetry = EncoderTelemetry()
+
+    def abort(self, reason: str | None = None):
+        """
+        Terminates a running but unhealthy ffmpeg. The supervisor then restarts it with backoff.
+        A grouped stream is evicted from its group instead, so the other members keep their encodes.
+        """
+        if not self.is_running():
+            return
+        self._abort_reason = reason
+        self._aborted = True
+        if self.group is not None:
+            self.group.evict(self)
+            return
+        self.ffmpeg_process.terminate()
+
+    async def acquire_inputs(self):
+        """Reads the valid sources through the gateway's shared relays when shared ingest is enabled."""
+        ingest = self.gateway.ingest
+        if ingest is None:
+            return
+        ingest.release_all(self.id, keep=self.active_source_urls())
+        input_urls = {}
+        for url in self.active_source_urls():
+            try:
+                input_urls[url] = await ingest.acquire(url, self.id)
+            except OSError as e:
+                logger.error(f"Shared ingest unavailable for {url}: {e}. Reading it directly.", extra=self.log_extra)
+        self.input_urls = input_urls
+
+    def release_inputs(self):
+        if self.gateway.ingest is not None:
+            self.gateway.ingest.release_all(self.id)
+        self.input_urls = {}
+
+    def reset_backoff(self):
+        self.consecutive_crashes = 0
+        self._crash_times.clear()
+
+    def is_running(self):
+        return self.ffmpeg_process is not None and self.ffmpeg_process.returncode is None
+
+    def active_source_urls(self) -> list[str]:
+        """Valid sources the encoder reads, only the first one when degraded to a single tile."""
+        if self.qos_level >= QOS_SINGLE_TILE:
+            return self.valid_source_urls[:1]
+        return self.valid_source_urls
+
+    def select_mode(self) -> str:
+        if len(self.active_source_urls()) > 1:
+            return MODE_MOSAIC
+        if (
+            PASSTHROUGH_ENABLED
+            and not self._passthrough_rejected
+            and self.qos_level == QOS_FULL
+            and can_passthrough(
+                self.source_info.get(self.valid_source_urls[0], {}),
+                self.encoder_profiles[MODE_TRANSCODE],
+            )
+        ):
+            return MODE_PASSTHROUGH
+        return MODE_TRANSCODE
+
+    def check_passthrough_bitrate(self) -> bool:
+        """Returns True when a passthrough stream measured above the bitrate ceiling and must be transcoded."""
+        max_bitrate = self.encoder_profiles[MODE_TRANSCODE].max_bitrate
+        if (
+            self.mode != MODE_PASSTHROUGH
+            or not self.is_running()
+            or self.telemetry.bitrate_bps is None
+            or time.time() - self.start_timestamp < PASSTHROUGH_VERIFY_TIME
+            or self.telemetry.bitrate_bps <= max_bitrate
+        ):
+            return False
+        logger.info(
+            f"Stream {self.id} passthrough bitrate {self.telemetry.bitrate_bps / 1000:.0f}k "
+            f"exceeds {max_bitrate / 1000:.0f}k, switching to transcode",
+            extra=self.log_extra,
+        )
+        self._passthrough_rejected = True
         return True
 
-    def validate_source_urls(self):
+    def is_stalled(self):
+        """True when the running encoder stopped producing output frames."""
+        return self.is_running() and self.telemetry.is_stalled(ENCODER_STARTUP_GRACE, ENCODER_STALL_TIMEOUT)
+
+    async def _supervise(self, process: asyncio.subprocess.Process):
+        """Drains ffmpeg's pipes until it exits, then restarts it unless it was stopped on purpose."""
+        return_code, _, _ = await asyncio.gather(
+            process.wait(),
+            drain_stream(process.stderr, self.stderr_buffer.append),
+            drain_stream(process.stdout, self.telemetry.feed_line),
+        )
+        if process is not self.ffmpeg_process:
+            return
+
+        stderr_output = self.stderr_buffer.tail(FFMPEG_CRASH_TAIL_LINES)
+        crash_error = stderr_output if stderr_output else "ffmpeg command failed"
+        crash_error += f" | Frames: {self.telemetry.frame}"
+        crash_error += f" | Return Code: {return_code}"
+        self.record_exit_error(crash_error)
+        self.exit_code = return_code
+        self.last_crash_reason = "aborted" if self._aborted else "signal" if return_code < 0 else "exit"
+        self.ffmpeg_process = None
+        await self._schedule_restart()
+
+    async def _schedule_restart(self):
+        await self._restart_after(self.record_crash())
+
+    def schedule_restart(self, delay: float):
+        """Restarts the stream after `delay` seconds, from a supervisor task that stop() cancels."""
+        self._cancel_supervisor()
+        self._supervisor_task = asyncio.create_task(self._restart_after(delay))
+
+    async def _restart_after(self, delay: float):
+        if self.state == STATE_CRASH_LOOPING:
+            # A parked stream does not hold on to the camera sessions of its sources
+            self.release_inputs()
+        logger.warning(f"Stream {self.id} crashed. Restarting in {delay:.1f}s ({self.state})...", extra=self.log_extra)
+        self.gateway.mark_state_changed()
+        self.next_restart_timestamp = time.time() + delay
+        await asyncio.sleep(delay)
+        self.next_restart_timestamp = None
+        self.invalidate_probes()
+        await self.start()
+
+    def record_crash(self) -> float:
+        """Records a crash and returns the delay before the next restart."""
+        now = time.time()
+        self.restart_count += 1
+        if self.start_timestamp and now - self.start_timestamp >= RESTART_STABLE_RUNTIME:
+            self.consecutive_crashes = 0
+        self.consecutive_crashes += 1
+        self._crash_times.append(now)
+        while self._crash_times[0] < now - CRASH_LOOP_WINDOW:
+            self._crash_times.popleft()
+
+        if len(self._crash_times) >= CRASH_LOOP_THRESHOLD:
+            self.state = STATE_CRASH_LOOPING
+            self._crash_times.clear()
+            return CRASH_LOOP_PARK_TIME
+
+        self.state = STATE_BACKOFF
+        delay = min(RESTART_BACKOFF_BASE * 2 ** (self.consecutive_crashes - 1), RESTART_BACKOFF_MAX)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _cancel_supervisor(self):
+        task, self._supervisor_task = self._supervisor_task, None
+        if task and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+
+    async def _reap(self, process: asyncio.subprocess.Process):
+        try:
+            await asyncio.wait_for(process.wait(), FFMPEG_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stream {self.id} ffmpeg did not exit after terminate, killing it", extra=self.log_extra)
+            process.kill()
+
+    def get_stats(self) -> dict:
+        return {
+            "state": self.state,
+            "mode": self.mode,
+            "encoder_profile": (
+                dataclasses.asdict(self.get_encoder_profile())
+                if self.is_transcoding() else None
+            ),
+            "decode_modes": self.decode_modes,
+            "encoder_group": self.group.id if self.group else None,
+            "priority": self.priority,
+            "qos_level": QOS_LEVEL_NAMES[self.qos_level],
+            # Usage of the whole group's ffmpeg for grouped streams
+            "resources": self.gateway.resources.get_usage(f"group:{self.group.id}" if self.group else self.id),
+            "restart_count": self.restart_count,
+            "errors": self.errors.get_stats(),
+            "consecutive_crashes": self.consecutive_crashes,
+            "exit_code": self.exit_code,
+            "next_restart_timestamp": self.next_restart_timestamp,
+            "encoder": self.telemetry.get_stats() if self.is_running() else None,
+        }
+
+    def is_alive(self):
+        if self.state in (STATE_BACKOFF, STATE_CRASH_LOOPING):
+            return False
+        if self.ffmpeg_process and self.ffmpeg_process.returncode is not None:
+            # Exited, the supervisor is collecting its output
+            return False
+        if self.is_stalled():
+            return False
+        return self.get_stale_frames_error() is None
+
+    def get_stale_frames_error(self) -> str | None:
+        """Why the backend's last frame timestamp marks the encoder as dead, None while it does not."""
+        # Judged as of the backend's last report, which must be from after the encoder's startup
+        report_time = self.last_frame_report_timestamp
+        if not self.start_timestamp or report_time - self.start_timestamp <= 150:
+            return None
+        if self.last_frame_timestamp and report_time - self.last_frame_timestamp <= 300:
+            return None
+        time_since_start = report_time - self.start_timestamp
+        error_msg = f"Last Frame received 120 seconds ago. Marking process as Not Alive."
+        if not self.last_frame_timestamp:
+            error_msg += f" [last_frame_timestamp=None, start_timestamp={self.start_timestamp}, time_since_start={time_since_start:.2f}s, report_time={report_time}]"
+        else:
+            time_since_last_frame = report_time - self.last_frame_timestamp
+            error_msg += f" [last_frame_timestamp={self.last_frame_timestamp}, time_since_last_frame={time_since_last_frame:.2f}s, start_timestamp={self.start_timestamp}, time_since_start={time_since_start:.2f}s, report_time={report_time}]"
+        return error_msg
+
+    def invalidate_probes(self):
+        for url in self.source_urls:
+            self.gateway.prober.cache.invalidate(url)
+
+    async def validate_source_urls(self):
+        with get_tracer().span("validate_source_urls"):
+            results = await self.gateway.prober.probe_many(self.source_urls)
+        previous = {status["url"]: status["valid"] for status in self.rtsp_status.values()}
         rtsp_status = {}
-        for index, url in enumerate(self.source_urls):
-            valid, output = self.check_rtsp(url)
-            rtsp_status[index] = {"url": url, "valid": valid, "output": output}
-            logger.info(f"Checking rtsp url: {url} - Results: valid -> {valid} | output -> {output}")
+        for index, result in enumerate(results):
+            rtsp_status[index] = {"url": result.url, "valid": result.valid, "output": result.output}
+            self.source_info[result.url] = result.info
+            # Only changes are logged, sources are re-checked on every reconcile
+            if not result.valid:
+                self.errors.add("invalid_source", f"RTSP URL {result.url} is invalid: {result.output}")
+            if previous.get(result.url) != result.valid:
+                logger.info(f"Checking rtsp url: {result.url} - Results: valid -> {result.valid} | output -> {result.output}", extra=self.log_extra)
         self.rtsp_status = rtsp_status
+        self.source_info = {url: info for url, info in self.source_info.items() if url in self.source_urls}
         self.valid_source_urls = [url["url"] for url in self.rtsp_status.values() if url["valid"]]
 
-    def check_rtsp(self, url):
+    def load_encoder_profiles(self, spec: str | dict | None):
+        """Validates the backend encoder profile once, falling back to the defaults when it is invalid."""
+        self.encoder_profile_spec = spec
         try:
-            output = subprocess.check_output(
-                [
-                    "ffprobe",
-                    "-rtsp_transport", "tcp",
-                    "-v", "error",
-                    "-select_streams", "v:0",
-                    "-show_entries", "stream=index,codec_name,codec_long_name,profile,pix_fmt,width,height,avg_frame_rate,r_frame_rate,bit_rate,level,color_range,color_space,color_transfer,color_primaries,nb_frames",
-                    "-of", "default=nokey=1:noprint_wrappers=1",
-                    url
-                ],
-                stderr=subprocess.STDOUT
+            self.encoder_profiles = {
+                MODE_TRANSCODE: resolve_encoder_profile(spec, "single"),
+                MODE_MOSAIC: resolve_encoder_profile(spec, "mosaic"),
+            }
+        except ValueError as e:
+            logger.error(f"Invalid encoder profile for stream {self.id}: {e}. Using defaults.", extra=self.log_extra)
+            self.errors.add("invalid_encoder_profile", str(e))
+            self.encoder_profiles = {
+                MODE_TRANSCODE: ENCODER_PRESETS["single"],
+                MODE_MOSAIC: ENCODER_PRESETS["mosaic"],
+            }
+
+    def load_layout(self, spec: str | dict | None):
+        """Validates the backend mosaic layout once, falling back to an automatic grid when it is invalid."""
+        self.layout_spec = spec
+        self.layout = None
+        if spec is None:
+            return
+        try:
+            self.layout = MosaicLayout.parse(spec)
+        except ValueError as e:
+            logger.error(f"Invalid layout for stream {self.id}: {e}. Using automatic layout.", extra=self.log_extra)
+            self.errors.add("invalid_layout", str(e))
+
+    def mosaic_layout(self) -> MosaicLayout:
+        count = len(self.active_source_urls())
+        if self.layout is None:
+            return MosaicLayout.for_count(count)
+        if self.layout.capacity < count:
+            logger.warning(
+                f"Layout {self.layout.rows}x{self.layout.cols} of stream {self.id} has no room for "
+                f"{count} sources. Using automatic layout.",
+                extra=self.log_extra,
+            )
+            return MosaicLayout.for_count(count)
+        return self.layout
+
+    def is_transcoding(self) -> bool:
+        return self.mode in (MODE_TRANSCODE, MODE_MOSAIC)
+
+    def base_encoder_profile(self) -> EncoderProfile:
+        return self.encoder_profiles[MODE_MOSAIC if self.mode == MODE_MOSAIC else MODE_TRANSCODE]
+
+    def get_encoder_profile(self) -> EncoderProfile:
+        """Returns the profile to encode with, including the bitrate controller's target and the QoS level."""
+        profile = self.base_encoder_profile()
+        target = self.rate_target
+        if target is not None:
+            ratio = target.bitrate / profile.bitrate
+            profile = dataclasses.replace(
+                profile,
+                bitrate=target.bitrate,
+                maxrate=int(profile.maxrate * ratio) // 1000 * 1000 if profile.maxrate else (
+                    target.bitrate if profile.rate_control == "crf" else None
+                ),
+                bufsize=int(profile.bufsize * ratio) // 1000 * 1000 if profile.bufsize else None,
+                fps=target.fps,
+            )
+        if self.qos_level >= QOS_REDUCED_FPS:
+            profile = dataclasses.replace(
+                profile, fps=max(BITRATE_MIN_FPS, round(profile.fps * QOS_FPS_FACTOR, 1))
+            )
+        if self.qos_level >= QOS_REDUCED_RESOLUTION:
+            profile = dataclasses.replace(
+                profile,
+                width=int(profile.width * QOS_RESOLUTION_FACTOR) // 2 * 2,
+                height=int(profile.height * QOS_RESOLUTION_FACTOR) // 2 * 2,
             )
-            return True, output.decode().strip()
-        except subprocess.CalledProcessError as e:
-            return False, e.output.decode().strip()
+        return profile
+
+    def input_args(self, url: str) -> list[str]:
+        local_url = self.input_urls.get(url)
+        if local_url:
+            return ["-f", "mpegts", "-i", local_url]
+        return ["-rtsp_transport", "tcp", "-i", url]
+
+    def update_decode_modes(self, profile: EncoderProfile):
+        self.decode_modes = {
+            url: select_decode_mode(self.source_info.get(url, {}), profile.fps)
+            for url in self.active_source_urls()
+        } if self.is_transcoding() else {}
+
+    def transcode_filter(self, profile: EncoderProfile) -> str:
+        """Video filter of a single-source transcode."""
+        video_filter = f"scale={profile.width}:{profile.height}:force_original_aspect_ratio=decrease:force_divisible_by=2,format=yuv420p"
+        if self.decode_modes.get(self.active_source_urls()[0]) not in (None, DECODE_FULL):
+            # Drop frames before they are scaled
+            video_filter = f"fps={profile.fps:g},{video_filter}"
+        return video_filter
 
     def build_ffmpeg_cmd(self):
-        logger.info(f"Building ffmpeg command for stream: {self.id} and urls: {self.valid_source_urls}")
-        source_urls = self.valid_source_urls
+        profile = self.get_encoder_profile()
+        layout = self.mosaic_layout() if self.mode == MODE_MOSAIC else None
+        self.update_decode_modes(profile)
+        cache_key = (
+            self.mode, tuple(self.active_source_urls()), self.stream_url, profile, layout,
+            tuple(self.decode_modes.values()), tuple(self.input_urls.items()),
+        )
+        if self._ffmpeg_cmd_cache and self._ffmpeg_cmd_cache[0] == cache_key:
+            return list(self._ffmpeg_cmd_cache[1])
+
+        source_urls = self.active_source_urls()
+        logger.info(f"Building ffmpeg command for stream: {self.id} and urls: {source_urls}", extra=self.log_extra)
         url_count = len(source_urls)
 
-        if url_count == 1:
-            # For single URL, just relay the stream as is
+        if self.mode == MODE_PASSTHROUGH:
+            # Source already meets the output constraints, relay it without decoding
             ffmpeg_cmd = [
                 "ffmpeg",
-                "-rtsp_transport", "tcp",
+                "-nostats",
+                "-progress", "pipe:1",
+                "-loglevel", "error",
+                "-fflags", "+genpts",
+                "-thread_queue_size", "4096",
+                *self.input_args(source_urls[0]),
+                "-map", "0:v:0",
+                "-c:v", "copy",
+                "-an",
+                "-f", "rtsp",
+                self.stream_url,
+            ]
+        elif url_count == 1:
+            ffmpeg_cmd = [
+                "ffmpeg",
+                "-nostats",
+                "-progress", "pipe:1",
                 "-loglevel", "error",
                 "-fflags", "genpts",
                 "-flags", "low_delay",
                 "-thread_queue_size", "4096",
-                "-i", source_urls[0],
-                "-vf", "scale=1280:720:force_original_aspect_ratio=decrease:force_divisible_by=2,format=yuv420p",
-                "-c:v", "libx264",
-                "-r", "2",
-                "-preset", "veryfast",
-                "-tune", "zerolatency",
-                "-b:v", "500k",
-                "-maxrate", "600k",
-                "-bufsize", "1000k",
+                *decode_input_args(self.decode_modes[source_urls[0]]),
+                *self.input_args(source_urls[0]),
+                "-vf", self.transcode_filter(profile),
+                *profile.encoder_args(),
                 "-an",  # disable audio explicitly
                 "-f", "rtsp",
                 self.stream_url,
             ]
         else:
-            # For 2-4 URLs, create a 2x2 grid
-            ffmpeg_cmd = ["ffmpeg", "-re", "-rtsp_transport", "tcp"]
-
-            # Add inputs for available URLs
-            for i in range(min(url_count, 4)):
-                ffmpeg_cmd.extend(["-thread_queue_size", "512", "-i", source_urls[i]])
-
-            # Add black inputs for missing URLs
-            for i in range(url_count, 4):
-                ffmpeg_cmd.extend(["-f", "lavfi", "-i", "color=c=black:s=960x540"])
-
-            # Build filter complex
-            filter_complex = (
-                "[0:v]scale=960:540[v1];"
-                "[1:v]scale=960:540[v2];"
-                "[2:v]scale=960:540[v3];"
-                "[3:v]scale=960:540[v4];"
-                "[v1][v2][v3][v4]xstack=inputs=4:layout=0_0|w0_0|0_h0|w0_h0[out]"
-            )
+            ffmpeg_cmd = ["ffmpeg", "-nostats", "-progress", "pipe:1", "-re"]
+            for url in source_urls:
+                ffmpeg_cmd.extend(["-thread_queue_size", "512", *decode_input_args(self.decode_modes[url]), *self.input_args(url)])
+
+            filter_complex = build_mosaic_filter([f"{index}:v" for index in range(url_count)], layout, profile.width, profile.height, profile.fps)
 
             ffmpeg_cmd.extend(
                 [
@@ -195,28 +677,16 @@ class StreamHandler:
                     filter_complex,
                     "-map",
                     "[out]",
-                    "-r",
-                    "15",
                     "-pix_fmt",
                     "yuv420p",
-                    "-preset",
-                    "ultrafast",
                     "-vsync",
                     "2",
-                    "-b:v",
-                    "500k",
-                    "-maxrate",
-                    "600k",
-                    "-bufsize",
-                    "1000k",
-                    "-vcodec",
-                    "libx264",
-                    "-tune",
-                    "zerolatency",
+                    *profile.encoder_args(),
                     "-f",
                     "rtsp",
                     self.stream_url,
                 ]
             )
 
-        return ffmpeg_cmd
+        self._ffmpeg_cmd_cache = (cache_key, ffmpeg_cmd)
+        return list(ffmpeg_cmd)
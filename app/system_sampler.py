@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import cache
+
+import psutil
+
+from .config import SYSTEM_SAMPLE_HISTORY, SYSTEM_SAMPLE_INTERVAL
+from .logs import logger
+from .network_utils import get_active_interfaces, get_tcp_counters, get_tcp_send_queue_bytes
+
+
+@dataclass
+class SystemSample:
+    timestamp: float
+    cpu_usage: float
+    memory_usage: float
+    disk_usage: float
+    # {interface: {"tx_bps": float, "rx_bps": float}}
+    interfaces: dict[str, dict[str, float]] = field(default_factory=dict)
+    # Share of TCP segments retransmitted during the interval, None if unknown
+    tcp_retransmit_ratio: float | None = None
+    tcp_send_queue: int = 0
+
+    @property
+    def tx_bps(self) -> float:
+        return sum(rates["tx_bps"] for rates in self.interfaces.values())
+
+    @property
+    def rx_bps(self) -> float:
+        return sum(rates["rx_bps"] for rates in self.interfaces.values())
+
+
+class SystemSampler(threading.Thread):
+    """
+    Samples CPU, memory, disk and per-interface TX/RX rates at a fixed cadence
+    into a ring buffer, so readers never block on a measurement interval.
+    """
+
+    def __init__(self, interval: float = SYSTEM_SAMPLE_INTERVAL, history: int = SYSTEM_SAMPLE_HISTORY):
+        super().__init__(name="system-sampler", daemon=True)
+        self.interval: float = interval
+        self._samples: deque[SystemSample] = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last_counters: dict[str, tuple[int, int]] = {}
+        self._last_counters_timestamp: float = 0.0
+        self._last_tcp_counters: tuple[int, int] | None = None
+
+    def run(self):
+        # Prime the cpu_percent and byte counter baselines
+        psutil.cpu_percent()
+        self._read_interface_rates()
+        self._read_tcp_retransmit_ratio()
+        while not self._stop_event.wait(self.interval):
+            try:
+                sample = self._take_sample()
+            except Exception as e:
+                logger.error(f"Failed to sample system metrics: {e}")
+                continue
+            with self._lock:
+                self._samples.append(sample)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def latest(self) -> SystemSample | None:
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def samples(self, window: float | None = None) -> list[SystemSample]:
+        with self._lock:
+            samples = list(self._samples)
+        if window is None:
+            return samples
+        since = time.time() - window
+        return [sample for sample in samples if sample.timestamp >= since]
+
+    def averages(self, window: float) -> dict:
+        samples = self.samples(window)
+        if not samples:
+            return {}
+        count = len(samples)
+        return {
+            "window": window,
+            "samples": count,
+            "cpu_usage": sum(s.cpu_usage for s in samples) / count,
+            "memory_usage": sum(s.memory_usage for s in samples) / count,
+            "disk_usage": sum(s.disk_usage for s in samples) / count,
+            "upload_bitrate": sum(s.tx_bps for s in samples) / count / 1_000_000,
+            "download_bitrate": sum(s.rx_bps for s in samples) / count / 1_000_000,
+        }
+
+    def _take_sample(self) -> SystemSample:
+        return SystemSample(
+            timestamp=time.time(),
+            cpu_usage=psutil.cpu_percent(),
+            memory_usage=psutil.virtual_memory().percent,
+            disk_usage=psutil.disk_usage("/").percent,
+            interfaces=self._read_interface_rates(),
+            tcp_retransmit_ratio=self._read_tcp_retransmit_ratio(),
+            tcp_send_queue=get_tcp_send_queue_bytes(),
+        )
+
+    def _read_tcp_retransmit_ratio(self) -> float | None:
+        counters = get_tcp_counters()
+        previous, self._last_tcp_counters = self._last_tcp_counters, counters
+        if counters is None or previous is None:
+            return None
+        out_segs = counters[0] - previous[0]
+        retrans_segs = counters[1] - previous[1]
+        if out_segs <= 0:
+            return 0.0
+        return max(retrans_segs, 0) / out_segs
+
+    def _read_interface_rates(self) -> dict[str, dict[str, float]]:
+        now = time.monotonic()
+        elapsed = now - self._last_counters_timestamp
+        counters = psutil.net_io_counters(pernic=True)
+        current = {
+            iface: (counters[iface].bytes_sent, counters[iface].bytes_recv)
+            for iface in get_active_interfaces()
+            if iface in counters
+        }
+        rates = {}
+        for iface, (sent, recv) in current.items():
+            previous = self._last_counters.get(iface)
+            if previous is None or elapsed <= 0:
+                continue
+            rates[iface] = {
+                "tx_bps": max(sent - previous[0], 0) * 8 / elapsed,
+                "rx_bps": max(recv - previous[1], 0) * 8 / elapsed,
+            }
+        self._last_counters = current
+        self._last_counters_timestamp = now
+        return rates
+
+
+@cache
+def get_system_sampler() -> SystemSampler:
+    sampler = SystemSampler()
+    sampler.start()
+    return sampler
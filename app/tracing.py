@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import cache
+
+from .config import (
+    LOOP_LAG_INTERVAL,
+    PROFILE_COOLDOWN,
+    PROFILE_DIR,
+    PROFILE_DURATION,
+    PROFILE_LAG_THRESHOLD,
+    PROFILE_SAMPLE_INTERVAL,
+    TRACE_WINDOW,
+)
+from .logs import logger
+
+LOOP_LAG_SPAN = "event_loop_lag"
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval and writes the counts in
+    collapsed format (`frame;frame;frame count` per line), as read by flamegraph tools.
+    """
+
+    def __init__(self, thread_id: int, path: str, duration: float, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id: int = thread_id
+        self.path: str = path
+        self.duration: float = duration
+        self.interval: float = interval
+        self.stacks: Counter[str] = Counter()
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        try:
+            with open(self.path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.warning(f"Failed to write profile {self.path}: {e}")
+            return
+        logger.info(f"Wrote {sum(self.stacks.values())} stack samples to {self.path}")
+
+
+class Tracer:
+    """
+    Rolling timings of named spans of the gateway's hot paths.
+    - The last `window` durations of every span are kept, reported as p50/p95/max
+    - Event loop lag is measured by a task that oversleeps when the loop is blocked
+    - A stack sampler of the loop thread can be started on demand to see where the time goes
+    """
+
+    def __init__(self, window: int = TRACE_WINDOW):
+        self.window: int = window
+        self.durations: dict[str, deque[float]] = {}
+        self.counts: Counter[str] = Counter()
+        self.profiler: StackSampler | None = None
+        self.last_profile_timestamp: float = 0.0
+        self._loop_thread_id: int | None = None
+        self._lag_task: asyncio.Task | None = None
+
+    @contextmanager
+    def span(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name: str, seconds: float):
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations[name] = deque(maxlen=self.window)
+        durations.append(seconds)
+        self.counts[name] += 1
+
+    def start_loop_monitor(self):
+        """Starts measuring the lag of the running event loop."""
+        self._loop_thread_id = threading.get_ident()
+        if self._lag_task is None or self._lag_task.done():
+            self._lag_task = asyncio.create_task(self._monitor_loop_lag())
+
+    def stop_loop_monitor(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def _monitor_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            self.record(LOOP_LAG_SPAN, lag)
+            if (
+                PROFILE_LAG_THRESHOLD
+                and lag >= PROFILE_LAG_THRESHOLD
+                and time.time() - self.last_profile_timestamp >= PROFILE_COOLDOWN
+            ):
+                logger.warning(f"Event loop blocked for {lag:.2f}s, profiling it")
+                self.start_profile()
+
+    def start_profile(self, duration: float = PROFILE_DURATION) -> str | None:
+        """Starts sampling the event loop thread, returns the file the samples are written to."""
+        if self.profiler and self.profiler.is_alive():
+            return None
+        thread_id = self._loop_thread_id or threading.main_thread().ident
+        path = os.path.join(PROFILE_DIR, f"streambox-profile-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        self.profiler = StackSampler(thread_id, path, duration, PROFILE_SAMPLE_INTERVAL)
+        self.profiler.start()
+        self.last_profile_timestamp = time.time()
+        logger.info(f"Profiling the event loop for {duration:.0f}s into {path}")
+        return path
+
+    def get_report(self) -> dict:
+        report = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            report[name] = {
+                "count": self.counts[name],
+                "p50": round(ordered[len(ordered) // 2], 4),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+                "max": round(ordered[-1], 4),
+            }
+        return report
+
+
+@cache
+def get_tracer() -> Tracer:
+    return Tracer()
@@ -3,7 +3,9 @@ import uuid
 import psutil
 import socket
 from functools import cache
-from .network_utils import get_upload_bitrate, get_cached_network_speedtest
+from .capacity import get_capacity_estimator
+from .config import CAPACITY_WINDOW, SYSTEM_AVERAGE_WINDOW
+from .system_sampler import get_system_sampler
 
 @cache
 def get_device_id():
@@ -37,23 +39,39 @@ def get_memory_usage():
 def get_disk_usage():
     return psutil.disk_usage('/').percent
 
-def get_system_info():
+def get_system_info(stream_bps: dict[str, float] | None = None):
+    sampler = get_system_sampler()
+    sample = sampler.latest()
+    if sample is None:
+        # The sampler has not completed its first interval yet
+        return {
+            "cpu_usage": get_cpu_usage(),
+            "memory_usage": get_memory_usage(),
+            "disk_usage": get_disk_usage(),
+            "network_info": get_network_info(stream_bps),
+        }
     return {
-        "cpu_usage": get_cpu_usage(),
-        "memory_usage": get_memory_usage(),
-        "disk_usage": get_disk_usage(),
-        "network_info": get_network_info(),
+        "cpu_usage": sample.cpu_usage,
+        "memory_usage": sample.memory_usage,
+        "disk_usage": sample.disk_usage,
+        "network_info": get_network_info(stream_bps),
+        "averages": sampler.averages(SYSTEM_AVERAGE_WINDOW),
     }
 
-def get_network_info():
-    upload_bitrate = get_upload_bitrate(2)
-    network_speed = get_cached_network_speedtest()
-    upload_speed = network_speed["upload_mbps"] if network_speed else 0
-    download_speed = network_speed["download_mbps"] if network_speed else 0
+def get_network_info(stream_bps: dict[str, float] | None = None):
+    sampler = get_system_sampler()
+    sample = sampler.latest()
+    estimator = get_capacity_estimator()
+    capacity = estimator.update(sampler.samples(CAPACITY_WINDOW), stream_bps)
+    upload_bitrate = sample.tx_bps / 1_000_000 if sample else 0
+    upload_speed = capacity.get("upload_capacity_mbps", 0)
+    download_speed = estimator.calibration["download_mbps"] if estimator.calibration else 0
     return {
         "upload_speed": upload_speed,
         "download_speed": download_speed,
         "upload_bitrate": upload_bitrate,
+        "interfaces": sample.interfaces if sample else {},
+        "capacity": capacity,
     }
 
 if __name__ == "__main__":
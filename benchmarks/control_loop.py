@@ -0,0 +1,162 @@
+"""
+Where the gateway's control loop stops scaling, measured against the mock backend.
+
+Starts benchmarks.mock_backend in a separate process and points a GatewayService
+at it. The gateway then polls it like the service does, with hundreds of stub
+stream handlers. Stub handlers skip ffprobe and run a shell loop printing ffmpeg
+progress instead of ffmpeg, so only the gateway's own work is measured: diffing,
+command building, process spawns, supervision and heartbeats.
+
+It reports the following as JSON:
+- reconcile latency per poll: the full stream_info round trip, and the time to
+  apply the response
+- event loop lag
+- heartbeat size on the wire
+
+    python -m benchmarks.control_loop --streams 500 --polls 20 --churn 0.05 --flap 0.02 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_cameras import wait_for_port  # noqa: E402
+from benchmarks.mock_backend import STREAM_INFO_PATH, add_backend_arguments, backend_argv  # noqa: E402
+
+# Advances its frame counter every second, like a healthy low-fps encoder
+STUB_ENCODER = ["sh", "-c", 'i=0; while :; do i=$((i+1)); printf "frame=%d\\nprogress=continue\\n" "$i"; sleep 1 >/dev/null 2>&1; done']
+STUB_SOURCE_INFO = {"codec_name": "h264", "pix_fmt": "yuv420p", "width": 1280, "height": 720, "avg_frame_rate": "25/1"}
+LAG_INTERVAL = 0.05
+
+
+def summarize(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    ordered = sorted(values)
+    return {
+        "p50": round(statistics.median(ordered), 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+async def measure_loop_lag(lags: list[float]):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - started - LAG_INTERVAL))
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # The backend URL is read from the environment when the app's config is imported
+    from app import stream_handler
+    from app.gateway import GatewayService
+
+    class StubStreamHandler(stream_handler.StreamHandler):
+        async def validate_source_urls(self):
+            self.rtsp_status = {
+                index: {"url": url, "valid": True, "output": "stub"} for index, url in enumerate(self.source_urls)
+            }
+            self.source_info = {url: dict(STUB_SOURCE_INFO) for url in self.source_urls}
+            self.valid_source_urls = list(self.source_urls)
+
+        def build_ffmpeg_cmd(self):
+            # Built anyway, its cost is part of the control loop
+            super().build_ffmpeg_cmd()
+            return list(STUB_ENCODER)
+
+    # The gateway creates its handlers through this module attribute
+    stream_handler.StreamHandler = StubStreamHandler
+
+    gateway = GatewayService(asyncio.Event())
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(lags))
+    polls = []
+    try:
+        async with httpx.AsyncClient() as client:
+            for poll in range(args.polls):
+                lag_start = len(lags)
+                reconciles = gateway.reconcile_duration.sum
+                started = time.monotonic()
+                await gateway.update_stream_handlers()
+                elapsed = time.monotonic() - started
+                stats = (await client.get(f"{args.backend}/stats")).json()
+                polls.append({
+                    "poll": poll,
+                    "seconds": round(elapsed, 4),
+                    "reconcile_seconds": round(gateway.reconcile_duration.sum - reconciles, 4),
+                    "handlers": len(gateway.stream_handlers),
+                    "running": sum(handler.is_running() for handler in gateway.stream_handlers.values()),
+                    "heartbeat_bytes": stats["last_body_bytes"],
+                    "heartbeat_decoded_bytes": stats["last_decoded_bytes"],
+                    "max_loop_lag": round(max(lags[lag_start:], default=0.0), 4),
+                })
+                # The per-second work of GatewayService.start between polls
+                deadline = time.monotonic() + args.interval
+                while time.monotonic() < deadline:
+                    gateway.abort_stalled_encoders()
+                    gateway.resources.update(gateway.get_owned_processes())
+                    await asyncio.sleep(1)
+            stats = (await client.get(f"{args.backend}/stats")).json()
+    finally:
+        lag_task.cancel()
+        await gateway.shutdown()
+        # Let the terminated stub encoders be reaped before the loop closes
+        reaping = asyncio.all_tasks() - {asyncio.current_task()}
+        if reaping:
+            await asyncio.wait(reaping, timeout=10.0)
+        await asyncio.sleep(0.5)
+
+    return {
+        "backend": stats,
+        "poll_seconds": summarize([poll["seconds"] for poll in polls]),
+        "reconcile_seconds": summarize([poll["reconcile_seconds"] for poll in polls]),
+        "loop_lag_seconds": summarize(lags),
+        "max_handlers": max((poll["handlers"] for poll in polls), default=0),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "polls": polls,
+    }
+
+
+async def main_async(args: argparse.Namespace) -> dict:
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_backend", "--port", str(args.port), *backend_argv(args)],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        await wait_for_port(args.port, 10.0)
+        return await run(args)
+    finally:
+        backend.terminate()
+        backend.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765, help="mock backend port")
+    parser.add_argument("--polls", type=int, default=10, help="stream_info polls to run")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between polls")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    args.backend = f"http://127.0.0.1:{args.port}"
+    os.environ["STREAMBOX_STREAM_INFO_URL"] = f"{args.backend}{STREAM_INFO_PATH}"
+
+    result = asyncio.run(main_async(args))
+    json.dump({"settings": vars(args), **result}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+CPU cost of a single-source transcode for each decode mode.
+
+Encodes a synthetic camera clip and transcodes it once per decode mode, with
+the ffmpeg command StreamHandler builds for it. Reports the CPU time per second
+of video, i.e. the share of one core a live stream of that source would use.
+
+    python -m benchmarks.decode_modes --size 1920x1080 --fps 25 --gop 25
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.gateway import GatewayService  # noqa: E402
+from app.stream_handler import (  # noqa: E402
+    DECODE_DECIMATE,
+    DECODE_FULL,
+    DECODE_KEYFRAMES,
+    MODE_TRANSCODE,
+    StreamHandler,
+)
+
+
+class FileStreamHandler(StreamHandler):
+    """Stream handler transcoding a local file with a fixed decode mode instead of the probed one."""
+
+    def __init__(self, gateway: GatewayService, source: str, decode_mode: str):
+        super().__init__(gateway, {
+            "stream_id": f"decode-{decode_mode}",
+            "stream_url": "-",
+            "status": "active",
+            "source_urls": [source],
+            "last_frame_timestamp": None,
+        })
+        self.valid_source_urls = [source]
+        self.mode = MODE_TRANSCODE
+        self.decode_mode = decode_mode
+
+    def update_decode_modes(self, profile):
+        self.decode_modes = {url: self.decode_mode for url in self.active_source_urls()}
+
+    def input_args(self, url: str) -> list[str]:
+        return ["-i", url]
+
+
+def make_source(path: str, size: str, fps: int, gop: int, duration: float):
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}",
+            "-t", str(duration),
+            "-c:v", "libx264", "-preset", "ultrafast", "-g", str(gop), "-keyint_min", str(gop),
+            "-pix_fmt", "yuv420p",
+            path,
+        ],
+        check=True,
+    )
+
+
+def transcode_cmd(gateway: GatewayService, source: str, decode_mode: str) -> list[str]:
+    """The command StreamHandler.build_ffmpeg_cmd runs for a single-source transcode, with a null output."""
+    cmd = FileStreamHandler(gateway, source, decode_mode).build_ffmpeg_cmd()
+    assert cmd[-3:] == ["-f", "rtsp", "-"], cmd[-3:]
+    return [*cmd[:-3], "-f", "null", "-"]
+
+
+def run(cmd: list[str]) -> tuple[float, float]:
+    """Returns the CPU seconds and wall seconds used by `cmd`."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    # Progress lines on stdout are not needed here
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    wall = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="1920x1080", help="source resolution")
+    parser.add_argument("--fps", type=int, default=25, help="source frame rate")
+    parser.add_argument("--gop", type=int, default=25, help="source keyframe interval in frames")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of video to transcode")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per mode, the fastest is reported")
+    args = parser.parse_args()
+
+    gateway = GatewayService(asyncio.Event())
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.mp4")
+        make_source(source, args.size, args.fps, args.gop, args.duration)
+        for decode_mode in (DECODE_FULL, DECODE_DECIMATE, DECODE_KEYFRAMES):
+            cpu, wall = min(run(transcode_cmd(gateway, source, decode_mode)) for _ in range(args.repeat))
+            results.append({
+                "decode_mode": decode_mode,
+                "cpu_seconds": round(cpu, 3),
+                "wall_seconds": round(wall, 3),
+                # Share of one core used by a live stream of this source
+                "cpu_percent_per_stream": round(100 * cpu / args.duration, 2),
+            })
+
+    json.dump(
+        {
+            "source": {"size": args.size, "fps": args.fps, "gop": args.gop, "duration": args.duration},
+            "results": results,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Local RTSP stand-in with synthetic cameras, for benchmarks that need live sources.
+
+An RTSP server (mediamtx by default, the server used in local.txt) is started on
+a local port and every fake camera is an ffmpeg publishing a lavfi test pattern
+to it in real time. Without --server, the cameras publish to an RTSP server that
+is already running on --port.
+
+    python -m benchmarks.fake_cameras --cameras 4 --size 1920x1080 --fps 25
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+
+HOST = "127.0.0.1"
+SERVER_STARTUP_TIMEOUT = 10.0
+PATTERNS = ("testsrc2", "smptehdbars", "mandelbrot", "rgbtestsrc")
+
+
+class RtspServer:
+    """A mediamtx process serving every path that is published to it."""
+
+    def __init__(self, binary: str = "mediamtx", port: int = 8554):
+        self.binary: str = binary
+        self.port: int = port
+        self.process: asyncio.subprocess.Process | None = None
+        self._config_dir: tempfile.TemporaryDirectory | None = None
+
+    async def start(self):
+        if shutil.which(self.binary) is None:
+            raise RuntimeError(f"RTSP server {self.binary!r} not found, install mediamtx or pass --server")
+        self._config_dir = tempfile.TemporaryDirectory()
+        config = os.path.join(self._config_dir.name, "mediamtx.yml")
+        with open(config, "w") as f:
+            f.write(
+                "logLevel: warn\n"
+                f"rtspAddress: {HOST}:{self.port}\n"
+                "rtmp: no\nhls: no\nwebrtc: no\nsrt: no\n"
+                "paths:\n  all_others:\n"
+            )
+        self.process = await asyncio.create_subprocess_exec(self.binary, config, stdout=asyncio.subprocess.DEVNULL)
+        await wait_for_port(self.port, SERVER_STARTUP_TIMEOUT)
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+        if self._config_dir:
+            self._config_dir.cleanup()
+
+
+class FakeCamera:
+    """An ffmpeg publishing a synthetic H.264 stream at its native rate, like an IP camera."""
+
+    def __init__(self, url: str, size: str, fps: int, gop: int, pattern: str = "testsrc2"):
+        self.url: str = url
+        self.size: str = size
+        self.fps: int = fps
+        self.gop: int = gop
+        self.pattern: str = pattern
+        self.process: asyncio.subprocess.Process | None = None
+
+    def cmd(self) -> list[str]:
+        return [
+            "ffmpeg", "-nostats", "-loglevel", "error",
+            "-re", "-f", "lavfi", "-i", f"{self.pattern}=size={self.size}:rate={self.fps}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency",
+            "-g", str(self.gop), "-keyint_min", str(self.gop), "-pix_fmt", "yuv420p",
+            "-f", "rtsp", "-rtsp_transport", "tcp", self.url,
+        ]
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd(), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL
+        )
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+
+class FakeCameras:
+    """
+    Starts the RTSP stand-in and `count` cameras, and yields their URLs.
+
+        async with FakeCameras(4) as urls:
+            ...
+    """
+
+    def __init__(
+        self,
+        count: int,
+        size: str = "1280x720",
+        fps: int = 25,
+        gop: int = 50,
+        server: str | None = "mediamtx",
+        port: int = 8554,
+        warmup: float = 3.0,
+    ):
+        self.server: RtspServer | None = RtspServer(server, port) if server else None
+        self.port: int = port
+        self.warmup: float = warmup
+        self.cameras: list[FakeCamera] = [
+            FakeCamera(f"rtsp://{HOST}:{port}/cam{index}", size, fps, gop, PATTERNS[index % len(PATTERNS)])
+            for index in range(count)
+        ]
+
+    @property
+    def urls(self) -> list[str]:
+        return [camera.url for camera in self.cameras]
+
+    def output_url(self, name: str) -> str:
+        return f"rtsp://{HOST}:{self.port}/{name}"
+
+    async def __aenter__(self) -> list[str]:
+        if self.server:
+            await self.server.start()
+        await asyncio.gather(*(camera.start() for camera in self.cameras))
+        # Give the encoders time to publish their first keyframe
+        await asyncio.sleep(self.warmup)
+        return self.urls
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.gather(*(camera.stop() for camera in self.cameras))
+        if self.server:
+            await self.server.stop()
+
+
+async def wait_for_port(port: int, timeout: float):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            with socket.create_connection((HOST, port), timeout=0.5):
+                return
+        except OSError:
+            if loop.time() >= deadline:
+                raise RuntimeError(f"Nothing listening on {HOST}:{port} after {timeout:.0f}s")
+            await asyncio.sleep(0.2)
+
+
+async def serve(args: argparse.Namespace):
+    async with FakeCameras(args.cameras, args.size, args.fps, args.gop, args.server, args.port) as urls:
+        for url in urls:
+            print(url, flush=True)
+        await asyncio.Event().wait()
+
+
+def add_camera_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--size", default="1280x720", help="camera resolution")
+    parser.add_argument("--fps", type=int, default=25, help="camera frame rate")
+    parser.add_argument("--gop", type=int, default=50, help="camera keyframe interval in frames")
+    parser.add_argument("--server", default="mediamtx", help="RTSP server binary, empty to use a running server")
+    parser.add_argument("--port", type=int, default=8554, help="RTSP server port")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cameras", type=int, default=4, help="number of fake cameras")
+    add_camera_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Local stand-in for the stream_info backend, serving scripted stream configs.
+
+Answers POST /api/v1/devices/stream_info like the real service, including
+ETag / If-None-Match and the X-Last-Frame-Timestamps header on a 304, with a
+config that changes as scripted:
+
+    --churn      fraction of streams replaced by new ones every --churn-every polls
+    --flap       fraction of streams whose status toggles between active and inactive every poll
+    --delay      seconds before every response, plus up to --jitter more
+    --error-rate share of requests answered with a 503
+
+GET /stats returns request counts and heartbeat sizes as JSON. Point a gateway
+at it with STREAMBOX_STREAM_INFO_URL=http://127.0.0.1:8765/api/v1/devices/stream_info.
+
+    python -m benchmarks.mock_backend --streams 200 --churn 0.05 --error-rate 0.1
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STREAM_INFO_PATH = "/api/v1/devices/stream_info"
+
+
+class ScriptedStreams:
+    """The stream config served to the gateway, advanced by one step per poll."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args: argparse.Namespace = args
+        self.random: random.Random = random.Random(args.seed)
+        self.next_id: int = 0
+        self.polls: int = 0
+        self.streams: list[dict] = [self._new_stream() for _ in range(args.streams)]
+        self.lock: threading.Lock = threading.Lock()
+
+    def _new_stream(self) -> dict:
+        stream_id = f"stream-{self.next_id}"
+        self.next_id += 1
+        return {
+            "stream_id": stream_id,
+            "stream_url": f"rtsp://127.0.0.1:8554/{stream_id}",
+            "status": "active",
+            "source_urls": [
+                f"rtsp://127.0.0.1:8554/cam{self.random.randrange(self.args.cameras)}"
+                for _ in range(self.args.sources_per_stream)
+            ],
+            "last_frame_timestamp": None,
+        }
+
+    def advance(self) -> list[dict]:
+        """Applies one poll worth of churn and flapping and returns the streams to serve."""
+        with self.lock:
+            self.polls += 1
+            if self.args.churn and self.polls % self.args.churn_every == 0:
+                for index in self.random.sample(range(len(self.streams)), round(len(self.streams) * self.args.churn)):
+                    self.streams[index] = self._new_stream()
+            if self.args.flap:
+                for stream in self.random.sample(self.streams, round(len(self.streams) * self.args.flap)):
+                    stream["status"] = "inactive" if stream["status"] == "active" else "active"
+            now = time.time()
+            for stream in self.streams:
+                stream["last_frame_timestamp"] = now
+            return [dict(stream) for stream in self.streams]
+
+
+def config_version(streams: list[dict]) -> str:
+    """Version of the config, runtime fields such as last_frame_timestamp excluded."""
+    config = [{key: value for key, value in stream.items() if key != "last_frame_timestamp"} for stream in streams]
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class Stats:
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.requests: int = 0
+        self.errors: int = 0
+        self.not_modified: int = 0
+        self.body_bytes: list[int] = []
+        self.decoded_bytes: list[int] = []
+
+    def get_report(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "not_modified": self.not_modified,
+                "last_body_bytes": self.body_bytes[-1] if self.body_bytes else None,
+                "max_body_bytes": max(self.body_bytes, default=None),
+                "mean_body_bytes": round(sum(self.body_bytes) / len(self.body_bytes)) if self.body_bytes else None,
+                "last_decoded_bytes": self.decoded_bytes[-1] if self.decoded_bytes else None,
+                "max_decoded_bytes": max(self.decoded_bytes, default=None),
+            }
+
+
+def make_handler(streams: ScriptedStreams, stats: Stats, args: argparse.Namespace):
+    class StreamInfoHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            pass
+
+        def _send(self, status: int, body: bytes = b"", headers: dict[str, str] | None = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._send(404)
+            self._send(200, json.dumps(stats.get_report()).encode(), {"Content-Type": "application/json"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path != STREAM_INFO_PATH:
+                return self._send(404)
+            decoded = gzip.decompress(body) if self.headers.get("Content-Encoding") == "gzip" else body
+            with stats.lock:
+                stats.requests += 1
+                stats.body_bytes.append(len(body))
+                # zstd bodies are counted compressed
+                stats.decoded_bytes.append(len(decoded))
+
+            time.sleep(args.delay + random.uniform(0, args.jitter))
+            if random.random() < args.error_rate:
+                with stats.lock:
+                    stats.errors += 1
+                return self._send(503)
+
+            served = streams.advance()
+            version = config_version(served)
+            if self.headers.get("If-None-Match") == version:
+                with stats.lock:
+                    stats.not_modified += 1
+                last_frame_timestamps = {stream["stream_id"]: stream["last_frame_timestamp"] for stream in served}
+                return self._send(304, headers={
+                    "ETag": version, "X-Last-Frame-Timestamps": json.dumps(last_frame_timestamps),
+                })
+            response = json.dumps({"streams": served, "config_version": version}).encode()
+            self._send(200, response, {"Content-Type": "application/json", "ETag": version})
+
+    return StreamInfoHandler
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--streams", type=int, default=100, help="streams in the config")
+    parser.add_argument("--cameras", type=int, default=50, help="distinct source URLs")
+    parser.add_argument("--sources-per-stream", type=int, default=1, help="sources per stream, above 1 for mosaics")
+    parser.add_argument("--churn", type=float, default=0.0, help="fraction of streams replaced per churn step")
+    parser.add_argument("--churn-every", type=int, default=1, help="polls between churn steps")
+    parser.add_argument("--flap", type=float, default=0.0, help="fraction of streams toggling status per poll")
+    parser.add_argument("--delay", type=float, default=0.0, help="response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra response delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 503")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the scripted changes")
+
+
+def backend_argv(args: argparse.Namespace) -> list[str]:
+    """The command line options of `add_backend_arguments` that reproduce `args`."""
+    parser = argparse.ArgumentParser()
+    add_backend_arguments(parser)
+    argv = []
+    for action in parser._actions:
+        if action.option_strings and action.dest != "help":
+            argv += [action.option_strings[0], str(getattr(args, action.dest))]
+    return argv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(ScriptedStreams(args), Stats(), args))
+    print(f"Serving http://{args.host}:{args.port}{STREAM_INFO_PATH}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
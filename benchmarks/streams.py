@@ -0,0 +1,189 @@
+"""
+How many streams a box sustains, measured end to end against fake cameras.
+
+Starts the local RTSP stand-in of benchmarks.fake_cameras, then runs a
+GatewayService with stream handlers for each workload, bypassing the backend:
+
+    single   one camera per stream
+    mosaic   --mosaic-size cameras per stream
+    mixed    half single, half mosaic
+
+Per workload it reports time to first output frame, CPU and RSS per stream,
+output bitrate against the encoder profile target and the time a crashed
+encoder takes to produce frames again, as JSON on stdout. Gateway settings
+such as STREAMBOX_INGEST_SHARED or STREAMBOX_GROUPED_EXECUTION are read from
+the environment as usual and recorded with the results.
+
+    python -m benchmarks.streams --streams 4 --cameras 4 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import config  # noqa: E402
+from app.gateway import GatewayService  # noqa: E402
+from app.reconcile import diff_streams  # noqa: E402
+from benchmarks.fake_cameras import FakeCameras, add_camera_arguments  # noqa: E402
+
+WORKLOADS = ("single", "mosaic", "mixed")
+RECORDED_SETTINGS = (
+    "INGEST_SHARED",
+    "GROUPED_EXECUTION",
+    "PASSTHROUGH_ENABLED",
+    "LOW_RATE_DECODE_ENABLED",
+    "ENCODER_PLACEMENT",
+)
+
+
+def build_streams(workload: str, count: int, mosaic_size: int, cameras: FakeCameras) -> list[dict]:
+    urls = cameras.urls
+    streams = []
+    for index in range(count):
+        mosaic = workload == "mosaic" or (workload == "mixed" and index % 2 == 1)
+        sources = [urls[(index * mosaic_size + tile) % len(urls)] for tile in range(mosaic_size)] if mosaic else [
+            urls[index % len(urls)]
+        ]
+        streams.append({
+            "stream_id": f"{workload}-{index}",
+            "stream_url": cameras.output_url(f"{workload}-{index}"),
+            "status": "active",
+            "source_urls": sources,
+            "last_frame_timestamp": None,
+        })
+    return streams
+
+
+def has_output(handler) -> bool:
+    return handler.is_running() and handler.telemetry.frame > 0
+
+
+async def wait_for_output(handlers: list, timeout: float) -> dict[str, float | None]:
+    """Returns the seconds until every handler wrote its first frame, None for those that never did."""
+    started = time.monotonic()
+    first_output = {handler.id: None for handler in handlers}
+    while time.monotonic() - started < timeout and None in first_output.values():
+        for handler in handlers:
+            if first_output[handler.id] is None and has_output(handler):
+                first_output[handler.id] = round(time.monotonic() - started, 3)
+        await asyncio.sleep(0.1)
+    return first_output
+
+
+async def measure_restart(handler, timeout: float) -> float | None:
+    """Kills the handler's encoder and returns the seconds until its replacement writes frames."""
+    if not handler.is_running():
+        return None
+    process = handler.ffmpeg_process
+    started = time.monotonic()
+    handler.abort("benchmark restart")
+    while time.monotonic() - started < timeout:
+        if handler.ffmpeg_process not in (None, process) and has_output(handler):
+            return round(time.monotonic() - started, 3)
+        await asyncio.sleep(0.1)
+    return None
+
+
+def usage_owner(handler) -> str:
+    return f"group:{handler.group.id}" if handler.group else handler.id
+
+
+async def run_workload(workload: str, cameras: FakeCameras, args: argparse.Namespace) -> dict:
+    gateway = GatewayService(asyncio.Event())
+    streams = build_streams(workload, args.streams, args.mosaic_size, cameras)
+    try:
+        await gateway.apply_stream_diff(diff_streams(gateway.stream_handlers, streams))
+        handlers = list(gateway.stream_handlers.values())
+        first_output = await wait_for_output(handlers, args.startup_timeout)
+
+        # The first sample only sets the CPU baseline of each process
+        gateway.resources.update(gateway.get_owned_processes())
+        reports = []
+        cpu = {handler.id: [] for handler in handlers}
+        rss = {handler.id: 0 for handler in handlers}
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            await asyncio.sleep(args.sample_interval)
+            gateway.resources.update(gateway.get_owned_processes())
+            reports.append(gateway.resources.get_report())
+            for handler in handlers:
+                usage = gateway.resources.get_usage(usage_owner(handler))
+                if usage:
+                    cpu[handler.id].append(usage["cpu_percent"])
+                    rss[handler.id] = max(rss[handler.id], usage["rss_bytes"])
+
+        stream_results = []
+        for handler in handlers:
+            target = handler.get_encoder_profile().bitrate if handler.is_transcoding() else None
+            bitrate = handler.telemetry.bitrate_bps if handler.is_running() else None
+            stream_results.append({
+                "stream_id": handler.id,
+                "mode": handler.mode,
+                "sources": len(handler.valid_source_urls),
+                "encoder_group": handler.group.id if handler.group else None,
+                "time_to_first_output": first_output[handler.id],
+                "cpu_percent": round(statistics.mean(cpu[handler.id]), 2) if cpu[handler.id] else None,
+                "rss_bytes": rss[handler.id] or None,
+                "speed": handler.telemetry.speed if handler.is_running() else None,
+                "bitrate_bps": round(bitrate) if bitrate is not None else None,
+                "target_bitrate_bps": target,
+                "bitrate_ratio": round(bitrate / target, 3) if bitrate and target else None,
+                "restart_count": handler.restart_count,
+            })
+
+        restart_latency = await measure_restart(handlers[0], args.startup_timeout) if handlers else None
+        total_cpu = [report["total_cpu_percent"] for report in reports]
+        return {
+            "workload": workload,
+            "streams": len(handlers),
+            "streams_with_output": sum(value is not None for value in first_output.values()),
+            # Includes shared ingest relays and encoder groups
+            "total_cpu_percent": round(statistics.mean(total_cpu), 2) if total_cpu else None,
+            "cpu_percent_per_stream": round(statistics.mean(total_cpu) / len(handlers), 2) if total_cpu else None,
+            "total_rss_bytes": max((report["total_rss_bytes"] for report in reports), default=None),
+            "restart_latency": restart_latency,
+            "stream_results": stream_results,
+        }
+    finally:
+        await gateway.shutdown()
+        await asyncio.sleep(args.cooldown)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    cameras = FakeCameras(args.cameras, args.size, args.fps, args.gop, args.server or None, args.port)
+    async with cameras:
+        results = [await run_workload(workload, cameras, args) for workload in args.workloads]
+    return {
+        "host": {"machine": platform.machine(), "cpus": os.cpu_count(), "python": platform.python_version()},
+        "cameras": {"count": args.cameras, "size": args.size, "fps": args.fps, "gop": args.gop},
+        "settings": {name: getattr(config, name) for name in RECORDED_SETTINGS},
+        "duration": args.duration,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--streams", type=int, default=4, help="streams per workload")
+    parser.add_argument("--cameras", type=int, default=4, help="number of fake cameras")
+    parser.add_argument("--mosaic-size", type=int, default=4, help="cameras per mosaic stream")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of steady state measured per workload")
+    parser.add_argument("--sample-interval", type=float, default=2.0, help="seconds between resource samples")
+    parser.add_argument("--startup-timeout", type=float, default=30.0, help="seconds to wait for output frames")
+    parser.add_argument("--cooldown", type=float, default=5.0, help="seconds of idle time between workloads")
+    add_camera_arguments(parser)
+    args = parser.parse_args()
+
+    json.dump(asyncio.run(run(args)), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()